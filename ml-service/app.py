@@ -1,83 +1,417 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, abort, jsonify, request, send_file
+from flask.json.provider import JSONProvider
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+import hmac
 import threading
+import time
+from functools import wraps
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 
 # Import modules from model package
 from model import utils
+from model import batch
+from model import catalog
+from model import codec
+from model import jobs
+from model import metrics
+from model import persistence
+from model import profiles
+from model import profiling
 from model import recommendation
+from model import result_cache
 
 # Load environment variables
 load_dotenv()
 
+class FastJSONProvider(JSONProvider):
+    """Encode responses with the service's JSON codec"""
+    def dumps(self, obj, **kwargs):
+        return codec.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return codec.loads(s)
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 
 # MongoDB Connection - Direct connection that will be visible if it fails
 mongo_uri = os.getenv('MONGODB_URI')
 if not mongo_uri:
     print("ERROR: MONGODB_URI not set in environment variables")
-mongo_client = MongoClient(mongo_uri)
-db = mongo_client["spotify_tracker"]
+
+def connect_mongo():
+    """Open the MongoDB connection, again in every worker process after a fork"""
+    global mongo_client, db
+    mongo_client = MongoClient(mongo_uri)
+    db = mongo_client["spotify_tracker"]
+    # Job states are shared, so any worker process can report them
+    jobs.get_queue().attach(db.jobs)
+
+connect_mongo()
+
+# Seconds a client is asked to wait when the job queue is full
+JOB_RETRY_AFTER = int(os.getenv('JOB_RETRY_AFTER', 5))
+
+# Token required by the admin endpoints, which are disabled without one
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# File every process-data payload is appended to as a JSON line, for replay
+# by benchmarks.load_test. Payloads hold user data, leave unset in production.
+PAYLOAD_RECORD_PATH = os.getenv('PAYLOAD_RECORD_PATH')
+_record_lock = threading.Lock()
+
+# Seconds a MongoDB health check result is reused
+HEALTH_CHECK_TTL = float(os.getenv('HEALTH_CHECK_TTL', 10))
+_health = {'checked_at': float('-inf'), 'collections': [], 'error': None}
+
+def start_warm_up():
+    """Load the catalog and cluster models in the background, readiness reports when done"""
+    threading.Thread(target=recommendation.warm_up, args=(db,), daemon=True).start()
+
+# Load the catalog and cluster models before the first request needs them.
+# Under gunicorn every worker does this after the fork (see gunicorn.conf.py).
+if os.getenv('ML_SERVICE_PRELOAD') != '1':
+    start_warm_up()
+
+# Gauges read their current value when metrics are scraped
+metrics.QUEUE_DEPTH.set_function(lambda: jobs.get_queue().depth())
+metrics.ACTIVE_JOBS.set_function(lambda: jobs.get_queue().active())
+metrics.CATALOG_SONGS.set_function(lambda: len(catalog.get_store().columns or ()))
+metrics.RESULT_CACHE_ENTRIES.set_function(lambda: result_cache.get_cache().size())
+metrics.PERSIST_BUFFERED.set_function(lambda: persistence.get_writer().size())
+metrics.PROFILES_CACHED.set_function(lambda: profiles.get_store().size())
+metrics.PROFILES_CACHED_BYTES.set_function(lambda: profiles.get_store().nbytes())
+metrics.PROCESS_RESIDENT_MEMORY.set_function(metrics.resident_memory_bytes)
+
+def admin_only(view):
+    """Require the admin token in the X-Admin-Token header"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+def record_payload(data):
+    """Append a request payload to PAYLOAD_RECORD_PATH"""
+    try:
+        with _record_lock, open(PAYLOAD_RECORD_PATH, 'ab') as f:
+            f.write(codec.dumps(data) + b'\n')
+    except OSError as e:
+        utils.log(f"Could not record payload: {e}")
+
+def parse_number(data, key, default, cast=float):
+    """
+    Read a numeric request field.
+
+    Args:
+        data (dict): Decoded request body
+        key (str): Field name
+        default: Value when the field is missing
+        cast (type): int or float
+
+    Returns:
+        Number: Parsed value
+
+    Raises:
+        ValueError: If the field is not a number
+    """
+    value = data.get(key)
+    if value is None:
+        return default
+    # bool is an int subclass, true must not pass as 1
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{key} must be a number")
+    try:
+        number = cast(float(value)) if cast is int else cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{key} must be a number")
+    if cast is int and number != float(value):
+        raise ValueError(f"{key} must be a whole number")
+    return number
+
+def parse_user_id(data, required=True):
+    """
+    Read the userId request field.
+
+    Args:
+        data (dict): Decoded request body
+        required (bool): Whether the field must be present
+
+    Returns:
+        str: User ID, or None if missing and not required
+
+    Raises:
+        ValueError: If the field is not a non-empty string
+    """
+    user_id = data.get('userId')
+    if user_id is None and not required:
+        return None
+    if not isinstance(user_id, str) or not user_id:
+        raise ValueError("userId must be a non-empty string")
+    return user_id
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose pipeline metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 # Health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint"""
-    # Test MongoDB connection
-    try:
-        # List all collections to verify connection
-        collections = db.list_collection_names()
-        return jsonify({
-            'status': 'healthy',
-            'mongodb_connected': True,
-            'collections': collections
-        })
-    except Exception as e:
+    # Test MongoDB connection, at most once per HEALTH_CHECK_TTL seconds
+    now = time.monotonic()
+    if now - _health['checked_at'] >= HEALTH_CHECK_TTL:
+        try:
+            # List all collections to verify connection
+            _health['collections'] = db.list_collection_names()
+            _health['error'] = None
+        except Exception as e:
+            _health['error'] = str(e)
+        _health['checked_at'] = now
+    
+    if _health['error'] is not None:
         return jsonify({
             'status': 'unhealthy',
-            'mongodb_error': str(e)
+            'mongodb_error': _health['error']
         }), 500
+    return jsonify({
+        'status': 'healthy',
+        'mongodb_connected': True,
+        'collections': _health['collections']
+    })
+
+@app.route('/api/health/live', methods=['GET'])
+def liveness():
+    """Liveness probe, answers as long as the process serves requests"""
+    return jsonify({'status': 'alive'})
+
+@app.route('/api/health/ready', methods=['GET'])
+def readiness():
+    """Readiness probe, based on the cached catalog and cluster models only"""
+    state = recommendation.readiness()
+    return jsonify(state), 200 if state['ready'] else 503
 
 @app.route('/api/process-data', methods=['POST'])
 def process_data():
     """ 
     Receive data from the web service and process it to generate recommendations.
+    
+    The body is JSON or msgpack. With baseCount (and baseId, the `_id` of the
+    last preference sent before), preferences holds only the ones added since.
     """   
-    data = request.json
+    data = codec.decode_request(request)
+    if PAYLOAD_RECORD_PATH:
+        record_payload(data)
     
     # Extract information for processing
-    user_id = data.get('userId', 'unknown')
+    try:
+        user_id = parse_user_id(data)
+        base_count = parse_number(data, 'baseCount', None, cast=int)
+        if base_count is not None and base_count < 0:
+            raise ValueError("baseCount must not be negative")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
     current_questionnaire = data.get('currentQuestionnaire', {})
     previous_questionnaires = data.get('previousQuestionnaires', [])
     preferences = data.get('preferences', [])
+    profiled = bool(data.get('profile', False))
     
-    # Calculate basic statistics for processing
-    liked_songs = sum(1 for pref in preferences if pref.get('liked', False))
-    disliked_songs = len(preferences) - liked_songs
+    # Count liked songs, from the taste profile when only new preferences are sent
+    preferences_base = None
+    if base_count is not None:
+        # Add the delta to the taste profile now, so a queued job replaced by
+        # a newer submission cannot lose the preferences it carried. Only the
+        # job looks the songs up in the catalog, which may need loading.
+        try:
+            profile = profiles.get_store().accept(db, user_id, preferences, (base_count, data.get('baseId')))
+        except profiles.StaleDelta as e:
+            return jsonify({
+                "success": False,
+                "error": str(e),
+                "preferenceCount": e.preference_count
+            }), 409
+        liked_songs = profile.liked_total
+        preferences = []
+        preferences_base = (profile.preference_count, profile.last_preference_id)
+        preference_count = profile.preference_count
+    else:
+        liked_songs = sum(1 for pref in preferences if pref.get('liked', False))
+        preference_count = len(preferences)
     
     # Get questionnaire ID for processing
     questionnaire_id = None
     if current_questionnaire:
         questionnaire_id = str(current_questionnaire.get('_id', ''))
         
-        # Start processing in background to avoid blocking the response
-        def process_recommendations():
-            # Generate recommendations if we have enough liked songs
-            if liked_songs >= 5:
-                success = recommendation.generate_recommendations(
-                    db, user_id, questionnaire_id, preferences, current_questionnaire
-                )
-            
-        # Start the processing thread
-        threading.Thread(target=process_recommendations).start()
+        # Generate recommendations only if we have enough liked songs
+        if liked_songs < 5:
+            return jsonify({
+                "success": True,
+                "jobId": None,
+                "preferenceCount": preference_count
+            })
+        
+        # Queue processing in the background to avoid blocking the response.
+        # A newer submission from the same user replaces one still queued.
+        try:
+            job = jobs.get_queue().submit(
+                user_id, recommendation.generate_recommendations,
+                db, user_id, questionnaire_id, preferences, current_questionnaire, profiled, preferences_base
+            )
+        except jobs.QueueFull as e:
+            response = jsonify({
+                "success": False,
+                "error": str(e)
+            })
+            response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+            return response, 429
         
-        # Return a simple success response
+        # Return the job ID so the caller can poll its status
+        return jsonify({
+            "success": True,
+            "jobId": job.id,
+            "preferenceCount": preference_count
+        })
+
+@app.route('/api/recommendations', methods=['POST'])
+def recommendations():
+    """
+    Compute recommendations synchronously within a deadline and return them.
+    """
+    data = codec.decode_request(request)
+    try:
+        user_id = parse_user_id(data, required=False)
+        deadline_ms = parse_number(data, 'deadlineMs', recommendation.DEADLINE_MS)
+        limit = parse_number(data, 'limit', 15, cast=int)
+        base_count = parse_number(data, 'baseCount', None, cast=int)
+        if not deadline_ms > 0:
+            raise ValueError("deadlineMs must be greater than 0")
+        if not 1 <= limit <= recommendation.MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {recommendation.MAX_LIMIT}")
+        if base_count is not None and base_count < 0:
+            raise ValueError("baseCount must not be negative")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    # Report the deadline actually applied, so clients see when theirs was shortened
+    deadline_ms = min(deadline_ms, recommendation.MAX_DEADLINE_MS)
+    preferences_base = None
+    if base_count is not None:
+        preferences_base = (base_count, data.get('baseId'))
+    
+    try:
+        result = recommendation.recommend(
+            db, data.get('preferences', []), data.get('currentQuestionnaire', {}),
+            limit=limit, deadline_ms=deadline_ms, user_id=user_id,
+            preferences_base=preferences_base
+        )
+    except profiles.StaleDelta as e:
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "preferenceCount": e.preference_count
+        }), 409
+    except recommendation.RecommendationError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 422
+    except Exception as e:
+        utils.log(f"Synchronous recommendation failed: {e!r}")
         return jsonify({
-            "success": True
+            "success": False,
+            "error": "Recommendation failed"
+        }), 500
+    
+    return jsonify({
+        "success": True,
+        "deadlineMs": deadline_ms,
+        **result
+    })
+
+@app.route('/api/batch-recommendations', methods=['POST'])
+def batch_recommendations():
+    """
+    Queue recommendation generation for many users in a single job.
+    """
+    data = codec.decode_request(request)
+    users = data.get('users', [])
+    try:
+        batch.validate_batch(users)
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+    
+    # Batches never coalesce, a later batch must not replace one still queued
+    try:
+        job = jobs.get_queue().submit(
+            None, batch.generate_batch_recommendations, db, users
+        )
+    except jobs.QueueFull as e:
+        response = jsonify({
+            "success": False,
+            "error": str(e)
         })
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response, 429
+    
+    return jsonify({
+        "success": True,
+        "jobId": job.id,
+        "users": len(users)
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Report the state of a recommendation job.
+    """
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        return jsonify({
+            'error': 'Job not found'
+        }), 404
+    
+    return jsonify(job.to_dict())
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@admin_only
+def list_profiles():
+    """
+    List the most recent job profiles, newest first.
+    """
+    return jsonify({
+        'profiles': profiling.list_profiles()
+    })
+
+@app.route('/api/admin/profiles/<profile_id>/<kind>', methods=['GET'])
+@admin_only
+def download_profile(profile_id, kind):
+    """
+    Download a job profile as collapsed stacks, a pstats dump or its metadata.
+    """
+    path = profiling.profile_path(profile_id, kind)
+    if path is None:
+        return jsonify({
+            'error': 'Profile not found'
+        }), 404
+    
+    return send_file(path, as_attachment=True, download_name=os.path.basename(path))
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5050))
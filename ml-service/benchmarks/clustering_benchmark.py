@@ -0,0 +1,126 @@
+"""
+Compare the exact and large catalog clustering modes on synthetic features,
+and the serial and parallel cluster count sweeps.
+
+Usage: python -m benchmarks.clustering_benchmark --sizes 5000 20000 100000 [--sweep-sizes 100000 --workers 4]
+"""
+import argparse
+import json
+import time
+import numpy as np
+from sklearn.metrics import adjusted_rand_score, silhouette_score
+from model import clustering
+
+def synthetic_features(n_songs, n_groups=12, seed=42):
+    """
+    Generate normalized feature rows scattered around a few genre-like centers.
+    
+    Args:
+        n_songs (int): Number of rows to generate
+        n_groups (int): Number of underlying groups
+        seed (int): Random seed
+        
+    Returns:
+        np.array: Feature array in the 0-1 range
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0.1, 0.9, size=(n_groups, 7))
+    groups = rng.randint(0, n_groups, size=n_songs)
+    features = centers[groups] + rng.normal(0, 0.08, size=(n_songs, 7))
+    return np.clip(features, 0, 1).astype(np.float32)
+
+def run_mode(features, large_catalog, eval_sample):
+    """
+    Fit one clustering mode and measure its runtime and quality.
+    
+    Args:
+        features (np.array): Feature array
+        large_catalog (bool): Whether to use the large catalog mode
+        eval_sample (np.array): Row indices used to score quality
+        
+    Returns:
+        tuple: (result dict, cluster labels)
+    """
+    start = time.perf_counter()
+    clusters, kmeans, _ = clustering.fit_cluster_models(features, len(features), large_catalog=large_catalog)
+    seconds = time.perf_counter() - start
+    
+    return {
+        'mode': 'large' if large_catalog else 'exact',
+        'seconds': round(seconds, 3),
+        'n_clusters': int(kmeans.n_clusters),
+        'inertia_per_song': float(kmeans.inertia_ / len(features)),
+        'silhouette': float(silhouette_score(features[eval_sample], clusters[eval_sample]))
+    }, clusters
+
+def run_sweep(features, workers):
+    """
+    Fit the large catalog mode with a serial and a parallel cluster count sweep.
+    
+    Args:
+        features (np.array): Feature array, large enough for the parallel sweep
+        workers (int): Processes of the parallel sweep
+        
+    Returns:
+        dict: Runtimes of both sweeps and the chosen cluster count
+    """
+    processes = clustering.sweep_workers(len(features), workers)
+    assert processes > 1, (
+        f"{len(features)} songs run the serial sweep, the parallel one starts at "
+        f"{clustering.PARALLEL_SWEEP_MIN_SONGS} songs"
+    )
+    
+    runs = {}
+    for mode, mode_workers in (('serial', 1), ('parallel', workers)):
+        start = time.perf_counter()
+        clusters, kmeans, _ = clustering.fit_cluster_models(
+            features, len(features), large_catalog=True, workers=mode_workers
+        )
+        runs[mode] = (time.perf_counter() - start, clusters, int(kmeans.n_clusters))
+    
+    serial_seconds, serial_clusters, serial_n = runs['serial']
+    parallel_seconds, parallel_clusters, parallel_n = runs['parallel']
+    # The chosen count must not depend on the worker count
+    assert serial_n == parallel_n and np.array_equal(serial_clusters, parallel_clusters)
+    
+    return {
+        'mode': 'sweep',
+        'workers': processes,
+        'serial_seconds': round(serial_seconds, 3),
+        'parallel_seconds': round(parallel_seconds, 3),
+        'speedup': round(serial_seconds / max(parallel_seconds, 1e-9), 2),
+        'n_clusters': parallel_n
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 20000, 50000])
+    parser.add_argument('--exact-limit', type=int, default=50000,
+                        help='Largest catalog the exact mode is run on')
+    parser.add_argument('--sweep-sizes', type=int, nargs='*', default=[100000],
+                        help='Catalog sizes the serial and parallel sweeps are compared on')
+    parser.add_argument('--workers', type=int, default=max(2, clustering.CLUSTERING_WORKERS),
+                        help='Processes of the parallel sweep')
+    args = parser.parse_args()
+    
+    for n_songs in args.sizes:
+        features = synthetic_features(n_songs)
+        eval_sample = np.random.RandomState(0).choice(n_songs, min(n_songs, 5000), replace=False)
+        
+        large, large_clusters = run_mode(features, True, eval_sample)
+        results = [large]
+        
+        if n_songs <= args.exact_limit:
+            exact, exact_clusters = run_mode(features, False, eval_sample)
+            large['agreement_with_exact'] = float(adjusted_rand_score(exact_clusters, large_clusters))
+            large['speedup'] = round(exact['seconds'] / max(large['seconds'], 1e-9), 2)
+            results.insert(0, exact)
+        
+        for result in results:
+            print(json.dumps({'songs': n_songs, **result}))
+    
+    for n_songs in args.sweep_sizes:
+        print(json.dumps({'songs': n_songs, **run_sweep(synthetic_features(n_songs), args.workers)}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+"""
+Load test the ML service by replaying process-data payloads at set arrival rates.
+
+Usage: python -m benchmarks.load_test --rates 1 2 4 8 --duration 60 [--payloads recorded.jsonl]
+       [--songs 20000 | --catalog songs.jsonl] [--url http://localhost:5050] [--output results.jsonl]
+
+Payloads are read from a JSON lines file, as recorded by the service with
+PAYLOAD_RECORD_PATH set, or synthesized for synthetic users. Without --url
+the Flask app is served in this process by werkzeug's threaded server and
+backed by an in-memory MongoDB stand-in holding a synthetic catalog, or the
+songs of --catalog (JSON lines, e.g. from mongoexport). The job queue then
+runs with --job-workers threads.
+
+Each rate runs for --duration seconds with Poisson arrivals and at most
+--concurrency submissions in flight, each submission being followed until
+its job finishes. One JSON object is printed per rate, with the end-to-end
+job latency percentiles, completed recommendations per second, queue wait
+(submission to start), service time (start to finish), rejections and the
+service's memory and queue depth over time, then a final object naming the
+first saturated rate.
+
+Against a gunicorn deployment with several workers, memory and queue depth
+are those of whichever worker answers the metrics scrape.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+
+# A rate is saturated once the service completes less than this share of the
+# jobs offered per second, counting the time to drain them after the last arrival
+SATURATION_THROUGHPUT = 0.9
+
+# Distinct job errors kept per rate
+MAX_ERRORS = 5
+
+FINISHED = ('succeeded', 'failed', 'superseded')
+
+def load_payloads(path):
+    """
+    Read recorded process-data payloads.
+
+    Args:
+        path (str): JSON lines file written with PAYLOAD_RECORD_PATH
+
+    Returns:
+        list: Payloads in recorded order
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def synthesize_payloads(song_ids, count, seed=42):
+    """
+    Generate process-data payloads for distinct synthetic users.
+
+    Args:
+        song_ids (list): Spotify IDs of the catalog
+        count (int): Number of users
+        seed (int): Random seed
+
+    Returns:
+        list: Payloads, one per user
+    """
+    from benchmarks import synthetic
+    return [synthetic.generate_user(song_ids, seed=seed + i) for i in range(count)]
+
+def load_catalog(path):
+    """
+    Read song documents exported from MongoDB.
+
+    Args:
+        path (str): JSON lines file in MongoDB extended JSON
+
+    Returns:
+        list: Song documents
+    """
+    from bson import json_util
+    with open(path) as f:
+        return [json_util.loads(line) for line in f if line.strip()]
+
+def start_local_service(songs, job_workers):
+    """
+    Serve the Flask app in this process on an in-memory MongoDB stand-in.
+
+    Args:
+        songs (list): Song documents loaded into the stand-in
+        job_workers (int): Worker threads of the job queue
+
+    Returns:
+        str: Base URL of the service
+    """
+    # Configure the service before its modules read the environment
+    os.environ['ML_SERVICE_PRELOAD'] = '1'
+    os.environ['JOB_WORKERS'] = str(job_workers)
+    os.environ.setdefault('MODEL_DIR', tempfile.mkdtemp(prefix='load-test-'))
+    os.environ.setdefault('MONGODB_URI', 'mongodb://localhost:27017')
+
+    import mongomock
+    from werkzeug.serving import make_server
+    import app as service
+    from model import jobs
+    from model import recommendation
+
+    # The real client never connects, every endpoint uses the stand-in
+    service.mongo_client = mongomock.MongoClient()
+    service.db = service.mongo_client['spotify_tracker']
+    service.db.songs.insert_many(songs)
+    jobs.get_queue().attach(service.db.jobs)
+    recommendation.warm_up(service.db)
+
+    # Request lines for every poll would drown the results
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, service.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+class ServiceSampler:
+    """
+    Scrapes the service's metrics at a fixed interval for its resident
+    memory, queue depth and running jobs over time.
+    """
+
+    SERIES = {
+        'process_resident_memory_bytes': 'rssMb',
+        'recommendation_queue_depth': 'queueDepth',
+        'recommendation_active_jobs': 'activeJobs'
+    }
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name='service-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        import requests
+
+        session = requests.Session()
+        while True:
+            sample = {'t': round(time.perf_counter() - self.start_time, 3)}
+            try:
+                text = session.get(f'{self.url}/metrics', timeout=5).text
+                for line in text.splitlines():
+                    name, _, value = line.partition(' ')
+                    if name in self.SERIES:
+                        sample[self.SERIES[name]] = float(value)
+            except requests.RequestException:
+                pass
+            if 'rssMb' in sample:
+                sample['rssMb'] = round(sample['rssMb'] / 2 ** 20, 1)
+            self.samples.append(sample)
+            if self.stopped.wait(self.interval):
+                return
+
+class LoadRun:
+    """
+    Replays payloads at one arrival rate and follows every job to its end.
+    """
+
+    def __init__(self, url, payloads, rate, duration, concurrency, poll_interval, job_timeout, seed):
+        self.url = url
+        self.payloads = payloads
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.random = random.Random(seed)
+        self.results = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.local = threading.local()
+
+    def run(self, sample_interval):
+        """
+        Send payloads with exponential gaps for the run's duration, then wait
+        for every submitted job to finish.
+
+        Args:
+            sample_interval (float): Seconds between metrics scrapes
+
+        Returns:
+            dict: Summary of the run
+        """
+        sampler = ServiceSampler(self.url, sample_interval)
+        sampler.start()
+        client_limited = 0
+        arrivals = 0
+
+        start = time.perf_counter()
+        next_arrival = start
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                next_arrival += self.random.expovariate(self.rate)
+                if next_arrival - start >= self.duration:
+                    break
+                time.sleep(max(0.0, next_arrival - time.perf_counter()))
+
+                payload = self.payloads[arrivals % len(self.payloads)]
+                arrivals += 1
+                # Arrivals keep their schedule, those finding every slot busy are counted
+                if not self.slots.acquire(blocking=False):
+                    client_limited += 1
+                    continue
+                executor.submit(self._submit, payload)
+            arrival_seconds = time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+
+        return self._summary(arrivals, client_limited, arrival_seconds, elapsed, sampler.samples)
+
+    def _session(self):
+        import requests
+
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _submit(self, payload):
+        import requests
+
+        result = {'outcome': 'error'}
+        start = time.perf_counter()
+        try:
+            response = self._session().post(f'{self.url}/api/process-data', json=payload, timeout=self.job_timeout)
+            if response.status_code == 429:
+                result['outcome'] = 'rejected'
+            elif response.ok and response.json().get('jobId') is None:
+                result['outcome'] = 'not_queued'
+            elif response.ok:
+                result.update(self._follow(response.json()['jobId'], start))
+            result['submitSeconds'] = response.elapsed.total_seconds()
+        except requests.RequestException as e:
+            result['error'] = str(e)
+        finally:
+            result['seconds'] = time.perf_counter() - start
+            with self.lock:
+                self.results.append(result)
+            self.slots.release()
+
+    def _follow(self, job_id, start):
+        while time.perf_counter() - start < self.job_timeout:
+            response = self._session().get(f'{self.url}/api/jobs/{job_id}', timeout=self.job_timeout)
+            job = response.json() if response.ok else {}
+            if job.get('status') in FINISHED:
+                return {
+                    'outcome': job['status'],
+                    'error': job.get('error'),
+                    'queueWaitSeconds': _seconds_between(job.get('submittedAt'), job.get('startedAt')),
+                    'serviceSeconds': _seconds_between(job.get('startedAt'), job.get('finishedAt'))
+                }
+            time.sleep(self.poll_interval)
+            if response.status_code == 404:
+                # Job expired from the jobs collection
+                return {'outcome': 'lost'}
+        return {'outcome': 'timeout'}
+
+    def _summary(self, arrivals, client_limited, arrival_seconds, elapsed, samples):
+        outcomes = {}
+        for result in self.results:
+            outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+
+        succeeded = [result for result in self.results if result['outcome'] == 'succeeded']
+        queued = [result for result in self.results if result['outcome'] not in ('not_queued', 'superseded')]
+        errors = sorted({result['error'] for result in self.results if result.get('error')})[:MAX_ERRORS]
+        rss = [sample['rssMb'] for sample in samples if 'rssMb' in sample]
+
+        # Jobs still running after the last arrival count towards the time taken
+        offered = len(queued) / arrival_seconds if arrival_seconds > 0 else 0.0
+        completed = len(succeeded) / elapsed if elapsed > 0 else 0.0
+        return {
+            'rate': self.rate,
+            'durationSeconds': self.duration,
+            'concurrency': self.concurrency,
+            'arrivals': arrivals,
+            'clientLimited': client_limited,
+            'outcomes': outcomes,
+            'errors': errors,
+            'offeredPerSecond': round(offered, 3),
+            'completedPerSecond': round(completed, 3),
+            'latencySeconds': _percentiles([result['seconds'] for result in succeeded]),
+            'queueWaitSeconds': _percentiles([result['queueWaitSeconds'] for result in succeeded
+                                              if result.get('queueWaitSeconds') is not None]),
+            'serviceSeconds': _percentiles([result['serviceSeconds'] for result in succeeded
+                                            if result.get('serviceSeconds') is not None]),
+            'submitSeconds': _percentiles([result['submitSeconds'] for result in self.results
+                                           if 'submitSeconds' in result]),
+            'drainSeconds': round(elapsed - arrival_seconds, 3),
+            'peakRssMb': max(rss) if rss else None,
+            'samples': samples,
+            'saturated': bool(outcomes.get('rejected') or client_limited
+                              or completed < SATURATION_THROUGHPUT * offered)
+        }
+
+def _seconds_between(start, end):
+    if not start or not end:
+        return None
+    return (_parse_time(end) - _parse_time(start)).total_seconds()
+
+def _parse_time(value):
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+def _percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4), 'max': round(max(values), 4)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rates', type=float, nargs='+', default=[1, 2, 4, 8],
+                        help='Arrival rates in submissions per second, run in order')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of arrivals per rate')
+    parser.add_argument('--concurrency', type=int, default=64, help='Most submissions followed at once')
+    parser.add_argument('--payloads', help='Recorded payloads to replay instead of synthetic users')
+    parser.add_argument('--users', type=int, default=200,
+                        help='Synthetic users when no payloads are given, repeated users hit the result cache')
+    parser.add_argument('--url', help='Running service to test instead of an in-process one')
+    parser.add_argument('--songs', type=int, default=20000, help='Synthetic catalog size of the in-process service')
+    parser.add_argument('--catalog', help='Song documents for the in-process service instead of a synthetic catalog')
+    parser.add_argument('--job-workers', type=int, default=2, help='Job queue threads of the in-process service')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--job-timeout', type=float, default=300)
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between metrics scrapes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Append results to this JSON lines file')
+    args = parser.parse_args()
+    if any(rate <= 0 for rate in args.rates):
+        parser.error('--rates must be greater than 0')
+
+    songs = None
+    if args.url is None or args.payloads is None:
+        from benchmarks import synthetic
+        songs = load_catalog(args.catalog) if args.catalog else synthetic.generate_songs(args.songs, seed=args.seed)
+
+    if args.payloads:
+        payloads = load_payloads(args.payloads)
+    else:
+        payloads = synthesize_payloads([song['spotifyId'] for song in songs], args.users, seed=args.seed)
+
+    url = args.url.rstrip('/') if args.url else start_local_service(songs, args.job_workers)
+    del songs
+
+    saturation_rate = None
+    for index, rate in enumerate(args.rates):
+        run = LoadRun(url, payloads, rate, args.duration, args.concurrency,
+                      args.poll_interval, args.job_timeout, args.seed + index)
+        result = run.run(args.sample_interval)
+        line = json.dumps(result)
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + '\n')
+        if result['saturated'] and saturation_rate is None:
+            saturation_rate = rate
+
+    print(json.dumps({'saturationRate': saturation_rate, 'rates': args.rates}), flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Benchmark the recommendation pipeline stages on synthetic catalogs.
+
+Usage: python -m benchmarks.suite --sizes 1000 10000 100000 1000000 [--output results.jsonl]
+       [--memory-budget MB --rss-ceiling MB]
+
+Each catalog size runs in a fresh process so peak RSS is measured per size.
+Results are printed as one JSON object per size. With --rss-ceiling the
+suite fails if a service stage grows the RSS by more than the ceiling.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# Stages doing what the service does. The others hold every synthetic
+# document or every user's full score arrays for the benchmark itself,
+# so their memory does not say anything about the service's.
+SERVICE_STAGES = ('extract_features', 'apply_preference_weights', 'cluster_songs', 'build_song_columns',
+                  'retrieve_candidates', 'score_retrieved')
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def _proc_status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    # Linux resets the peak RSS (VmHWM) to the current RSS on request
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class _Stages:
+    """
+    Collects wall time, peak RSS and throughput per stage.
+    
+    Where the peak RSS can be reset, each stage also reports how far it
+    grew the RSS above what was resident when it started.
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, func, items=None):
+        rss_before = _proc_status_mb('VmRSS') if _reset_peak_rss() else None
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+
+        entry = {'seconds': round(seconds, 6), 'peak_rss_mb': _peak_rss_mb()}
+        if rss_before is not None:
+            entry['peak_growth_mb'] = round(_proc_status_mb('VmHWM') - rss_before, 1)
+        if items:
+            entry['items_per_second'] = round(items / seconds, 2) if seconds > 0 else None
+        self.results[name] = entry
+        return result
+
+def run_size(n_songs, n_users, full_pipeline, seed, model_dir, memory_budget=None, rss_ceiling=None):
+    """
+    Benchmark every stage on one synthetic catalog size.
+
+    Args:
+        n_songs (int): Catalog size
+        n_users (int): Number of synthetic users scored
+        full_pipeline (bool): Whether to run generate_recommendations against mongomock
+        seed (int): Random seed of the catalog and users
+        model_dir (str): Directory for persisted catalog and cluster models
+        memory_budget (float): MEMORY_BUDGET_MB of the service (optional)
+        rss_ceiling (float): Most megabytes a service stage may grow the RSS by (optional)
+
+    Returns:
+        dict: Benchmark results for the size
+    """
+    # Configure the service before its modules read the environment
+    os.environ['MODEL_DIR'] = model_dir
+    os.environ['CLUSTER_BACKGROUND_WARM'] = '0'
+    if memory_budget is not None:
+        os.environ['MEMORY_BUDGET_MB'] = str(memory_budget)
+
+    from benchmarks import synthetic
+    from model import cluster_cache, clustering, feature_extraction, retrieval, scoring, utils
+
+    stages = _Stages()
+    songs = stages.run('generate_catalog', lambda: synthetic.generate_songs(n_songs, seed=seed), items=n_songs)
+    song_ids = [song['spotifyId'] for song in songs]
+    users = [synthetic.generate_user(song_ids, seed=seed + i) for i in range(n_users)]
+
+    features, _ = stages.run(
+        'extract_features', lambda: feature_extraction.extract_features(songs),
+        items=n_songs
+    )
+    weighted = stages.run(
+        'apply_preference_weights', lambda: feature_extraction.apply_preference_weights(features, 'balanced', 'balanced'),
+        items=n_songs
+    )
+    clusters, kmeans_model = stages.run(
+        'cluster_songs', lambda: clustering.cluster_songs(weighted, n_songs), items=n_songs
+    )
+    columns = stages.run('build_song_columns', lambda: scoring.build_song_columns(songs), items=n_songs)
+    base = scoring.base_scores(columns)
+
+    parsed = []
+    for user in users:
+        _, _, discovery = utils.extract_questionnaire_preferences(user['currentQuestionnaire']['answers'])
+        liked, disliked = utils.extract_song_preferences(user['preferences'])
+        parsed.append((liked, disliked, discovery))
+
+    scored = stages.run(
+        'score_songs',
+        lambda: [scoring.score_array(weighted, clusters, columns, liked, disliked, discovery, base=base)
+                 for liked, disliked, discovery in parsed],
+        items=n_users
+    )
+    stages.results['score_songs']['songs_per_second'] = round(
+        n_songs * n_users / stages.results['score_songs']['seconds'], 2
+    )
+    stages.run(
+        'rank_recommendations',
+        lambda: [scoring.rank_candidates(rows, scores, columns, limit=15) for rows, scores in scored],
+        items=n_users
+    )
+
+    # Two-stage path: retrieve a candidate budget, then score only those songs
+    models = cluster_cache.ClusterModels('benchmark', 0, weighted, clusters, kmeans_model, None)
+    resolved = [scoring.resolve_ratings(columns, liked, disliked) for liked, disliked, _ in parsed]
+    allowed = stages.run(
+        'retrieve_candidates',
+        lambda: [retrieval.retrieve_candidates(models, base, liked_rows, discovery)
+                 for (liked_rows, _), (_, _, discovery) in zip(resolved, parsed)],
+        items=n_users
+    )
+    stages.run(
+        'score_retrieved',
+        lambda: [scoring.score_rows(weighted, clusters, columns, liked_rows, rated_rows, bool(liked), discovery,
+                                    base=base, allowed=mask)
+                 for (liked_rows, rated_rows), (liked, _, discovery), mask in zip(resolved, parsed, allowed)],
+        items=n_users
+    )
+
+    result = {
+        'songs': n_songs,
+        'users': n_users,
+        'n_clusters': int(kmeans_model.n_clusters),
+        'stages': stages.results
+    }
+    growth = [stages.results[name].get('peak_growth_mb') for name in SERVICE_STAGES]
+    if None not in growth:
+        result['service_peak_growth_mb'] = max(growth)
+        if rss_ceiling is not None:
+            result['rss_ceiling_mb'] = rss_ceiling
+            result['within_rss_ceiling'] = max(growth) <= rss_ceiling
+    del features, weighted, scored, models, allowed
+
+    if full_pipeline:
+        result['generate_recommendations'] = _run_full_pipeline(songs, users)
+
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+def _run_full_pipeline(songs, users):
+    import mongomock
+    from model import recommendation
+
+    db = mongomock.MongoClient()['spotify_tracker']
+    db.songs.insert_many(songs)
+
+    def generate(user):
+        questionnaire = user['currentQuestionnaire']
+        return recommendation.generate_recommendations(
+            db, user['userId'], questionnaire['_id'], user['preferences'], questionnaire
+        )
+
+    # The first request loads the catalog and fits the cluster models
+    start = time.perf_counter()
+    generate(users[0])
+    cold_seconds = time.perf_counter() - start
+
+    # Fit the remaining weight profiles so every timed request hits warm models
+    start = time.perf_counter()
+    recommendation.warm_up(db)
+    warm_up_seconds = time.perf_counter() - start
+
+    latencies = []
+    start = time.perf_counter()
+    for user in users:
+        user_start = time.perf_counter()
+        generate(user)
+        latencies.append(time.perf_counter() - user_start)
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'cold_seconds': round(cold_seconds, 6),
+        'warm_up_seconds': round(warm_up_seconds, 6),
+        'warm_mean_seconds': round(seconds / len(users), 6),
+        'warm_p50_seconds': round(latencies[len(latencies) // 2], 6),
+        'warm_max_seconds': round(latencies[-1], 6),
+        'requests_per_second': round(len(users) / seconds, 2) if seconds > 0 else None,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+def _environment():
+    import numpy
+    import sklearn
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'scikit-learn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--users', type=int, default=20, help='Synthetic users scored per size')
+    parser.add_argument('--full-pipeline-max', type=int, default=100000,
+                        help='Largest catalog generate_recommendations is run on')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Append results to this JSON lines file')
+    parser.add_argument('--memory-budget', type=float, help='MEMORY_BUDGET_MB the service runs with')
+    parser.add_argument('--rss-ceiling', type=float,
+                        help='Fail if a service stage grows the RSS by more megabytes than this')
+    args = parser.parse_args()
+
+    environment = _environment()
+    context = multiprocessing.get_context('spawn')
+
+    exceeded = []
+    for n_songs in args.sizes:
+        with tempfile.TemporaryDirectory() as model_dir, context.Pool(1) as pool:
+            result = pool.apply(
+                run_size, (n_songs, args.users, n_songs <= args.full_pipeline_max, args.seed, model_dir,
+                           args.memory_budget, args.rss_ceiling)
+            )
+        line = json.dumps({**result, 'environment': environment})
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + '\n')
+        if result.get('within_rss_ceiling') is False:
+            exceeded.append(n_songs)
+
+    if exceeded:
+        sys.exit(f"RSS ceiling of {args.rss_ceiling} MB exceeded for catalog sizes {exceeded}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Synthetic song catalogs and user preferences for offline benchmarks.
+
+Audio features follow the per-genre baselines of the song import script
+(src/import-scripts/utils/audio-features.ts), with noise added so songs of
+the same genre are not identical.
+"""
+from datetime import datetime
+import numpy as np
+from bson.objectid import ObjectId
+
+DEFAULT_FEATURES = {
+    'danceability': 0.5,
+    'energy': 0.5,
+    'acousticness': 0.5,
+    'instrumentalness': 0.0,
+    'valence': 0.5,
+    'tempo': 120.0
+}
+
+# Genre groups and their overrides of the default audio features
+GENRE_GROUPS = [
+    (['dance', 'edm', 'electro', 'electronic', 'house', 'techno', 'trance', 'drum-and-bass', 'dubstep'],
+     {'danceability': 0.8, 'energy': 0.9, 'tempo': 128, 'instrumentalness': 0.4, 'acousticness': 0.2}),
+    (['classical', 'ambient'],
+     {'acousticness': 0.9, 'energy': 0.3, 'instrumentalness': 0.8, 'valence': 0.4}),
+    (['rock', 'metal', 'alt-rock', 'punk'],
+     {'energy': 0.9, 'tempo': 140, 'acousticness': 0.3, 'valence': 0.6}),
+    (['jazz', 'blues', 'soul'],
+     {'acousticness': 0.7, 'instrumentalness': 0.4, 'energy': 0.5, 'tempo': 100, 'valence': 0.4}),
+    (['hip-hop', 'r-n-b'],
+     {'danceability': 0.7, 'energy': 0.7, 'acousticness': 0.3, 'tempo': 95}),
+    (['pop', 'k-pop'],
+     {'danceability': 0.7, 'energy': 0.8, 'valence': 0.7}),
+    (['folk', 'acoustic', 'country'],
+     {'acousticness': 0.8, 'instrumentalness': 0.2, 'energy': 0.4, 'danceability': 0.4, 'tempo': 110}),
+    (['latin', 'reggae', 'afrobeat'],
+     {'danceability': 0.8, 'energy': 0.6, 'valence': 0.7, 'tempo': 105}),
+    (['indie', 'indie-pop', 'alternative'],
+     {'energy': 0.6, 'danceability': 0.5, 'valence': 0.5, 'acousticness': 0.4}),
+    (['disco', 'funk'],
+     {'danceability': 0.9, 'energy': 0.7, 'valence': 0.8, 'tempo': 115, 'acousticness': 0.3}),
+]
+
+GENRES = [genre for genres, _ in GENRE_GROUPS for genre in genres]
+GENRE_FEATURES = {
+    genre: {**DEFAULT_FEATURES, **overrides}
+    for genres, overrides in GENRE_GROUPS
+    for genre in genres
+}
+
+# Spread of the noise added around each genre baseline
+FEATURE_NOISE = 0.08
+TEMPO_NOISE = 12.0
+
+MOODS = ['energetic', 'chill', 'balanced']
+VIBES = ['happy', 'sad', 'balanced']
+DISCOVERY = ['similar', 'explore', 'balanced']
+
+def generate_songs(n_songs, seed=42, artists_per_genre=200):
+    """
+    Generate song documents shaped like the songs collection.
+
+    Args:
+        n_songs (int): Number of songs
+        seed (int): Random seed
+        artists_per_genre (int): Size of each genre's artist pool
+
+    Returns:
+        list: Song documents
+    """
+    rng = np.random.RandomState(seed)
+    genre_index = rng.randint(0, len(GENRES), size=n_songs)
+    baselines = np.array([[GENRE_FEATURES[genre][name] for name in DEFAULT_FEATURES] for genre in GENRES])
+
+    noise = rng.normal(0, FEATURE_NOISE, size=(n_songs, len(DEFAULT_FEATURES)))
+    noise[:, -1] = rng.normal(0, TEMPO_NOISE, size=n_songs)
+    values = baselines[genre_index] + noise
+    values[:, :-1] = np.clip(values[:, :-1], 0, 1)
+
+    popularity = np.clip(rng.normal(45, 20, size=n_songs), 0, 100).astype(int)
+    years = rng.randint(1960, 2026, size=n_songs)
+    artists = rng.randint(0, artists_per_genre, size=n_songs)
+
+    updated_at = datetime(2024, 1, 1)
+    songs = []
+    for i in range(n_songs):
+        genre = GENRES[genre_index[i]]
+        artist_id = f'{genre}-artist-{artists[i]}'
+        songs.append({
+            '_id': ObjectId(),
+            'spotifyId': f'song{i:08d}',
+            'name': f'Song {i}',
+            'artists': [{'id': artist_id, 'name': artist_id}],
+            'album': {
+                'releaseDate': f'{years[i]}-01-01',
+                'images': [{'url': f'https://example.com/{i}.jpg', 'height': 640, 'width': 640}]
+            },
+            'popularity': int(popularity[i]),
+            'genre': genre,
+            'audioFeatures': dict(zip(DEFAULT_FEATURES, values[i].tolist())),
+            'updatedAt': updated_at
+        })
+    return songs
+
+def generate_user(song_ids, n_ratings=60, like_ratio=0.6, seed=0):
+    """
+    Generate a process-data payload for one synthetic user.
+
+    Args:
+        song_ids (list): Spotify IDs to rate from
+        n_ratings (int): Number of rated songs
+        like_ratio (float): Share of ratings that are likes
+        seed (int): Random seed
+
+    Returns:
+        dict: Payload with userId, currentQuestionnaire and preferences
+    """
+    rng = np.random.RandomState(seed)
+    rated = rng.choice(len(song_ids), size=min(n_ratings, len(song_ids)), replace=False)
+    preferences = [
+        {'userId': f'user{seed}', 'songId': song_ids[i], 'liked': bool(rng.rand() < like_ratio)}
+        for i in rated.tolist()
+    ]
+
+    answers = [
+        {'questionId': 'mood', 'selectedOption': MOODS[rng.randint(len(MOODS))]},
+        {'questionId': 'vibe', 'selectedOption': VIBES[rng.randint(len(VIBES))]},
+        {'questionId': 'discovery', 'selectedOption': DISCOVERY[rng.randint(len(DISCOVERY))]}
+    ]
+    return {
+        'userId': f'user{seed}',
+        'currentQuestionnaire': {'_id': f'questionnaire{seed}', 'userId': f'user{seed}', 'answers': answers},
+        'previousQuestionnaires': [],
+        'preferences': preferences
+    }
@@ -0,0 +1,46 @@
+"""
+Gunicorn configuration for serving the ML service in production.
+
+Usage: gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master, which memory-maps the catalog and
+cluster models already persisted under MODEL_DIR before forking, so the
+workers share one copy of the feature matrices. The master never queries
+MongoDB or fits models: every worker warms up in a background thread after
+the fork, serving liveness probes meanwhile and readiness once warm. The
+catalog and model file locks let one worker build or fit while the others
+wait for its files, and workers follow catalog versions published by
+whichever refreshes first. Job states are kept in the jobs collection, so
+every worker reports them and the queue depth limit holds for the whole
+service (see jobs.JobQueue).
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5050)}"
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+preload_app = True
+
+# Tell app.py to leave warm-up to the workers, started after the fork
+os.environ['ML_SERVICE_PRELOAD'] = '1'
+
+def when_ready(server):
+    import app
+    from model import recommendation
+
+    recommendation.load_persisted()
+
+    # The MongoDB client is not fork-safe, workers open their own
+    app.mongo_client.close()
+
+    # Keep the garbage collector from touching objects created so far, so
+    # their memory pages stay shared with the workers after the fork
+    gc.freeze()
+
+def post_fork(server, worker):
+    import app
+    app.connect_mongo()
+    app.start_warm_up()
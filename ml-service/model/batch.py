@@ -0,0 +1,201 @@
+"""
+Batch recommendation generation for many users in one pass.
+
+Usage: python -m model.batch users.json [--workers N]
+"""
+import argparse
+import os
+import time
+import numpy as np
+from . import catalog
+from . import cluster_cache
+from . import codec
+from . import feature_extraction
+from . import jobs
+from . import memory
+from . import persistence
+from . import scoring
+from . import utils
+
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', os.cpu_count() or 1))
+BATCH_USER_CHUNK = int(os.getenv('BATCH_USER_CHUNK', 16))
+
+# Scratch bytes per user and song while a chunk of users is scored
+SCORE_BYTES_PER_SONG = 32
+
+# Users need this many liked songs before recommendations are generated
+MIN_LIKED_SONGS = 5
+
+def validate_batch(batch):
+    """
+    Check the shape of a batch before it is queued.
+
+    Args:
+        batch: Decoded batch, a list of dicts with userId, currentQuestionnaire and preferences
+
+    Raises:
+        ValueError: If the batch or one of its entries is malformed
+    """
+    if not isinstance(batch, list):
+        raise ValueError("users must be a list")
+    for index, entry in enumerate(batch):
+        if not isinstance(entry, dict):
+            raise ValueError(f"users[{index}] must be an object")
+        user_id = entry.get('userId')
+        if not isinstance(user_id, str) or not user_id:
+            raise ValueError(f"users[{index}].userId must be a non-empty string")
+        if not isinstance(entry.get('currentQuestionnaire'), dict):
+            raise ValueError(f"users[{index}].currentQuestionnaire must be an object")
+        preferences = entry.get('preferences')
+        if not isinstance(preferences, list) or not all(isinstance(p, dict) for p in preferences):
+            raise ValueError(f"users[{index}].preferences must be a list of objects")
+
+def _score_chunk(features_array, clusters, valid, base, artist_offsets, artist_values, users, limit):
+    """
+    Score a chunk of users sharing a weight profile and pick their top songs.
+
+    Returns:
+        list: (rows, scores) of the selected songs for each user
+    """
+    liked_rows, rated_rows, has_likes, discovery = zip(*users)
+    scores, candidates = scoring.score_matrix(
+        features_array, clusters, valid, base, liked_rows, rated_rows, has_likes, discovery
+    )
+
+    results = []
+    for user in range(len(users)):
+        candidate_rows = np.nonzero(candidates[user])[0]
+        user_scores = scores[user, candidate_rows]
+        selected = scoring.select_diverse(user_scores, candidate_rows, artist_offsets, artist_values, limit)
+        results.append((candidate_rows[selected], user_scores[selected]))
+    return results
+
+def generate_batch_recommendations(db, batch, limit=15, workers=BATCH_WORKERS):
+    """
+    Generate and store recommendations for many users at once.
+
+    The catalog and cluster models are loaded once, users are grouped by
+    weight profile and scored together in chunks spread over worker
+    processes, and all documents are written with a single bulk insert.
+
+    Args:
+        db: Database connection
+        batch (list): Dicts with userId, currentQuestionnaire and preferences
+        limit (int): Number of recommendations per user
+        workers (int): Number of worker processes
+
+    Returns:
+        dict: Summary with the number of users, generated and skipped documents
+    """
+    from joblib import Parallel, delayed
+    
+    start = time.perf_counter()
+    snapshot = catalog.get_store().get_snapshot(db)
+    if snapshot is None:
+        return {'users': len(batch), 'generated': 0, 'skipped': len(batch), 'seconds': 0.0}
+
+    columns = snapshot.columns
+    base = scoring.base_scores(columns)
+
+    # Group users by weight profile so each group shares one set of cluster models
+    groups = {}
+    skipped = 0
+    for entry in batch:
+        questionnaire = entry.get('currentQuestionnaire') or {}
+        mood, vibe, discovery = utils.extract_questionnaire_preferences(questionnaire.get('answers', []))
+        liked_song_ids, disliked_song_ids = utils.extract_song_preferences(entry.get('preferences', []))
+
+        if not questionnaire or len(liked_song_ids) < MIN_LIKED_SONGS:
+            skipped += 1
+            continue
+
+        liked_rows, rated_rows = scoring.resolve_ratings(columns, liked_song_ids, disliked_song_ids)
+        profile = feature_extraction.weight_profile_key(feature_extraction.preference_weights(mood, vibe))
+        group = groups.setdefault(profile, {'mood': mood, 'vibe': vibe, 'entries': [], 'users': []})
+        group['entries'].append(entry)
+        group['users'].append((liked_rows, rated_rows, bool(liked_song_ids), discovery))
+
+    # Every worker scores a chunk of users at once, all of them within the memory budget
+    user_chunk = memory.chunk_rows(len(columns) * SCORE_BYTES_PER_SONG * max(1, workers), BATCH_USER_CHUNK)
+    selections = []
+    with Parallel(n_jobs=workers) as parallel:
+        for group in groups.values():
+            models = cluster_cache.get_cache().get(snapshot, group['mood'], group['vibe'])
+            users = group['users']
+            chunks = [users[i:i + user_chunk] for i in range(0, len(users), user_chunk)]
+
+            results = parallel(
+                delayed(_score_chunk)(
+                    models.weighted_features, models.clusters, columns.valid, base,
+                    columns.artist_offsets, columns.artist_values, chunk, limit
+                )
+                for chunk in chunks
+            )
+            for entry, result in zip(group['entries'], (r for chunk in results for r in chunk)):
+                selections.append((entry, result))
+
+    # Load display fields for every selected song in one query, unless only IDs are stored
+    details = {}
+    if persistence.RECOMMENDATION_STORAGE != 'compact':
+        song_ids = {columns.song_id(row) for _, (rows, _) in selections for row in rows.tolist()}
+        details = catalog.load_song_details(db, song_ids)
+
+    documents = []
+    for entry, (rows, scores) in selections:
+        top_recommendations = [
+            (columns.song_id(row), {
+                'score': score,
+                'song': details.get(columns.song_id(row)) or columns.song(row)
+            })
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+        documents.append(scoring.create_recommendation_document(
+            entry.get('userId', 'unknown'),
+            str(entry['currentQuestionnaire'].get('_id', '')),
+            persistence.compact_recommendations(scoring.format_recommendations(top_recommendations))
+        ))
+
+    # Write the whole batch before reporting it as generated
+    writer = persistence.get_writer()
+    writer.add(db.recommendations, documents, on_persisted=jobs.persisted_callback())
+    writer.flush()
+
+    seconds = time.perf_counter() - start
+    utils.log(f"Batch recommendations: {len(documents)} generated, {skipped} skipped in {seconds:.2f}s")
+    return {
+        'users': len(batch),
+        'generated': len(documents),
+        'skipped': skipped,
+        'seconds': round(seconds, 3),
+        'usersPerSecond': round(len(documents) / seconds, 2) if seconds > 0 else None
+    }
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description='Generate recommendations for many users at once.')
+    parser.add_argument('input', help='JSON array or JSON lines file of process-data payloads')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--limit', type=int, default=15)
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = MongoClient(os.getenv('MONGODB_URI'))["spotify_tracker"]
+
+    with open(args.input) as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        batch = codec.loads(content)
+    else:
+        batch = [codec.loads(line) for line in content.splitlines() if line.strip()]
+    try:
+        validate_batch(batch)
+    except ValueError as e:
+        parser.error(f"{args.input}: {e}")
+
+    summary = generate_batch_recommendations(db, batch, limit=args.limit, workers=args.workers)
+    print(codec.dumps(summary).decode())
+
+if __name__ == '__main__':
+    main()
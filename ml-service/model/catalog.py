@@ -0,0 +1,415 @@
+"""
+Process-level catalog store holding the song feature matrix between requests.
+"""
+import os
+import pickle
+import threading
+import time
+import uuid
+import numpy as np
+from . import feature_extraction
+from . import metrics
+from . import scoring
+from . import utils
+
+MODEL_DIR = os.getenv('MODEL_DIR', '/app/models')
+REFRESH_INTERVAL = float(os.getenv('CATALOG_REFRESH_SECONDS', 30))
+
+# Number of recent versions whose changed rows are remembered
+DELTA_HISTORY = int(os.getenv('CATALOG_DELTA_HISTORY', 16))
+
+CATALOG_PROJECTION = {**feature_extraction.FEATURE_PROJECTION, 'updatedAt': 1}
+
+# Display fields are only loaded for the songs that end up recommended
+DETAILS_PROJECTION = {'_id': 0, 'spotifyId': 1, 'name': 1, 'artists': 1, 'album.images': 1}
+
+class CatalogSnapshot:
+    """
+    Immutable view of the catalog used by a single recommendation request.
+    """
+    __slots__ = ('version', 'epoch', 'features', 'columns', 'song_count', 'deltas')
+
+    def __init__(self, version, features, columns, song_count, deltas=(), epoch=None):
+        self.version = version
+        self.epoch = epoch
+        self.features = features
+        self.columns = columns
+        self.song_count = song_count
+        self.deltas = tuple(deltas)
+
+    def changed_rows_since(self, version):
+        """
+        Rows added or updated after an earlier catalog version.
+
+        Args:
+            version (int): Earlier catalog version
+
+        Returns:
+            np.array: Sorted changed rows, or None if the rows of that version
+                no longer line up with this one (a rebuild happened or the
+                history does not reach back far enough)
+        """
+        if version == self.version:
+            return np.empty(0, dtype=np.intp)
+        if version > self.version or not self.deltas or self.deltas[0][0] > version + 1:
+            return None
+
+        rows = []
+        for delta_version, delta_rows in self.deltas:
+            if delta_version <= version:
+                continue
+            if delta_rows is None:
+                return None
+            rows.append(delta_rows)
+        return np.unique(np.concatenate(rows)).astype(np.intp)
+
+class CatalogStore:
+    """
+    Normalized song feature matrix that is built once, persisted under the
+    model directory and refreshed incrementally from an `_id`/`updatedAt`
+    watermark instead of rescanning the songs collection on every request.
+
+    Song metadata is kept as SongColumns only, rows are matched to changed
+    documents by their unique Spotify ID.
+
+    The import scripts only insert songs and never set `updatedAt`, so the
+    `_id` half of the watermark is what picks up their imports. Songs edited
+    in place are only seen if the editor sets `updatedAt`, otherwise they
+    need a rebuild, e.g. by removing the catalog files from the model
+    directory before a restart.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, refresh_interval=REFRESH_INTERVAL):
+        self.model_dir = model_dir
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.raw_features = None
+        self.columns = None
+        self.document_count = 0
+        self.last_id = None
+        self.last_updated = None
+        self.version = 0
+        # Changes on every rebuild, rows keep their meaning within an epoch
+        self.epoch = None
+        self.last_refresh = 0.0
+        self.snapshot = None
+        self.loaded = False
+        self.meta_mtime = None
+        self.deltas = []
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.model_dir, 'catalog_meta.pkl')
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.model_dir, 'catalog.lock')
+
+    def _raw_path(self, version):
+        return os.path.join(self.model_dir, f'catalog_raw.{version}.npy')
+
+    def _features_path(self, version):
+        return os.path.join(self.model_dir, f'catalog_features.{version}.npy')
+
+    def get_snapshot(self, db, force=False):
+        """
+        Return the current catalog snapshot, refreshing it from MongoDB when due.
+
+        Processes sharing the model directory take turns refreshing: the one
+        holding the catalog lock queries MongoDB and publishes a new version,
+        the others pick that version up from disk.
+
+        Args:
+            db: Database connection
+            force (bool): Refresh even if the refresh interval has not elapsed
+
+        Returns:
+            CatalogSnapshot: Current snapshot, or None if the catalog is empty
+        """
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                self._load()
+
+            if force or time.time() - self.last_refresh >= self.refresh_interval:
+                self.last_refresh = time.time()
+                # Without a snapshot there is nothing to serve, so wait for the lock
+                with utils.file_lock(self.lock_path, blocking=self.snapshot is None) as acquired:
+                    # Catch up with a version published by another process first
+                    self._load()
+                    if acquired:
+                        self._refresh(db)
+
+            return self.snapshot
+
+    def load_persisted(self):
+        """
+        Memory-map the catalog persisted under the model directory, without
+        querying MongoDB.
+
+        Returns:
+            CatalogSnapshot: Persisted snapshot, or None if there is none
+        """
+        with self.lock:
+            self.loaded = True
+            self._load()
+            return self.snapshot
+
+    def _refresh(self, db):
+        """
+        Pull songs added or changed since the watermark and apply them.
+
+        Changes are found by `_id` for inserts and by `updatedAt` for edits,
+        edits that do not set `updatedAt` are missed until a rebuild.
+        """
+        # Deleted songs cannot be seen through the watermark, so rebuild when
+        # the collection shrinks below what we have already indexed
+        if self.raw_features is None or db.songs.estimated_document_count() < self.document_count:
+            self._rebuild(db)
+            return
+
+        query = {'_id': {'$gt': self.last_id}}
+        if self.last_updated is not None:
+            query = {'$or': [query, {'updatedAt': {'$gt': self.last_updated}}]}
+
+        with metrics.timed(metrics.STAGE_SECONDS, stage='mongo_fetch'):
+            changed = list(
+                db.songs.find(query, CATALOG_PROJECTION).batch_size(feature_extraction.BATCH_SIZE)
+            )
+        if not changed:
+            return
+
+        last_id = self.last_id
+        self._advance_watermark(changed)
+        new_songs = []
+        updated_rows = []
+        updated_songs = []
+        raw_features = self.raw_features.copy()
+        rows = self.columns.lookup([song.get('spotifyId') for song in changed])
+
+        for song, row in zip(changed, rows.tolist()):
+            if song['_id'] > last_id:
+                self.document_count += 1
+
+            if row < 0:
+                new_songs.append(song)
+                continue
+
+            vector, _ = feature_extraction.stream_raw_features([song])
+            if vector is None:
+                # The song lost its audio features, row layout has to change
+                self._rebuild(db)
+                return
+            raw_features[row] = vector[0]
+            updated_rows.append(row)
+            updated_songs.append(song)
+
+        with metrics.timed(metrics.STAGE_SECONDS, stage='extract_features'):
+            new_features, new_rows = feature_extraction.stream_raw_features(new_songs)
+        song_count = len(self.columns)
+        changed_rows = np.array(updated_rows, dtype=np.intp)
+        if new_features is not None:
+            changed_rows = np.concatenate([changed_rows, np.arange(song_count, song_count + len(new_rows))])
+            raw_features = np.vstack([raw_features, new_features])
+
+        columns = self.columns.merge(updated_rows, updated_songs + new_rows)
+        self._install(raw_features, columns, changed_rows)
+        utils.log(f"Catalog refreshed: {len(changed)} changed songs, {len(columns)} rows")
+
+    def _rebuild(self, db):
+        """
+        Build the catalog from a full scan of the songs collection.
+        """
+        self.document_count = 0
+        self.last_id = None
+        self.last_updated = None
+        self.epoch = uuid.uuid4().hex
+
+        def tracked(cursor):
+            # Advance the watermark while the cursor streams
+            for song in cursor:
+                self.document_count += 1
+                self._advance_watermark((song,))
+                yield song
+
+        # Fetching, extraction and column building are interleaved while the
+        # cursor streams, so only one batch of documents is held at a time
+        builder = scoring.SongColumnsBuilder()
+        with metrics.timed(metrics.STAGE_SECONDS, stage='catalog_rebuild'):
+            cursor = db.songs.find({}, CATALOG_PROJECTION).batch_size(feature_extraction.BATCH_SIZE)
+            raw_features, _ = feature_extraction.stream_raw_features(
+                tracked(cursor), capacity=db.songs.estimated_document_count(), on_batch=builder.add
+            )
+        if raw_features is None:
+            self.raw_features = None
+            self.columns = None
+            self.snapshot = None
+            return
+
+        with metrics.timed(metrics.STAGE_SECONDS, stage='build_song_columns'):
+            columns = builder.build()
+        self._install(raw_features, columns)
+        utils.log(f"Catalog rebuilt: {len(columns)} rows")
+
+    def _advance_watermark(self, songs):
+        for song in songs:
+            if self.last_id is None or song['_id'] > self.last_id:
+                self.last_id = song['_id']
+            updated = song.get('updatedAt')
+            if updated is not None and (self.last_updated is None or updated > self.last_updated):
+                self.last_updated = updated
+
+    def _install(self, raw_features, columns, changed_rows=None):
+        """
+        Normalize, persist and publish a new catalog version.
+
+        Args:
+            raw_features (np.array): Raw feature rows
+            columns (SongColumns): Song metadata per row
+            changed_rows (np.array): Rows updated or appended since the
+                previous version, or None if the row layout changed
+        """
+        self.raw_features = raw_features
+        self.columns = columns
+        self.version += 1
+        self.deltas = (self.deltas + [(self.version, changed_rows)])[-DELTA_HISTORY:]
+
+        with metrics.timed(metrics.STAGE_SECONDS, stage='normalize_features'):
+            features = feature_extraction.normalize_features(raw_features)
+        features = self._save(features)
+
+        self.snapshot = CatalogSnapshot(
+            self.version, features, columns, self.document_count, self.deltas, self.epoch
+        )
+
+    def _save(self, features):
+        """
+        Persist the catalog and return the feature matrix memory-mapped from disk.
+
+        Arrays are written under version-numbered names and the metadata file
+        is replaced last, so other processes see either the old version or
+        the complete new one. Every process maps the same files, so the
+        feature matrix is held in memory once.
+        """
+        try:
+            os.makedirs(self.model_dir, exist_ok=True)
+            _atomic_save_npy(self._raw_path(self.version), self.raw_features)
+            _atomic_save_npy(self._features_path(self.version), features)
+
+            meta = {
+                'columns': self.columns,
+                'document_count': self.document_count,
+                'last_id': self.last_id,
+                'last_updated': self.last_updated,
+                'version': self.version,
+                'epoch': self.epoch,
+                'deltas': self.deltas
+            }
+            tmp_path = self.meta_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.meta_path)
+            self.meta_mtime = os.stat(self.meta_path).st_mtime_ns
+
+            self._remove_old_versions()
+            self.raw_features = np.load(self._raw_path(self.version), mmap_mode='r')
+            return np.load(self._features_path(self.version), mmap_mode='r')
+        except OSError as e:
+            # Keep serving from memory if the model directory is not writable
+            utils.log(f"Could not persist catalog: {e}")
+            return features
+
+    def _remove_old_versions(self):
+        """
+        Delete array files older than the previous version.
+
+        The previous version is kept for processes that are loading it right
+        now, and files still mapped by a process stay readable after removal.
+        """
+        keep = set()
+        for version in (self.version, self.version - 1):
+            keep.add(os.path.basename(self._raw_path(version)))
+            keep.add(os.path.basename(self._features_path(version)))
+
+        for name in os.listdir(self.model_dir):
+            if name.startswith(('catalog_raw', 'catalog_features')) and name.endswith('.npy') and name not in keep:
+                try:
+                    os.remove(os.path.join(self.model_dir, name))
+                except OSError:
+                    pass
+
+    def _load(self):
+        """
+        Load the catalog persisted by this or another process, if it changed.
+
+        Restarts only apply the delta since the persisted version, and
+        processes sharing the model directory follow each other's refreshes.
+        """
+        try:
+            mtime = os.stat(self.meta_path).st_mtime_ns
+            if mtime == self.meta_mtime:
+                return
+            with open(self.meta_path, 'rb') as f:
+                meta = pickle.load(f)
+            if self.snapshot is not None and meta['version'] <= self.version:
+                self.meta_mtime = mtime
+                return
+            raw_features = np.load(self._raw_path(meta['version']), mmap_mode='r')
+            features = np.load(self._features_path(meta['version']), mmap_mode='r')
+            # Catalogs saved before the columnar format are rebuilt
+            columns = meta['columns']
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+            return
+
+        if features.shape[0] != len(columns) or raw_features.shape != features.shape:
+            return
+
+        self.meta_mtime = mtime
+        self.raw_features = raw_features
+        self.columns = columns
+        self.document_count = meta['document_count']
+        self.last_id = meta['last_id']
+        self.last_updated = meta['last_updated']
+        self.version = meta['version']
+        self.epoch = meta['epoch']
+        self.deltas = meta.get('deltas', [])
+        self.snapshot = CatalogSnapshot(
+            self.version, features, self.columns, self.document_count, self.deltas, self.epoch
+        )
+        utils.log(f"Catalog loaded from disk: {len(self.columns)} rows, version {self.version}")
+
+def load_song_details(db, song_ids):
+    """
+    Load the display fields for a small set of songs.
+
+    Args:
+        db: Database connection
+        song_ids (list): Spotify IDs of the songs to load
+
+    Returns:
+        dict: Mapping from Spotify ID to song document with display fields
+    """
+    # A copy per call, concurrent jobs must not share a projection the driver may modify
+    cursor = db.songs.find({'spotifyId': {'$in': list(song_ids)}}, dict(DETAILS_PROJECTION))
+    return {song['spotifyId']: song for song in cursor}
+
+def _atomic_save_npy(path, array):
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Get the process-wide catalog store.
+
+    Returns:
+        CatalogStore: Shared catalog store
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CatalogStore()
+        return _store
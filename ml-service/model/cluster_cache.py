@@ -0,0 +1,415 @@
+"""
+Cache of fitted clustering models per preference weight profile.
+"""
+import os
+import threading
+import numpy as np
+from . import clustering
+from . import feature_extraction
+from . import metrics
+from . import neighbors
+from . import utils
+
+MODEL_DIR = os.getenv('MODEL_DIR', '/app/models')
+
+# Fit every weight profile in the background once one is requested
+BACKGROUND_WARM = os.getenv('CLUSTER_BACKGROUND_WARM', '1') == '1'
+
+# Drift after incremental updates beyond which a profile is refitted from
+# scratch: the fraction of songs closer to another centroid than their own,
+# and the growth of the per-song inertia since the last full fit
+DRIFT_REASSIGNED = float(os.getenv('CLUSTER_DRIFT_REASSIGNED', 0.05))
+DRIFT_INERTIA_GROWTH = float(os.getenv('CLUSTER_DRIFT_INERTIA_GROWTH', 0.1))
+
+class ClusterModels:
+    """
+    Fitted clustering state for one weight profile and catalog version.
+    """
+    __slots__ = ('profile', 'version', 'weighted_features', 'clusters', 'kmeans_model', 'pca_model',
+                 'fit_inertia', 'index', 'members', 'song_counts')
+
+    def __init__(self, profile, version, weighted_features, clusters, kmeans_model, pca_model,
+                 fit_inertia=None):
+        self.profile = profile
+        self.version = version
+        self.weighted_features = weighted_features
+        self.clusters = clusters
+        self.kmeans_model = kmeans_model
+        self.pca_model = pca_model
+        self.fit_inertia = fit_inertia
+        self.index = None
+        self.members = None
+        self.song_counts = None
+
+    def neighbor_index(self):
+        """
+        Get the nearest-neighbour index over the weighted features, building it on first use.
+
+        Returns:
+            NeighborIndex: Index over weighted_features
+        """
+        if self.index is None:
+            with metrics.timed(metrics.STAGE_SECONDS, stage='build_neighbor_index'):
+                self.index = neighbors.NeighborIndex(self.weighted_features)
+        return self.index
+
+    def cluster_members(self):
+        """
+        Get the rows of each cluster, grouping them on first use.
+
+        Returns:
+            tuple: (rows, offsets) where the rows of cluster c are
+                rows[offsets[c]:offsets[c + 1]]
+        """
+        if self.members is None:
+            clusters = np.asarray(self.clusters)
+            rows = np.argsort(clusters, kind='stable')
+            sizes = np.bincount(clusters, minlength=int(self.kmeans_model.n_clusters))
+            offsets = np.zeros(len(sizes) + 1, dtype=np.intp)
+            np.cumsum(sizes, out=offsets[1:])
+            self.members = (rows, offsets)
+        return self.members
+
+    def cluster_song_counts(self, valid):
+        """
+        Get the number of valid songs in each cluster, counting them on first use.
+
+        Args:
+            valid (np.array): Mask of songs with a Spotify ID, of the same catalog version
+
+        Returns:
+            np.array: Song count indexed by cluster
+        """
+        if self.song_counts is None:
+            clusters = np.asarray(self.clusters)
+            self.song_counts = np.bincount(clusters[valid], minlength=int(self.kmeans_model.n_clusters))
+        return self.song_counts
+
+class ClusterModelCache:
+    """
+    Keeps the PCA and KMeans models, weighted features and per-song cluster
+    labels for every weight profile, keyed by catalog version and persisted
+    to disk so that requests, restarts and other worker processes skip
+    clustering. Arrays are memory-mapped from the saved files, so workers
+    sharing the model directory share one copy.
+
+    When the catalog changes, the previous version's models are updated
+    with the changed songs instead of refitted, and a full refit runs in
+    the background only once the clusters have drifted.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR):
+        self.model_dir = os.path.join(model_dir, 'clusters')
+        self.models = {}
+        self.lock = threading.Lock()
+        self.profile_locks = {}
+        self.warming_version = None
+        self.warm_version = None
+        self.refitting = set()
+
+    def get(self, snapshot, mood, vibe):
+        """
+        Get the clustering models for a preference profile, fitting them on a miss.
+
+        Args:
+            snapshot (CatalogSnapshot): Catalog the models are built on
+            mood (str): User's mood preference
+            vibe (str): User's vibe preference
+
+        Returns:
+            ClusterModels: Fitted models for the profile
+        """
+        weights = feature_extraction.preference_weights(mood, vibe)
+        profile = feature_extraction.weight_profile_key(weights)
+
+        drifted = False
+        with self._profile_lock(profile):
+            models = self.models.get(profile)
+            if models is not None and models.version == snapshot.version:
+                return models
+
+            models = self._load(profile, snapshot)
+            if models is None:
+                # Another process sharing the model directory may be fitting
+                # this profile already, wait for it and reuse its models
+                with utils.file_lock(self._path(profile) + '.lock'):
+                    models = self._load(profile, snapshot)
+                    if models is None:
+                        models, drifted = self._update(profile, snapshot, mood, vibe)
+                    if models is None:
+                        models = self._fit(profile, snapshot, mood, vibe)
+
+            self.models[profile] = models
+
+        if drifted:
+            self._refit_async(snapshot, profile, mood, vibe)
+
+        # Fit the remaining profiles for this catalog version in the background
+        self.warm_async(snapshot)
+        return models
+
+    def peek(self, snapshot, mood, vibe):
+        """
+        Get the clustering models for a preference profile without fitting
+        in the caller's thread.
+
+        Models of an earlier catalog version are updated with the changed
+        songs in place, which is cheap. Anything that would need a full fit
+        starts warming every profile in the background instead.
+
+        Args:
+            snapshot (CatalogSnapshot): Catalog the models are built on
+            mood (str): User's mood preference
+            vibe (str): User's vibe preference
+
+        Returns:
+            ClusterModels: Fitted models for the profile, or None
+        """
+        profile = feature_extraction.weight_profile_key(feature_extraction.preference_weights(mood, vibe))
+        models = self.models.get(profile)
+        if models is not None and models.version == snapshot.version:
+            return models
+
+        if models is not None and models.version < snapshot.version:
+            models = self._update_now(profile, snapshot, mood, vibe)
+
+        self.warm_async(snapshot)
+        return models
+
+    def _update_now(self, profile, snapshot, mood, vibe):
+        """
+        Bring a profile's models to a catalog version by an incremental
+        update only, giving up rather than waiting on a fit in progress.
+
+        Returns:
+            ClusterModels: Models for the catalog version, or None
+        """
+        lock = self._profile_lock(profile)
+        if not lock.acquire(blocking=False):
+            return None
+
+        drifted = False
+        try:
+            models = self.models.get(profile)
+            if models is not None and models.version == snapshot.version:
+                return models
+
+            models = self._load(profile, snapshot)
+            if models is None:
+                with utils.file_lock(self._path(profile) + '.lock', blocking=False) as acquired:
+                    if not acquired:
+                        return None
+                    models = self._load(profile, snapshot)
+                    if models is None:
+                        models, drifted = self._update(profile, snapshot, mood, vibe)
+            if models is not None:
+                self.models[profile] = models
+        finally:
+            lock.release()
+
+        if drifted:
+            self._refit_async(snapshot, profile, mood, vibe)
+        return models
+
+    def warm(self, snapshot):
+        """
+        Fit or load models for every weight profile of a catalog version.
+
+        Args:
+            snapshot (CatalogSnapshot): Catalog the models are built on
+        """
+        with self.lock:
+            self.warming_version = snapshot.version
+
+        for profile, (mood, vibe) in feature_extraction.weight_profiles().items():
+            models = self.models.get(profile)
+            if models is None or models.version != snapshot.version:
+                self.get(snapshot, mood, vibe)
+        self.warm_version = snapshot.version
+        utils.log(f"Cluster models warm for catalog version {snapshot.version}")
+
+    def load_persisted(self, snapshot):
+        """
+        Memory-map the saved models of every weight profile fitted for a
+        catalog version, without fitting the missing ones.
+
+        Args:
+            snapshot (CatalogSnapshot): Catalog the models were built on
+
+        Returns:
+            int: Number of profiles loaded
+        """
+        loaded = 0
+        for profile in feature_extraction.weight_profiles():
+            with self._profile_lock(profile):
+                models = self._load(profile, snapshot)
+                if models is not None:
+                    self.models[profile] = models
+                    loaded += 1
+        return loaded
+
+    def warm_async(self, snapshot):
+        """
+        Start warming all profiles in a background thread, once per catalog version.
+
+        Args:
+            snapshot (CatalogSnapshot): Catalog the models are built on
+        """
+        with self.lock:
+            if not BACKGROUND_WARM or self.warming_version == snapshot.version:
+                return
+            self.warming_version = snapshot.version
+        threading.Thread(target=self.warm, args=(snapshot,), daemon=True).start()
+
+    def _profile_lock(self, profile):
+        with self.lock:
+            return self.profile_locks.setdefault(profile, threading.Lock())
+
+    def _path(self, profile):
+        return os.path.join(self.model_dir, f'{profile}.joblib')
+
+    def _fit(self, profile, snapshot, mood, vibe, mode='full'):
+        return self._persist(self._fit_models(profile, snapshot, mood, vibe, mode), snapshot)
+
+    def _fit_models(self, profile, snapshot, mood, vibe, mode):
+        with metrics.timed(metrics.STAGE_SECONDS, stage='apply_preference_weights'):
+            weighted_features = feature_extraction.apply_preference_weights(snapshot.features, mood, vibe)
+        with metrics.timed(metrics.STAGE_SECONDS, stage='cluster_songs'):
+            clusters, kmeans_model, pca_model = clustering.fit_cluster_models(
+                weighted_features, snapshot.song_count
+            )
+        metrics.CLUSTER_UPDATES_TOTAL.inc(mode=mode)
+        return ClusterModels(
+            profile, snapshot.version, weighted_features, clusters, kmeans_model, pca_model,
+            fit_inertia=kmeans_model.inertia_ / max(1, len(clusters))
+        )
+
+    def _update(self, profile, snapshot, mood, vibe):
+        """
+        Derive models for a new catalog version from the previous version's.
+
+        Returns:
+            tuple: (models, drifted) where models is None if a full fit is
+                needed and drifted tells whether the clusters need a refit
+        """
+        previous = self.models.get(profile) or self._read(profile)
+        if previous is None or previous.version > snapshot.version:
+            return None, False
+        changed_rows = snapshot.changed_rows_since(previous.version)
+        if changed_rows is None or len(previous.clusters) > snapshot.features.shape[0]:
+            return None, False
+
+        with metrics.timed(metrics.STAGE_SECONDS, stage='apply_preference_weights'):
+            weighted_features = feature_extraction.apply_preference_weights(snapshot.features, mood, vibe)
+        with metrics.timed(metrics.STAGE_SECONDS, stage='update_clusters'):
+            clusters, kmeans_model, drift = clustering.update_cluster_models(
+                previous.kmeans_model, weighted_features, previous.clusters, changed_rows
+            )
+
+        fit_inertia = previous.fit_inertia or drift['inertia']
+        inertia_growth = drift['inertia'] / fit_inertia - 1 if fit_inertia > 0 else 0.0
+        models = ClusterModels(
+            profile, snapshot.version, weighted_features, clusters, kmeans_model, previous.pca_model,
+            fit_inertia=fit_inertia
+        )
+        metrics.CLUSTER_UPDATES_TOTAL.inc(mode='incremental')
+        metrics.CLUSTER_REASSIGNED_RATIO.observe(drift['reassigned'])
+        utils.log_event(
+            'cluster_update', profile=profile, version=snapshot.version, changedSongs=len(changed_rows),
+            reassigned=round(drift['reassigned'], 4), inertiaGrowth=round(inertia_growth, 4)
+        )
+
+        drifted = drift['reassigned'] > DRIFT_REASSIGNED or inertia_growth > DRIFT_INERTIA_GROWTH
+        return self._persist(models, snapshot), drifted
+
+    def _refit_async(self, snapshot, profile, mood, vibe):
+        """
+        Refit a drifted profile from scratch without blocking requests, which
+        keep using the incrementally updated models until the refit is done.
+        """
+        with self.lock:
+            if (profile, snapshot.version) in self.refitting:
+                return
+            self.refitting.add((profile, snapshot.version))
+
+        def refit():
+            try:
+                models = self._fit_models(profile, snapshot, mood, vibe, 'refit')
+                with self._profile_lock(profile):
+                    # Drop the refit if the catalog moved on while it ran
+                    current = self.models.get(profile)
+                    if current is not None and current.version != snapshot.version:
+                        return
+                    self.models[profile] = self._persist(models, snapshot)
+                utils.log(f"Cluster models for profile {profile} refitted after drift")
+            finally:
+                with self.lock:
+                    self.refitting.discard((profile, snapshot.version))
+
+        if BACKGROUND_WARM:
+            threading.Thread(target=refit, daemon=True).start()
+        else:
+            refit()
+
+    def _persist(self, models, snapshot):
+        # Serve the saved copy so every process maps the same arrays
+        if self._save(models):
+            return self._load(models.profile, snapshot) or models
+        return models
+
+    def _read(self, profile):
+        import joblib
+        try:
+            saved = joblib.load(self._path(profile), mmap_mode='r')
+        except (OSError, EOFError, ValueError):
+            return None
+        if 'weighted_features' not in saved:
+            return None
+
+        return ClusterModels(
+            profile, saved['version'], saved['weighted_features'], saved['clusters'],
+            saved['kmeans_model'], saved['pca_model'], fit_inertia=saved.get('fit_inertia')
+        )
+
+    def _load(self, profile, snapshot):
+        models = self._read(profile)
+
+        # Models from another catalog version would mislabel the songs
+        if models is None or models.version != snapshot.version or len(models.clusters) != snapshot.features.shape[0]:
+            return None
+        return models
+
+    def _save(self, models):
+        import joblib
+        try:
+            os.makedirs(self.model_dir, exist_ok=True)
+            path = self._path(models.profile)
+            joblib.dump({
+                'version': models.version,
+                'weighted_features': models.weighted_features,
+                'clusters': models.clusters,
+                'kmeans_model': models.kmeans_model,
+                'pca_model': models.pca_model,
+                'fit_inertia': models.fit_inertia
+            }, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            return True
+        except OSError as e:
+            utils.log(f"Could not persist cluster models: {e}")
+            return False
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Get the process-wide cluster model cache.
+
+    Returns:
+        ClusterModelCache: Shared cluster model cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ClusterModelCache()
+        return _cache
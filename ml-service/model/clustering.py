@@ -1,12 +1,29 @@
 """
 Song clustering using KMeans algorithm.
 """
-from sklearn.cluster import KMeans
+import copy
+import os
+import time
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
+from . import memory
+from . import metrics
 from . import utils
 
+# Catalogs above this size are clustered with MiniBatchKMeans on a sampled model selection
+LARGE_CATALOG_THRESHOLD = int(os.getenv('CLUSTERING_LARGE_THRESHOLD', 50000))
+SILHOUETTE_SAMPLE_SIZE = int(os.getenv('CLUSTERING_SILHOUETTE_SAMPLE', 10000))
+MINIBATCH_SIZE = int(os.getenv('CLUSTERING_BATCH_SIZE', 4096))
+
+# Rows compared against the centroids at once when assigning songs
+ASSIGN_CHUNK_SIZE = 65536
+
+# Cluster count candidates are evaluated in this many processes once the
+# catalog is large enough to outweigh the process pool overhead. Large
+# catalogs select on a sample, which still costs a quadratic silhouette per
+# candidate, so the catalog size decides rather than the rows evaluated.
+CLUSTERING_WORKERS = int(os.getenv('CLUSTERING_WORKERS', os.cpu_count() or 1))
+PARALLEL_SWEEP_MIN_SONGS = int(os.getenv('CLUSTERING_PARALLEL_MIN_SONGS', 20000))
+
 def cluster_songs(features_array, song_count):
     """
     Cluster songs based on their audio features using KMeans with adaptive cluster count.
@@ -20,6 +37,51 @@ def cluster_songs(features_array, song_count):
             - clusters is a numpy array of cluster assignments
             - kmeans_model is the fitted KMeans model
     """
+    clusters, kmeans, _ = fit_cluster_models(features_array, song_count)
+    return clusters, kmeans
+
+def sweep_workers(row_count, workers=None):
+    """
+    Number of processes the cluster count candidates are evaluated in.
+    
+    Args:
+        row_count (int): Rows of the catalog being clustered
+        workers (int): Processes available, CLUSTERING_WORKERS by default
+        
+    Returns:
+        int: Processes used, 1 for the serial sweep
+    """
+    if workers is None:
+        workers = CLUSTERING_WORKERS
+    if row_count < PARALLEL_SWEEP_MIN_SONGS:
+        return 1
+    return max(1, workers)
+
+def fit_cluster_models(features_array, song_count, large_catalog=None, workers=None):
+    """
+    Fit the PCA and KMeans models used to cluster songs.
+    
+    Large catalogs pick the cluster count from silhouette scores on a bounded
+    random sample and fit MiniBatchKMeans, since the exact silhouette is
+    quadratic in the number of songs.
+    
+    Args:
+        features_array (np.array): Normalized and weighted feature array
+        song_count (int): Total number of songs
+        large_catalog (bool): Force the large catalog mode on or off, by
+            default it is used above LARGE_CATALOG_THRESHOLD songs
+        workers (int): Processes evaluating cluster count candidates,
+            CLUSTERING_WORKERS by default
+        
+    Returns:
+        tuple: (clusters, kmeans_model, pca_model) where:
+            - clusters is a numpy array of cluster assignments
+            - kmeans_model is the fitted KMeans model
+            - pca_model is the PCA used for model selection, or None
+    """
+    # scikit-learn is imported on first fit to keep service startup fast
+    from sklearn.decomposition import PCA
+    
     # Determine optimal cluster count based on dataset size
     # Using min_clusters to avoid warnings about too many clusters
     min_clusters = 3
@@ -29,13 +91,26 @@ def cluster_songs(features_array, song_count):
     if features_array.shape[0] < max_clusters:
         max_clusters = max(min_clusters, features_array.shape[0] // 5)
     
+    if large_catalog is None:
+        large_catalog = features_array.shape[0] > LARGE_CATALOG_THRESHOLD
+    
+    # Large catalogs select the cluster count on a bounded random sample,
+    # drawn before the PCA so no reduced copy of the whole catalog is made
+    selection_features = features_array
+    if large_catalog and features_array.shape[0] > SILHOUETTE_SAMPLE_SIZE:
+        sample = np.random.RandomState(42).choice(
+            features_array.shape[0], SILHOUETTE_SAMPLE_SIZE, replace=False
+        )
+        selection_features = features_array[sample]
+    
     # Apply dimensionality reduction if needed
     # This helps with high-dimensional feature spaces
-    if features_array.shape[1] > 3 and features_array.shape[0] > 10:
-        pca = PCA(n_components=min(features_array.shape[0]-1, features_array.shape[1], 10))
-        reduced_features = pca.fit_transform(features_array)
+    if selection_features.shape[1] > 3 and selection_features.shape[0] > 10:
+        pca = PCA(n_components=min(selection_features.shape[0]-1, selection_features.shape[1], 10))
+        reduced_features = pca.fit_transform(selection_features)
     else:
-        reduced_features = features_array
+        pca = None
+        reduced_features = selection_features
     
     # Find optimal number of clusters using silhouette score
     best_score = -1
@@ -43,44 +118,184 @@ def cluster_songs(features_array, song_count):
     
     # Only try to find optimal clusters if we have enough data points
     if reduced_features.shape[0] >= 20:
-        for n_clusters in range(min_clusters, max_clusters + 1):
-            # Skip if we have too few samples for the number of clusters
-            if reduced_features.shape[0] <= n_clusters + 1:
-                continue
-                
-            kmeans = KMeans(
-                n_clusters=n_clusters, 
-                random_state=42, 
-                n_init=10,  # Explicit to avoid warnings
-                init='k-means++'
-            )
-            cluster_labels = kmeans.fit_predict(reduced_features)
-            
-            # Skip silhouette calculation if only one cluster or if all points in one cluster
-            if n_clusters <= 1 or len(np.unique(cluster_labels)) <= 1:
-                continue
-                
+        # Skip counts with too few samples per cluster
+        candidates = [n for n in range(min_clusters, max_clusters + 1) if reduced_features.shape[0] > n + 1]
+        
+        # Results come back in candidate order and ties keep the smaller
+        # count, so the choice does not depend on the worker count
+        workers = sweep_workers(features_array.shape[0], workers)
+        for n_clusters, score, seconds in _evaluate_candidates(reduced_features, candidates, large_catalog, workers):
+            metrics.CLUSTER_CANDIDATE_SECONDS.observe(seconds, n_clusters=n_clusters)
+            if score is not None and score > best_score:
+                best_score = score
+                best_n_clusters = n_clusters
+    
+    # Use the optimal number of clusters
+    kmeans = _make_kmeans(best_n_clusters, large_catalog)
+    
+    # Run on original feature space for final clustering
+    clusters = kmeans.fit_predict(features_array)
+    
+    return clusters, kmeans, pca
+
+def _evaluate_candidates(reduced_features, candidates, large_catalog, workers):
+    """
+    Fit and score every cluster count candidate, in parallel with more than one worker.
+    
+    Each worker process gets an equal share of the cores for BLAS and
+    OpenMP, so the pool does not oversubscribe the machine.
+    
+    Returns:
+        list: (n_clusters, silhouette score or None, seconds) per candidate
+    """
+    workers = max(1, min(workers, len(candidates)))
+    
+    if workers == 1:
+        return [_evaluate_candidate(reduced_features, n, large_catalog) for n in candidates]
+    
+    from joblib import Parallel, delayed
+    
+    blas_threads = max(1, (os.cpu_count() or 1) // workers)
+    return Parallel(n_jobs=workers)(
+        delayed(_evaluate_candidate)(reduced_features, n, large_catalog, blas_threads)
+        for n in candidates
+    )
+
+def _evaluate_candidate(reduced_features, n_clusters, large_catalog, blas_threads=None):
+    """
+    Fit one cluster count candidate and compute its silhouette score.
+    
+    Returns:
+        tuple: (n_clusters, score, seconds), score is None if it cannot be computed
+    """
+    from sklearn import config_context
+    from sklearn.metrics import silhouette_score
+    from threadpoolctl import threadpool_limits
+    
+    start = time.perf_counter()
+    # The silhouette's pairwise distances are computed in chunks of the memory budget
+    with threadpool_limits(limits=blas_threads), config_context(working_memory=memory.working_memory_mb()):
+        kmeans = _make_kmeans(n_clusters, large_catalog)
+        cluster_labels = kmeans.fit_predict(reduced_features)
+        
+        # Skip silhouette calculation if only one cluster or if all points in one cluster
+        score = None
+        if n_clusters > 1 and len(np.unique(cluster_labels)) > 1:
             try:
                 score = silhouette_score(reduced_features, cluster_labels)
-                if score > best_score:
-                    best_score = score
-                    best_n_clusters = n_clusters
-            except Exception as e:
+            except Exception:
                 # Silhouette score can fail in some cases
-                continue
+                pass
     
-    # Use the optimal number of clusters
-    kmeans = KMeans(
-        n_clusters=best_n_clusters, 
+    return n_clusters, score, time.perf_counter() - start
+
+def _make_kmeans(n_clusters, large_catalog):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    
+    if large_catalog:
+        return MiniBatchKMeans(
+            n_clusters=n_clusters,
+            random_state=42,
+            n_init=3,
+            batch_size=MINIBATCH_SIZE,
+            init='k-means++'
+        )
+    return KMeans(
+        n_clusters=n_clusters, 
         random_state=42, 
         n_init=10,  # Explicit to avoid warnings
         init='k-means++'
     )
+
+def update_cluster_models(kmeans_model, features_array, clusters, changed_rows):
+    """
+    Fold new or changed songs into fitted clusters without refitting.
     
-    # Run on original feature space for final clustering
-    clusters = kmeans.fit_predict(features_array)
+    Changed songs are assigned to their nearest centroid, then every centroid
+    moves to the mean of its members, a single partial-fit style step. The
+    other songs keep their labels, so recommendations stay stable.
     
-    return clusters, kmeans
+    Args:
+        kmeans_model (KMeans): Fitted model, left unchanged
+        features_array (np.array): Normalized and weighted feature array
+        clusters (np.array): Labels of the rows the model was fitted on
+        changed_rows (np.array): Rows added or updated since then
+        
+    Returns:
+        tuple: (clusters, kmeans_model, drift) where:
+            - clusters are the labels of every row
+            - kmeans_model is a copy with the moved centroids
+            - drift has 'reassigned', the fraction of unchanged songs now
+              closer to another centroid, and 'inertia' per song
+    """
+    centers = np.asarray(kmeans_model.cluster_centers_, dtype=np.float64)
+    n_clusters = len(centers)
+    
+    labels = np.empty(len(features_array), dtype=np.int32)
+    labels[:len(clusters)] = clusters
+    if len(changed_rows):
+        labels[changed_rows], _ = _nearest_centers(features_array[changed_rows], centers)
+    
+    # Move each centroid to the mean of its members, empty clusters stay put
+    counts = np.bincount(labels, minlength=n_clusters)
+    sums = np.zeros_like(centers)
+    for start, stop in _chunks(len(labels), centers.shape[1] * 8):
+        for dim in range(centers.shape[1]):
+            sums[:, dim] += np.bincount(
+                labels[start:stop], weights=features_array[start:stop, dim], minlength=n_clusters
+            )
+    occupied = counts > 0
+    centers = centers.copy()
+    centers[occupied] = sums[occupied] / counts[occupied, None]
+    
+    nearest, _ = _nearest_centers(features_array, centers)
+    unchanged = np.ones(len(labels), dtype=bool)
+    unchanged[changed_rows] = False
+    moved = (nearest != labels) & unchanged
+    
+    model = copy.deepcopy(kmeans_model)
+    model.cluster_centers_ = centers.astype(kmeans_model.cluster_centers_.dtype)
+    model.inertia_ = _inertia(features_array, centers, labels)
+    model.labels_ = labels
+    
+    drift = {
+        'reassigned': float(moved.sum() / max(1, unchanged.sum())),
+        'inertia': model.inertia_ / max(1, len(labels))
+    }
+    return labels, model, drift
+
+def _nearest_centers(features_array, centers):
+    """
+    Nearest centroid and squared distance to it for each row.
+    """
+    labels = np.empty(len(features_array), dtype=np.int32)
+    distances = np.empty(len(features_array))
+    for start, stop in _chunks(len(features_array), 2 * centers.size * 8):
+        chunk = np.asarray(features_array[start:stop], dtype=np.float64)
+        diff = chunk[:, None, :] - centers[None, :, :]
+        chunk_distances = np.einsum('ijk,ijk->ij', diff, diff)
+        chunk_labels = chunk_distances.argmin(axis=1)
+        labels[start:stop] = chunk_labels
+        distances[start:stop] = chunk_distances[np.arange(len(chunk)), chunk_labels]
+    return labels, distances
+
+def _inertia(features_array, centers, labels):
+    """
+    Sum of squared distances from each row to its centroid.
+    """
+    total = 0.0
+    for start, stop in _chunks(len(features_array), 3 * centers.shape[1] * 8):
+        diff = np.asarray(features_array[start:stop], dtype=np.float64) - centers[labels[start:stop]]
+        total += float(np.einsum('ij,ij->', diff, diff))
+    return total
+
+def _chunks(row_count, row_bytes):
+    """
+    Split rows into chunks whose scratch arrays fit the memory budget.
+    """
+    size = memory.chunk_rows(row_bytes, ASSIGN_CHUNK_SIZE)
+    for start in range(0, row_count, size):
+        yield start, min(start + size, row_count)
 
 def get_cluster_members(clusters, cluster_id):
     """
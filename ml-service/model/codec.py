@@ -0,0 +1,68 @@
+"""
+Request decoding and JSON encoding shared by the HTTP API, logs and saved files.
+"""
+import msgpack
+import orjson
+from werkzeug.exceptions import BadRequest
+
+# Content types of msgpack request bodies
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def dumps(value):
+    """
+    Encode a value as JSON.
+
+    Numpy arrays and scalars are encoded natively, other unknown types
+    such as ObjectId as their string.
+
+    Args:
+        value: Value to encode
+
+    Returns:
+        bytes: UTF-8 encoded JSON
+    """
+    return orjson.dumps(value, default=str, option=JSON_OPTIONS)
+
+def loads(data):
+    """
+    Decode JSON.
+
+    Args:
+        data (bytes): JSON document
+
+    Returns:
+        Decoded value
+    """
+    return orjson.loads(data)
+
+def decode_request(request):
+    """
+    Decode the body of a request sent as JSON or msgpack.
+
+    Args:
+        request: Flask request
+
+    Returns:
+        dict: Decoded body, empty if there is none
+
+    Raises:
+        BadRequest: If the body cannot be decoded
+    """
+    data = request.get_data(cache=False)
+    if not data:
+        return {}
+
+    try:
+        if request.mimetype in MSGPACK_TYPES:
+            # Timestamps arrive as datetime, like the dates pymongo returns
+            body = msgpack.unpackb(data, raw=False, timestamp=3)
+        else:
+            body = loads(data)
+    except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+        raise BadRequest(f"Could not decode request body: {e}")
+
+    if not isinstance(body, dict):
+        raise BadRequest("Request body must be an object")
+    return body
@@ -1,83 +1,183 @@
 """
 Feature extraction and processing for song data.
 """
+import os
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler
 
-def extract_features(songs):
+# Feature columns, in matrix order
+FEATURE_NAMES = ['danceability', 'energy', 'valence', 'acousticness',
+                 'instrumentalness', 'tempo', 'popularity']
+
+# Divisors bringing tempo and popularity to roughly the 0-1 range
+FEATURE_DIVISORS = np.array([1, 1, 1, 1, 1, 200.0, 100.0], dtype=np.float32)
+
+# Only the fields needed for features, scoring and ranking are read from MongoDB
+FEATURE_PROJECTION = {
+    'spotifyId': 1,
+    'popularity': 1,
+    'album.releaseDate': 1,
+    'artists.id': 1,
+    **{f'audioFeatures.{name}': 1 for name in FEATURE_NAMES[:6]}
+}
+
+# Answers with dedicated weights; anything else falls back to neutral weights
+PROFILE_MOODS = ['energetic', 'chill', 'balanced', None]
+PROFILE_VIBES = ['happy', 'sad', 'balanced', None]
+
+BATCH_SIZE = int(os.getenv('FEATURE_BATCH_SIZE', 10000))
+
+def _feature_row(song, audio_feat):
+    # Missing audio features fall back to neutral defaults
+    return (
+        audio_feat.get('danceability', 0.5),
+        audio_feat.get('energy', 0.5),
+        audio_feat.get('valence', 0.5),  # Positivity/happiness
+        audio_feat.get('acousticness', 0.5),
+        audio_feat.get('instrumentalness', 0.5),
+        audio_feat.get('tempo', 120),
+        song.get('popularity', 50)  # Include song popularity as a feature
+    )
+
+def _rows_to_array(rows):
+    try:
+        return np.array(rows, dtype=np.float32)
+    except (TypeError, ValueError):
+        # Null or non-numeric values become NaN and are filled during normalization
+        return np.array([[_to_float(v) for v in row] for row in rows], dtype=np.float32)
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def stream_raw_features(songs, capacity=0, batch_size=BATCH_SIZE, on_batch=None):
     """
-    Extract relevant audio features from song data and prepare for processing.
+    Extract un-normalized feature vectors from a stream of song documents.
+    
+    Documents are consumed in batches and written straight into a preallocated
+    float32 array, so only one batch of Python objects is alive at a time.
+    Documents are read, never modified, so callers may pass songs they reuse.
     
     Args:
-        songs (list): List of song documents from MongoDB
+        songs (iterable): Song documents or a MongoDB cursor, ideally
+            projected with FEATURE_PROJECTION
+        capacity (int): Expected number of songs, used to size the array
+        batch_size (int): Number of documents converted per batch
+        on_batch (callable): Receives each batch of documents with audio
+            features instead of them being collected into rows (optional)
         
     Returns:
-        tuple: (features_array, song_map) where:
-            - features_array is a normalized numpy array of audio features
-            - song_map is a dictionary mapping feature indices to song documents
+        tuple: (raw_features, rows) where:
+            - raw_features is a float32 array of audio features (may contain NaN)
+            - rows is a list of song documents in feature row order, empty
+              with on_batch
     """
-    features = []
-    song_map = {}
-    feature_names = ['danceability', 'energy', 'valence', 'acousticness', 
-                     'instrumentalness', 'tempo', 'popularity']
+    raw_features = np.empty((max(capacity, 1), len(FEATURE_NAMES)), dtype=np.float32)
+    rows = []
+    batch = []
+    batch_songs = []
+    count = 0
+    
+    def flush():
+        nonlocal raw_features, count, batch_songs
+        block = _rows_to_array(batch)
+        if count + len(block) > raw_features.shape[0]:
+            grown = np.empty((max(2 * raw_features.shape[0], count + len(block)), raw_features.shape[1]),
+                             dtype=np.float32)
+            grown[:count] = raw_features[:count]
+            raw_features = grown
+        raw_features[count:count + len(block)] = block
+        count += len(block)
+        batch.clear()
+        if on_batch is not None:
+            on_batch(batch_songs)
+        else:
+            rows.extend(batch_songs)
+        batch_songs = []
     
     for song in songs:
-        song_id = song.get('spotifyId')
-        audio_feat = song.get('audioFeatures', {})
+        audio_feat = song.get('audioFeatures')
         
-        # Extract relevant features for clustering
+        # Only songs with audio features take part in clustering
         if audio_feat:
-            # Store mapping from features index to song
-            song_map[len(features)] = song
-            
-            # Extract features with better defaults
-            popularity = song.get('popularity', 50) / 100.0  # Normalize to 0-1 range
-            
-            # Handle missing audio features more gracefully
-            feat_vector = [
-                audio_feat.get('danceability', 0.5),
-                audio_feat.get('energy', 0.5),
-                audio_feat.get('valence', 0.5),  # Positivity/happiness
-                audio_feat.get('acousticness', 0.5),
-                audio_feat.get('instrumentalness', 0.5),
-                audio_feat.get('tempo', 120) / 200.0,  # Normalize tempo
-                popularity  # Include song popularity as a feature
-            ]
-            features.append(feat_vector)
-    
-    # Convert to numpy array for processing
-    if not features:
-        return None, {}
-    
-    features_array = np.array(features)
-    
-    # Check for NaN values and replace with column means
-    col_means = np.nanmean(features_array, axis=0)
-    for i in range(features_array.shape[1]):
-        mask = np.isnan(features_array[:, i])
-        features_array[mask, i] = col_means[i]
-    
-    # Normalize features
-    features_array = MinMaxScaler().fit_transform(features_array)
-    
-    return features_array, song_map
+            batch.append(_feature_row(song, audio_feat))
+            batch_songs.append(song)
+            if len(batch) >= batch_size:
+                flush()
+    
+    if batch:
+        flush()
+    
+    if count == 0:
+        return None, []
+    
+    raw_features = raw_features[:count] if count == raw_features.shape[0] else raw_features[:count].copy()
+    raw_features /= FEATURE_DIVISORS
+    return raw_features, rows
 
-def apply_preference_weights(features_array, mood, vibe):
+def normalize_features(raw_features):
     """
-    Apply weights to features based on user's mood and vibe preferences.
+    Fill missing values with column means and min-max scale to the 0-1 range.
+    
+    Args:
+        raw_features (np.array): Raw feature array from stream_raw_features
+        
+    Returns:
+        np.array: Normalized float32 feature array
+    """
+    features_array = np.array(raw_features, dtype=np.float32)
+    
+    nan_mask = np.isnan(features_array)
+    if nan_mask.any():
+        col_means = np.nanmean(features_array, axis=0)
+        features_array[nan_mask] = np.take(col_means, np.nonzero(nan_mask)[1])
+    
+    col_min = features_array.min(axis=0)
+    col_range = features_array.max(axis=0) - col_min
+    # Constant columns are left at zero, matching MinMaxScaler
+    col_range[col_range == 0] = 1.0
+    
+    features_array -= col_min
+    features_array /= col_range
+    return features_array
+
+def extract_features(songs):
+    """
+    Extract relevant audio features from song data and prepare for processing.
+    
+    Args:
+        songs (iterable): Song documents or a MongoDB cursor
+        
+    Returns:
+        tuple: (features_array, columns) where:
+            - features_array is a normalized numpy array of audio features
+            - columns is the SongColumns metadata in feature row order
+    """
+    from .scoring import SongColumnsBuilder
+    
+    # Columns are built batch by batch, the documents are not kept
+    builder = SongColumnsBuilder()
+    raw_features, _ = stream_raw_features(songs, on_batch=builder.add)
+    
+    if raw_features is None:
+        return None, None
+    
+    return normalize_features(raw_features), builder.build()
+
+def preference_weights(mood, vibe):
+    """
+    Get the per-feature weights for a user's mood and vibe preferences.
     
     Args:
-        features_array (np.array): Normalized feature array
         mood (str): User's mood preference
         vibe (str): User's vibe preference
         
     Returns:
-        np.array: Weighted feature array
+        np.array: Weight for each feature column
     """
-    weighted_array = features_array.copy()
-    
     # Default weights (no strong preference)
-    weights = np.ones(features_array.shape[1])
+    weights = np.ones(len(FEATURE_NAMES))
     
     # Feature indices for reference:
     # 0: danceability, 1: energy, 2: valence, 3: acousticness, 
@@ -111,8 +211,53 @@ def apply_preference_weights(features_array, mood, vibe):
         # Slightly prefer more positive music
         weights[2] = 1.3  # valence
     
-    # Apply the weights to each column
-    for i in range(features_array.shape[1]):
-        weighted_array[:, i] *= weights[i]
+    return weights
+
+def weight_profile_key(weights):
+    """
+    Build a stable key identifying a weight profile.
     
-    return weighted_array 
\ No newline at end of file
+    Args:
+        weights (np.array): Feature weights from preference_weights
+        
+    Returns:
+        str: Key shared by all mood/vibe pairs producing the same weights
+    """
+    return '_'.join(f'{w:g}' for w in weights)
+
+def weight_profiles():
+    """
+    Get every distinct weight profile the questionnaire answers can produce.
+    
+    Returns:
+        dict: Mapping from profile key to (mood, vibe) pair producing it
+    """
+    profiles = {}
+    for mood in PROFILE_MOODS:
+        for vibe in PROFILE_VIBES:
+            key = weight_profile_key(preference_weights(mood, vibe))
+            profiles.setdefault(key, (mood, vibe))
+    return profiles
+
+def apply_preference_weights(features_array, mood, vibe, out=None):
+    """
+    Apply weights to features based on user's mood and vibe preferences.
+    
+    The matrix is scaled in one pass in float32, without an intermediate
+    copy, so the result can also be written over a buffer that is no
+    longer needed.
+    
+    Args:
+        features_array (np.array): Normalized feature array
+        mood (str): User's mood preference
+        vibe (str): User's vibe preference
+        out (np.array): Array receiving the weighted features, which may
+            be features_array itself (optional)
+        
+    Returns:
+        np.array: Weighted feature array
+    """
+    weights = preference_weights(mood, vibe).astype(np.float32)
+    if out is None:
+        out = np.empty(features_array.shape, dtype=np.float32)
+    return np.multiply(features_array, weights, out=out)
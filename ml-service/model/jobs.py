@@ -0,0 +1,430 @@
+"""
+Bounded job queue and worker pool for recommendation jobs.
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from threadpoolctl import threadpool_limits
+from . import metrics
+from . import utils
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_DEPTH = int(os.getenv('JOB_QUEUE_DEPTH', 32))
+JOB_BLAS_THREADS = int(os.getenv('JOB_BLAS_THREADS', 1))
+JOB_HISTORY = int(os.getenv('JOB_HISTORY', 1000))
+
+# Seconds job states are kept in the shared jobs collection
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 86400))
+
+# Jobs queued longer than this no longer count against the depth limit,
+# the process that accepted them has most likely stopped
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', 600))
+
+JOB_INDEXES = [
+    [('status', ASCENDING), ('submittedAt', ASCENDING)],
+    [('key', ASCENDING), ('status', ASCENDING)]
+]
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is at its depth limit.
+    """
+
+class Job:
+    """
+    A unit of work and its lifecycle state.
+
+    A job succeeds once its function returns, while documents it queued for
+    the write-behind writer may still be unwritten: persisted stays None
+    until they are, then turns True, or False if any was given up.
+    """
+    __slots__ = ('id', 'key', 'func', 'args', 'status', 'result', 'error',
+                 'submitted_at', 'started_at', 'finished_at', 'superseded_by', 'persisted')
+
+    def __init__(self, key, func, args):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.func = func
+        self.args = args
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.superseded_by = None
+        self.persisted = None
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Restore the state of a job from the shared jobs collection.
+
+        Args:
+            document (dict): Document written by to_document
+
+        Returns:
+            Job: Job without its function, for status reporting
+        """
+        job = cls(document.get('key'), None, None)
+        job.id = document['_id']
+        job.status = document['status']
+        job.result = document.get('result')
+        job.error = document.get('error')
+        job.superseded_by = document.get('supersededBy')
+        job.submitted_at = document.get('submittedAt')
+        job.started_at = document.get('startedAt')
+        job.finished_at = document.get('finishedAt')
+        job.persisted = document.get('persisted')
+        return job
+
+    def to_document(self):
+        """
+        Returns:
+            dict: Job state as stored in the shared jobs collection
+        """
+        return {
+            '_id': self.id,
+            'key': self.key,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'supersededBy': self.superseded_by,
+            'submittedAt': self.submitted_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at,
+            'persisted': self.persisted
+        }
+
+    def to_dict(self):
+        """
+        Serialize the job state for the status endpoint.
+
+        Returns:
+            dict: Job state
+        """
+        return {
+            'jobId': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'supersededBy': self.superseded_by,
+            'submittedAt': _isoformat(self.submitted_at),
+            'startedAt': _isoformat(self.started_at),
+            'finishedAt': _isoformat(self.finished_at),
+            'persisted': self.persisted
+        }
+
+class JobQueue:
+    """
+    FIFO queue served by a fixed number of worker threads.
+
+    The queue has a depth limit so bursts are pushed back to the caller
+    instead of piling up CPU-heavy work, and a newer submission with the
+    same key replaces a job of that key still waiting in the queue.
+
+    With a jobs collection attached, job states are kept in MongoDB, so every
+    process serving the API reports the same status, the depth limit counts
+    the jobs queued by all of them and a submission replaces a queued job of
+    the same key wherever it waits. Jobs still run in the process that
+    accepted them: a worker claims its job in the collection first and skips
+    it if another process has superseded it meanwhile.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_depth=JOB_QUEUE_DEPTH,
+                 blas_threads=JOB_BLAS_THREADS, history=JOB_HISTORY):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.blas_threads = blas_threads
+        self.history = history
+        self.queue = deque()
+        self.jobs = OrderedDict()
+        self.running = 0
+        self.blas_limiter = None
+        self.condition = threading.Condition()
+        self.threads = []
+        self.collection = None
+        self.indexed = False
+
+    def attach(self, collection):
+        """
+        Keep job states in a MongoDB collection shared by every process.
+
+        Args:
+            collection: Jobs collection, or None to keep them in memory only
+        """
+        with self.condition:
+            self.collection = collection
+            self.indexed = False
+
+    def submit(self, key, func, *args):
+        """
+        Queue a job, superseding a queued job with the same key.
+
+        Args:
+            key: Coalescing key, typically the user ID, or None for a job
+                that never supersedes nor is superseded
+            func (callable): Function run by the worker
+            *args: Arguments passed to the function
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            QueueFull: If the queue is at its depth limit
+        """
+        job = Job(key, func, args)
+        collection = self.collection
+        if collection is not None:
+            self._submit_shared(collection, job)
+
+        with self.condition:
+            self._start()
+
+            for index, queued in enumerate(self.queue):
+                if key is not None and queued.key == key:
+                    # Take the superseded job's place in line
+                    queued.status = 'superseded'
+                    queued.superseded_by = job.id
+                    queued.finished_at = job.submitted_at
+                    queued.func = None
+                    queued.args = None
+                    if collection is None:
+                        metrics.JOBS_TOTAL.inc(status='superseded')
+                    self.queue[index] = job
+                    break
+            else:
+                if collection is None and len(self.queue) >= self.max_depth:
+                    raise QueueFull(f"Job queue is full ({self.max_depth} jobs)")
+                self.queue.append(job)
+
+            self._remember(job)
+            self.condition.notify()
+
+        return job
+
+    def get(self, job_id):
+        """
+        Look up a job by ID.
+
+        Args:
+            job_id (str): Job ID
+
+        Returns:
+            Job: The job, or None if it is unknown or expired
+        """
+        collection = self.collection
+        if collection is not None:
+            try:
+                document = collection.find_one({'_id': job_id})
+                return Job.from_document(document) if document else None
+            except Exception as e:
+                utils.log(f"Could not read job {job_id}: {e}")
+
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def depth(self):
+        """
+        Returns:
+            int: Number of jobs waiting in the queue
+        """
+        with self.condition:
+            return len(self.queue)
+
+    def active(self):
+        """
+        Returns:
+            int: Number of jobs currently running
+        """
+        with self.condition:
+            return self.running
+
+    def _start(self):
+        if self.threads:
+            return
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def record_persisted(self, job, persisted):
+        """
+        Record whether the documents a job queued for writing were written.
+
+        Args:
+            job (Job): Job that queued the documents
+            persisted (bool): True if all of them were written
+        """
+        with self.condition:
+            job.persisted = persisted and job.persisted is not False
+            persisted = job.persisted
+            collection = self.collection
+        if collection is not None:
+            try:
+                collection.update_one({'_id': job.id}, {'$set': {'persisted': persisted}})
+            except Exception as e:
+                utils.log(f"Could not store the state of job {job.id}: {e}")
+
+    def _submit_shared(self, collection, job):
+        """
+        Supersede the queued jobs of the same key in every process, or check
+        the shared depth limit, then store the new job.
+
+        Checks and inserts are separate operations, so concurrent submissions
+        can exceed the depth limit by a few jobs.
+        """
+        if not self.indexed:
+            for keys in JOB_INDEXES:
+                collection.create_index(keys)
+            collection.create_index([('submittedAt', ASCENDING)], expireAfterSeconds=JOB_RETENTION_SECONDS)
+            self.indexed = True
+
+        replaced = 0
+        if job.key is not None:
+            replaced = collection.update_many(
+                {'key': job.key, 'status': 'queued'},
+                {'$set': {'status': 'superseded', 'supersededBy': job.id, 'finishedAt': job.submitted_at}}
+            ).modified_count
+        if replaced:
+            metrics.JOBS_TOTAL.inc(replaced, status='superseded')
+        else:
+            stale = job.submitted_at - timedelta(seconds=JOB_STALE_SECONDS)
+            if collection.count_documents({'status': 'queued', 'submittedAt': {'$gte': stale}}) >= self.max_depth:
+                raise QueueFull(f"Job queue is full ({self.max_depth} jobs)")
+        collection.insert_one(job.to_document())
+
+    def _claim(self, collection, job):
+        """
+        Mark a job running in the shared collection.
+
+        Returns:
+            bool: False if another process superseded the job meanwhile
+        """
+        try:
+            claimed = collection.find_one_and_update(
+                {'_id': job.id, 'status': 'queued'},
+                {'$set': {'status': 'running', 'startedAt': job.started_at}}
+            )
+        except Exception as e:
+            utils.log(f"Could not claim job {job.id}: {e}")
+            return True
+        if claimed is not None:
+            return True
+
+        document = collection.find_one({'_id': job.id}) or {}
+        with self.condition:
+            job.status = document.get('status', 'superseded')
+            job.superseded_by = document.get('supersededBy')
+            job.finished_at = document.get('finishedAt') or datetime.utcnow()
+            job.func = None
+            job.args = None
+        return False
+
+    def _store(self, collection, job):
+        try:
+            collection.update_one({'_id': job.id}, {'$set': {
+                'status': job.status,
+                'result': job.result,
+                'error': job.error,
+                'finishedAt': job.finished_at
+            }})
+        except Exception as e:
+            utils.log(f"Could not store the state of job {job.id}: {e}")
+
+    def _remember(self, job):
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status in ('queued', 'running'):
+                break
+            del self.jobs[oldest_id]
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                job.started_at = datetime.utcnow()
+                collection = self.collection
+
+            if collection is not None and not self._claim(collection, job):
+                continue
+
+            with self.condition:
+                job.status = 'running'
+                self.running += 1
+                # Worker threads already provide the parallelism, so keep BLAS
+                # from spawning its own threads per job. The limit is process
+                # wide, it holds while any job runs and is lifted after the last
+                # one, so fits and warm-ups between jobs use every core again.
+                if self.blas_limiter is None:
+                    self.blas_limiter = threadpool_limits(limits=self.blas_threads)
+            metrics.JOB_QUEUE_WAIT_SECONDS.observe((job.started_at - job.submitted_at).total_seconds())
+
+            _current.job = job
+            _current.queue = self
+            try:
+                job.result = job.func(*job.args)
+                job.status = 'succeeded'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+                utils.log(f"Job {job.id} failed: {e}")
+            finally:
+                _current.job = None
+                with self.condition:
+                    job.finished_at = datetime.utcnow()
+                    job.func = None
+                    job.args = None
+                    self.running -= 1
+                    if self.running == 0 and self.blas_limiter is not None:
+                        self.blas_limiter.restore_original_limits()
+                        self.blas_limiter = None
+                if collection is not None:
+                    self._store(collection, job)
+                metrics.JOBS_TOTAL.inc(status=job.status)
+                metrics.JOB_SECONDS.observe(
+                    (job.finished_at - job.started_at).total_seconds(), status=job.status
+                )
+
+# Job running in the current worker thread
+_current = threading.local()
+
+def persisted_callback():
+    """
+    Callback for the writer that records on the running job whether the
+    documents it queued were written.
+
+    Returns:
+        callable: Callback, or None outside a job
+    """
+    job = getattr(_current, 'job', None)
+    if job is None:
+        return None
+    queue = _current.queue
+    return lambda persisted: queue.record_persisted(job, persisted)
+
+def _isoformat(value):
+    return value.isoformat() + 'Z' if value else None
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+    """
+    Get the process-wide job queue.
+
+    Returns:
+        JobQueue: Shared job queue
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
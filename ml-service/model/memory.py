@@ -0,0 +1,34 @@
+"""
+Memory budget for the scratch arrays of clustering, distance and scoring work.
+"""
+import os
+
+# Megabytes of temporary arrays one step may allocate, 0 for no budget.
+# Catalog-sized arrays that are kept (features, labels, indexes) come on top.
+MEMORY_BUDGET_MB = float(os.getenv('MEMORY_BUDGET_MB', 0))
+
+def chunk_rows(row_bytes, default):
+    """
+    Number of rows processed at once so a chunk's scratch arrays fit the budget.
+
+    Args:
+        row_bytes (int): Scratch bytes needed per row
+        default (int): Rows per chunk without a budget, also the maximum
+
+    Returns:
+        int: Rows per chunk, at least 1
+    """
+    if MEMORY_BUDGET_MB <= 0:
+        return default
+    return max(1, min(default, int(MEMORY_BUDGET_MB * 2 ** 20 // max(1, row_bytes))))
+
+def working_memory_mb():
+    """
+    Working memory for scikit-learn's chunked pairwise computations.
+
+    Returns:
+        int: Megabytes, or None to keep the scikit-learn default
+    """
+    if MEMORY_BUDGET_MB <= 0:
+        return None
+    return max(1, int(MEMORY_BUDGET_MB))
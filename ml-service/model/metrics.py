@@ -0,0 +1,226 @@
+"""
+Prometheus-format metrics for the recommendation pipeline.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# When the service modules were first imported, the reference for startup timings
+START_TIME = time.monotonic()
+
+# Latency buckets in seconds, from sub-millisecond stages to full refits
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self):
+        with self.lock:
+            return [f'{self.name}{self._labels(key)} {value}' for key, value in self.values.items()]
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down, either set directly or read from a callback.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description):
+        super().__init__(name, description)
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def _samples(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float('nan')
+        return [f'{self.name} {value}']
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values over cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in self.series.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{self._labels(key, ("le", repr(float(bound))))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{self._labels(key, ("le", "+Inf"))} {count}')
+                lines.append(f'{self.name}_sum{self._labels(key)} {total}')
+                lines.append(f'{self.name}_count{self._labels(key)} {count}')
+        return lines
+
+@contextmanager
+def timed(histogram, **labels):
+    """
+    Observe the duration of a block in a histogram.
+
+    Args:
+        histogram (Histogram): Histogram to record into
+        **labels: Label values for the observation
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+def observe_stage(stage, seconds):
+    """
+    Record the duration of a recommendation pipeline stage.
+
+    Args:
+        stage (str): Stage name
+        seconds (float): Stage duration
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+def resident_memory_bytes():
+    """
+    Read the current resident set size of the process (Linux only).
+
+    Returns:
+        int: Resident memory in bytes
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def render():
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: Metrics text
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = Histogram(
+    'recommendation_stage_seconds', 'Duration of recommendation pipeline stages', ['stage']
+)
+CLUSTER_CANDIDATE_SECONDS = Histogram(
+    'clustering_candidate_seconds', 'Duration of fitting and scoring one cluster count candidate',
+    ['n_clusters']
+)
+JOB_SECONDS = Histogram(
+    'recommendation_job_seconds', 'Run time of recommendation jobs', ['status']
+)
+JOB_QUEUE_WAIT_SECONDS = Histogram(
+    'recommendation_job_queue_wait_seconds', 'Time jobs spend waiting in the queue'
+)
+JOBS_TOTAL = Counter(
+    'recommendation_jobs_total', 'Recommendation jobs by final status', ['status']
+)
+RECOMMENDATION_PATHS_TOTAL = Counter(
+    'recommendation_paths_total', 'Recommendations generated per scoring path', ['path']
+)
+RETRIEVED_CANDIDATES = Histogram(
+    'recommendation_retrieved_candidates', 'Songs passed from candidate retrieval to full scoring', ['discovery'],
+    buckets=(100, 500, 1000, 2500, 5000, 10000, 20000, 50000, 100000)
+)
+CLUSTER_UPDATES_TOTAL = Counter(
+    'cluster_model_updates_total', 'Cluster model builds by mode (full, incremental or refit after drift)', ['mode']
+)
+CLUSTER_REASSIGNED_RATIO = Histogram(
+    'cluster_reassigned_ratio', 'Fraction of songs closer to another centroid after an incremental update',
+    buckets=(0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+)
+PROFILE_UPDATES_TOTAL = Counter(
+    'taste_profile_updates_total', 'Taste profile lookups by how the profile was brought up to date', ['mode']
+)
+RESULT_CACHE_TOTAL = Counter(
+    'recommendation_result_cache_total', 'Recommendation result cache lookups by outcome', ['result']
+)
+RESULT_CACHE_ENTRIES = Gauge('recommendation_result_cache_entries', 'Results held in the result cache')
+PERSISTED_DOCUMENTS_TOTAL = Counter(
+    'recommendation_documents_persisted_total', 'Recommendation documents written to MongoDB by outcome',
+    ['status']
+)
+PERSIST_BUFFERED = Gauge('recommendation_documents_buffered', 'Recommendation documents waiting to be written')
+PROFILES_CACHED = Gauge('taste_profiles_cached', 'Taste profiles held in memory')
+PROFILES_CACHED_BYTES = Gauge('taste_profiles_cached_bytes', 'Estimated bytes of the taste profiles held in memory')
+WARM_UP_SECONDS = Gauge('warm_up_seconds', 'Duration of the startup warm-up phase')
+FIRST_RECOMMENDATION_SECONDS = Gauge(
+    'first_recommendation_seconds', 'Time from startup to the first successful recommendation'
+)
+QUEUE_DEPTH = Gauge('recommendation_queue_depth', 'Jobs waiting in the queue')
+ACTIVE_JOBS = Gauge('recommendation_active_jobs', 'Jobs currently running')
+CATALOG_SONGS = Gauge('catalog_songs', 'Songs in the catalog feature matrix')
+PROCESS_RESIDENT_MEMORY = Gauge('process_resident_memory_bytes', 'Resident memory of the serving process')
@@ -0,0 +1,99 @@
+"""
+Nearest-neighbour search over the weighted song features.
+"""
+import numpy as np
+from . import memory
+
+# Liked sets at least this large get their own tree when finding each
+# candidate's closest liked songs; smaller sets are compared directly
+LIKED_TREE_MIN_SIZE = 64
+
+# Share of neighbours fetched per query point beyond an even split of k
+NEAREST_OVERSAMPLE = 2
+
+# Candidate rows compared against liked songs at once when computing distances
+DISTANCE_CHUNK_SIZE = 4096
+
+class NeighborIndex:
+    """
+    KD-tree over the weighted feature matrix of one weight profile.
+
+    Audio features have few dimensions, so a KD-tree answers k-nearest
+    queries without scanning the whole catalog.
+    """
+
+    def __init__(self, features_array, leaf_size=40):
+        from sklearn.neighbors import KDTree
+
+        self.size = len(features_array)
+        self.tree = KDTree(np.asarray(features_array, dtype=np.float64), leaf_size=leaf_size)
+
+    def nearest(self, points, k, exact=False):
+        """
+        Find the catalog rows closest to a set of points.
+
+        With exact, each point contributes its own k nearest rows and the
+        closest k of their union are the exact k nearest to the set. Without
+        it, each point contributes an equal share of k (oversampled by
+        NEAREST_OVERSAMPLE) so long liked histories stay cheap to query,
+        and every point keeps its own neighbourhood in the result.
+
+        Args:
+            points (np.array): Query feature rows, e.g. a user's liked songs
+            k (int): Number of rows to return
+            exact (bool): Whether to return the exact k nearest rows
+
+        Returns:
+            tuple: (rows, distances) sorted by distance to the closest point
+        """
+        k = min(k, self.size)
+        if len(points) == 0 or k == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        per_point = k if exact else min(k, -(-k // len(points)) * NEAREST_OVERSAMPLE)
+        distances, rows = self.tree.query(np.asarray(points, dtype=np.float64), k=per_point)
+        rows = rows.ravel()
+        distances = distances.ravel()
+
+        # Keep each row's smallest distance over all query points
+        order = np.lexsort((distances, rows))
+        rows, distances = rows[order], distances[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        rows, distances = rows[first], distances[first]
+
+        closest = np.argsort(distances, kind='stable')[:k]
+        return rows[closest], distances[closest]
+
+def nearest_liked_distance(candidate_features, liked_features, k=3):
+    """
+    Average distance from each candidate to its (up to) k closest liked songs.
+
+    Args:
+        candidate_features (np.array): Feature rows of the candidates
+        liked_features (np.array): Feature rows of the liked songs
+        k (int): Number of closest liked songs averaged
+
+    Returns:
+        np.array: Average distance per candidate
+    """
+    k = min(k, len(liked_features))
+
+    if len(liked_features) >= LIKED_TREE_MIN_SIZE:
+        from sklearn.neighbors import KDTree
+        tree = KDTree(np.asarray(liked_features, dtype=np.float64))
+        distances, _ = tree.query(np.asarray(candidate_features, dtype=np.float64), k=k)
+        return distances.mean(axis=1)
+
+    # Each candidate row needs its differences and distances to every liked song
+    chunk_size = memory.chunk_rows(len(liked_features) * (liked_features.shape[1] + 1) * 8, DISTANCE_CHUNK_SIZE)
+    result = np.empty(len(candidate_features))
+    for start in range(0, len(candidate_features), chunk_size):
+        chunk = candidate_features[start:start + chunk_size]
+        diff = chunk[:, None, :] - liked_features[None, :, :]
+        distances = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+        if k < distances.shape[1]:
+            distances = np.partition(distances, k - 1, axis=1)[:, :k]
+        result[start:start + len(chunk)] = distances.mean(axis=1)
+
+    return result
@@ -0,0 +1,256 @@
+"""
+Write-behind persistence of recommendation documents.
+"""
+import atexit
+import os
+import threading
+import time
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from . import metrics
+from . import utils
+
+PERSIST_BATCH_SIZE = int(os.getenv('PERSIST_BATCH_SIZE', 100))
+PERSIST_FLUSH_SECONDS = float(os.getenv('PERSIST_FLUSH_SECONDS', 2))
+
+# Failed writes are retried this many times, waiting PERSIST_RETRY_SECONDS
+# before the first retry and twice as long before every further one
+PERSIST_MAX_RETRIES = int(os.getenv('PERSIST_MAX_RETRIES', 3))
+PERSIST_RETRY_SECONDS = float(os.getenv('PERSIST_RETRY_SECONDS', 1))
+
+DUPLICATE_KEY = 11000
+
+# 'full' copies song names, artists and images into each document, 'compact'
+# stores only song IDs and scores
+RECOMMENDATION_STORAGE = os.getenv('RECOMMENDATION_STORAGE', 'full')
+
+RECOMMENDATION_INDEXES = [
+    [('userId', ASCENDING), ('questionnaireId', ASCENDING), ('timestamp', DESCENDING)],
+    # The web app lists a user's recommendations newest first
+    [('userId', ASCENDING), ('timestamp', DESCENDING)]
+]
+
+def compact_recommendations(recommendations, storage=RECOMMENDATION_STORAGE):
+    """
+    Drop copied song metadata from formatted recommendations in compact storage mode.
+
+    Args:
+        recommendations (list): Formatted recommendations
+        storage (str): 'full' or 'compact'
+
+    Returns:
+        list: Recommendations as they are stored
+    """
+    if storage != 'compact':
+        return recommendations
+    return [{'songId': r['songId'], 'score': r['score']} for r in recommendations]
+
+def ensure_indexes(collection):
+    """
+    Create the indexes used to look up recommendation documents.
+
+    Args:
+        collection: Recommendations collection
+    """
+    for keys in RECOMMENDATION_INDEXES:
+        collection.create_index(keys)
+
+class _Ticket:
+    """
+    Outcome of the documents queued by one add call.
+    """
+    __slots__ = ('remaining', 'failed', 'callback')
+
+    def __init__(self, count, callback):
+        self.remaining = count
+        self.failed = False
+        self.callback = callback
+
+class RecommendationWriter:
+    """
+    Buffers recommendation documents and writes them with one insert_many
+    per collection once the buffer reaches its size limit or its oldest
+    document has waited long enough.
+
+    Documents of a failed insert are retried with exponential backoff, up to
+    PERSIST_MAX_RETRIES times. Documents MongoDB rejects individually (for
+    example failing validation) are not retried.
+    """
+
+    def __init__(self, batch_size=PERSIST_BATCH_SIZE, flush_seconds=PERSIST_FLUSH_SECONDS,
+                 max_retries=PERSIST_MAX_RETRIES, retry_seconds=PERSIST_RETRY_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_retries = max_retries
+        self.retry_seconds = retry_seconds
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.pending = {}
+        self.buffered = 0
+        self.oldest = None
+        # (due, attempt, collection, entries) of failed writes
+        self.retries = []
+        self.retrying = 0
+        self.indexed = set()
+        self.thread = None
+
+    def add(self, collection, documents, on_persisted=None):
+        """
+        Queue documents for insertion.
+
+        Args:
+            collection: Collection the documents belong to
+            documents (list): Documents to insert
+            on_persisted (callable): Called from the writer with True once all
+                documents are written, or False once any of them is given up (optional)
+        """
+        if not documents:
+            return
+
+        ticket = _Ticket(len(documents), on_persisted) if on_persisted is not None else None
+        with self.condition:
+            self._start()
+            entry = self.pending.setdefault(collection.full_name, (collection, []))
+            entry[1].extend((document, ticket) for document in documents)
+            self.buffered += len(documents)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self.condition.notify()
+
+        if self.batch_size <= 1:
+            self.flush()
+
+    def flush(self, retries=False):
+        """
+        Write every buffered document now, and the failed writes due for a retry.
+
+        Args:
+            retries (bool): Retry every failed write, whether due or not
+
+        Returns:
+            int: Number of documents written
+        """
+        with self.flush_lock:
+            with self.condition:
+                batches = [(0, collection, entries) for collection, entries in self.pending.values()]
+                self.pending = {}
+                self.buffered = 0
+                self.oldest = None
+
+                now = time.monotonic()
+                waiting = []
+                for retry in self.retries:
+                    if retries or retry[0] <= now:
+                        batches.append(retry[1:])
+                        self.retrying -= len(retry[3])
+                    else:
+                        waiting.append(retry)
+                self.retries = waiting
+
+            return sum(self._write(attempt, collection, entries) for attempt, collection, entries in batches)
+
+    def size(self):
+        """
+        Returns:
+            int: Number of documents waiting to be written, including retries
+        """
+        with self.condition:
+            return self.buffered + self.retrying
+
+    def _write(self, attempt, collection, entries):
+        """
+        Insert one collection's documents and settle their outcome.
+
+        Returns:
+            int: Number of documents written
+        """
+        documents = [document for document, _ in entries]
+        rejected = set()
+        try:
+            if collection.full_name not in self.indexed:
+                ensure_indexes(collection)
+                self.indexed.add(collection.full_name)
+            with metrics.timed(metrics.STAGE_SECONDS, stage='persist_flush'):
+                collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Unordered inserts write every document without a write error. On
+            # a retry, a duplicate key means an earlier attempt wrote it already.
+            rejected = {
+                error['index'] for error in e.details.get('writeErrors', [])
+                if not (attempt and error.get('code') == DUPLICATE_KEY)
+            }
+            utils.log(f"Could not persist {len(rejected)} of {len(entries)} recommendation documents: {e}")
+        except Exception as e:
+            utils.log(f"Could not persist {len(entries)} recommendation documents "
+                      f"(attempt {attempt + 1} of {self.max_retries + 1}): {e}")
+            if attempt < self.max_retries:
+                metrics.PERSISTED_DOCUMENTS_TOTAL.inc(len(entries), status='retried')
+                due = time.monotonic() + self.retry_seconds * 2 ** attempt
+                with self.condition:
+                    self.retries.append((due, attempt + 1, collection, entries))
+                    self.retrying += len(entries)
+                    self.condition.notify()
+                return 0
+            rejected = set(range(len(entries)))
+
+        written = [entry for index, entry in enumerate(entries) if index not in rejected]
+        if written:
+            metrics.PERSISTED_DOCUMENTS_TOTAL.inc(len(written), status='written')
+        if rejected:
+            metrics.PERSISTED_DOCUMENTS_TOTAL.inc(len(rejected), status='failed')
+        _settle([entries[index] for index in rejected], False)
+        _settle(written, True)
+        return len(written)
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='recommendation-writer', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self._due():
+                    deadlines = [retry[0] for retry in self.retries]
+                    if self.oldest is not None:
+                        deadlines.append(self.oldest + self.flush_seconds)
+                    timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+                    self.condition.wait(timeout)
+            self.flush()
+
+    def _due(self):
+        now = time.monotonic()
+        if any(retry[0] <= now for retry in self.retries):
+            return True
+        if self.buffered == 0:
+            return False
+        return self.buffered >= self.batch_size or now - self.oldest >= self.flush_seconds
+
+def _settle(entries, written):
+    for _, ticket in entries:
+        if ticket is None:
+            continue
+        ticket.remaining -= 1
+        ticket.failed = ticket.failed or not written
+        if ticket.remaining == 0 and ticket.callback is not None:
+            try:
+                ticket.callback(not ticket.failed)
+            except Exception as e:
+                utils.log(f"Persistence callback failed: {e}")
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """
+    Get the process-wide recommendation writer.
+
+    Returns:
+        RecommendationWriter: Shared writer, flushed at interpreter exit
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = RecommendationWriter()
+            atexit.register(_writer.flush, retries=True)
+        return _writer
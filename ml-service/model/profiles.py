@@ -0,0 +1,522 @@
+"""
+Per-user taste profiles updated incrementally from song preferences.
+"""
+import itertools
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+from bson.binary import Binary
+from . import metrics
+from . import utils
+
+# Megabytes of taste profiles kept in memory per process, the least
+# recently used are dropped first
+PROFILE_CACHE_MB = float(os.getenv('PROFILE_CACHE_MB', 64))
+
+# Estimated bytes of a profile besides its row arrays and cluster counts
+PROFILE_OVERHEAD_BYTES = 1024
+
+PROFILE_COLLECTION = 'tasteProfiles'
+
+# Users are spread over this many locks so one user's updates are serialized
+PROFILE_LOCK_STRIPES = 64
+
+class StaleDelta(Exception):
+    """
+    Raised when preferences sent as a delta do not continue the saved profile.
+    """
+
+    def __init__(self, preference_count):
+        super().__init__("Preferences do not continue the saved taste profile, send all of them")
+        self.preference_count = preference_count
+
+class TasteProfile:
+    """
+    What a user's preferences say about their taste, in catalog row terms.
+
+    Liked and rated songs are sorted arrays of catalog rows of one catalog
+    epoch, so a profile grows with the user's ratings, not with the catalog.
+    Preferences are applied in the order the web app stores them, and the
+    count and `_id` of the last one applied tell which are new next time.
+    Preferences can be accepted before a catalog is at hand, they are kept
+    pending and resolved to rows on the next apply.
+    """
+    __slots__ = ('user_id', 'epoch', 'catalog_version', 'preference_count', 'last_preference_id',
+                 'liked', 'rated', 'liked_total', 'unresolved', 'pending', 'cluster_counts', 'generation')
+
+    def __init__(self, user_id, epoch, catalog_version):
+        self.user_id = user_id
+        self.epoch = epoch
+        self.catalog_version = catalog_version
+        self.preference_count = 0
+        self.last_preference_id = None
+        self.liked = np.empty(0, dtype=np.int32)
+        self.rated = np.empty(0, dtype=np.int32)
+        # Liked preferences including songs missing from the catalog
+        self.liked_total = 0
+        # (song_id, liked) of preferences for songs not in the catalog yet
+        self.unresolved = []
+        # (song_id, liked) of preferences accepted but not looked up yet
+        self.pending = []
+        self.cluster_counts = {}
+        # Changes whenever preferences are applied, unique across profiles
+        self.generation = next(_generations)
+
+    @property
+    def has_likes(self):
+        return self.liked_total > 0
+
+    def liked_rows(self):
+        """
+        Returns:
+            np.array: Catalog rows of the liked songs
+        """
+        return self.liked.astype(np.intp)
+
+    def rated_rows(self):
+        """
+        Returns:
+            np.array: Catalog rows of the liked and disliked songs
+        """
+        return self.rated.astype(np.intp)
+
+    def nbytes(self):
+        """
+        Returns:
+            int: Estimated memory held by the profile
+        """
+        counts = sum(liked.nbytes + disliked.nbytes for _, liked, disliked in self.cluster_counts.values())
+        ratings = len(self.unresolved) + len(self.pending)
+        return self.liked.nbytes + self.rated.nbytes + counts + PROFILE_OVERHEAD_BYTES + 64 * ratings
+
+    def copy(self):
+        """
+        Copy the profile, so it can be read while the original is updated.
+
+        Returns:
+            TasteProfile: Copy with the same generation
+        """
+        profile = TasteProfile.__new__(TasteProfile)
+        for name in TasteProfile.__slots__:
+            setattr(profile, name, getattr(self, name))
+        # Row arrays are replaced on every update, the rest is changed in place
+        profile.unresolved = list(self.unresolved)
+        profile.pending = list(self.pending)
+        profile.cluster_counts = {
+            key: (models, liked.copy(), disliked.copy())
+            for key, (models, liked, disliked) in self.cluster_counts.items()
+        }
+        return profile
+
+    def revision(self):
+        """
+        Identify the preferences applied so far.
+
+        Returns:
+            str: Key changing whenever preferences are added, or None if the
+                preferences carry no `_id` to track them by
+        """
+        if self.last_preference_id is None:
+            return None
+        return f'{self.user_id}:{self.preference_count}:{self.last_preference_id}'
+
+    def follows(self, preferences):
+        """
+        Whether preferences extend the ones already applied.
+
+        Args:
+            preferences (list): Full preference list of the user
+
+        Returns:
+            bool: True if only preferences past preference_count are new
+        """
+        if len(preferences) < self.preference_count:
+            return False
+        if self.preference_count == 0:
+            return True
+        return (self.last_preference_id is not None
+                and _preference_id(preferences[self.preference_count - 1]) == self.last_preference_id)
+
+    def continues(self, count, last_preference_id):
+        """
+        Whether preferences added after a known base extend the ones already applied.
+
+        Args:
+            count (int): Number of preferences the sender knows are applied
+            last_preference_id: `_id` of the last of them
+
+        Returns:
+            bool: True if the base is exactly where this profile ends
+        """
+        if count != self.preference_count:
+            return False
+        if count == 0:
+            return True
+        return self.last_preference_id is not None and str(last_preference_id) == self.last_preference_id
+
+    def accept(self, preferences):
+        """
+        Count new preferences and keep them pending until the next apply.
+
+        Args:
+            preferences (list): Preferences not applied yet, oldest first
+        """
+        for preference in preferences:
+            liked = bool(preference.get('liked', False))
+            if liked:
+                self.liked_total += 1
+            self.pending.append((preference.get('songId'), liked))
+
+        self.preference_count += len(preferences)
+        if preferences:
+            self.last_preference_id = _preference_id(preferences[-1])
+        self.generation = next(_generations)
+
+    def apply(self, snapshot, preferences):
+        """
+        Apply new and pending preferences on the catalog snapshot they were rated on.
+
+        Args:
+            snapshot (CatalogSnapshot): Current catalog, of the profile's epoch
+            preferences (list): Preferences not applied yet, oldest first
+        """
+        self.accept(preferences)
+        self._follow_catalog(snapshot)
+
+        pending, self.pending = self.pending, []
+        rows = snapshot.columns.lookup([song_id for song_id, _ in pending])
+        ratings = []
+        for (song_id, liked), row in zip(pending, rows.tolist()):
+            if row < 0:
+                self.unresolved.append((song_id, liked))
+            else:
+                ratings.append((row, liked))
+        self._rate(ratings)
+        self.generation = next(_generations)
+
+    def cluster_like_counts(self, models):
+        """
+        Liked and disliked songs per cluster of a weight profile's models.
+
+        Counts are kept per weight profile and recounted only when its models change.
+
+        Args:
+            models (ClusterModels): Models the songs are clustered by
+
+        Returns:
+            tuple: (liked_counts, disliked_counts) arrays indexed by cluster
+        """
+        cached = self.cluster_counts.get(models.profile)
+        if cached is not None and cached[0] is models:
+            return cached[1], cached[2]
+
+        n_clusters = int(models.kmeans_model.n_clusters)
+        clusters = np.asarray(models.clusters)
+        liked = self.liked_rows()
+        disliked = np.setdiff1d(self.rated_rows(), liked, assume_unique=True)
+        liked_counts = np.bincount(clusters[liked], minlength=n_clusters)
+        disliked_counts = np.bincount(clusters[disliked], minlength=n_clusters)
+        self.cluster_counts[models.profile] = (models, liked_counts, disliked_counts)
+        return liked_counts, disliked_counts
+
+    def to_document(self):
+        """
+        Returns:
+            dict: MongoDB document of the profile, with compressed row arrays
+        """
+        return {
+            '_id': self.user_id,
+            'epoch': self.epoch,
+            'catalogVersion': self.catalog_version,
+            'preferenceCount': self.preference_count,
+            'lastPreferenceId': self.last_preference_id,
+            'likedRows': _pack_rows(self.liked),
+            'ratedRows': _pack_rows(self.rated),
+            'likedTotal': self.liked_total,
+            'unresolved': [[song_id, liked] for song_id, liked in self.unresolved],
+            'pending': [[song_id, liked] for song_id, liked in self.pending],
+            'updatedAt': datetime.utcnow()
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Restore a profile saved with to_document.
+
+        Returns:
+            TasteProfile: Restored profile
+
+        Raises:
+            KeyError: If the document is not in the current format
+        """
+        profile = cls(document['_id'], document['epoch'], document['catalogVersion'])
+        profile.preference_count = document['preferenceCount']
+        profile.last_preference_id = document['lastPreferenceId']
+        profile.liked = _unpack_rows(document['likedRows'])
+        profile.rated = _unpack_rows(document['ratedRows'])
+        profile.liked_total = document['likedTotal']
+        profile.unresolved = [(song_id, liked) for song_id, liked in document['unresolved']]
+        profile.pending = [(song_id, liked) for song_id, liked in document['pending']]
+        return profile
+
+    def _follow_catalog(self, snapshot):
+        if snapshot.version == self.catalog_version:
+            return
+
+        # Rows keep their songs within an epoch, only the clusters change
+        self.catalog_version = snapshot.version
+        self.cluster_counts = {}
+
+        # Songs rated before they were imported may be in the catalog now
+        unresolved, self.unresolved = self.unresolved, []
+        if unresolved:
+            rows = snapshot.columns.lookup([song_id for song_id, _ in unresolved])
+            ratings = []
+            for (song_id, liked), row in zip(unresolved, rows.tolist()):
+                if row < 0:
+                    self.unresolved.append((song_id, liked))
+                else:
+                    ratings.append((row, liked))
+            self._rate(ratings)
+
+    def _rate(self, ratings):
+        """
+        Add (row, liked) ratings in order. A like stays once given, a later
+        dislike of the same song does not remove it.
+        """
+        if not ratings:
+            return
+
+        new_liked = set()
+        new_rated = set()
+        for row, liked in ratings:
+            was_liked = row in new_liked or _contains(self.liked, row)
+            was_rated = row in new_rated or _contains(self.rated, row)
+            new_rated.add(row)
+            if liked and not was_liked:
+                new_liked.add(row)
+
+            # Keep the counts of the cached weight profiles in step
+            for models, liked_counts, disliked_counts in self.cluster_counts.values():
+                cluster = models.clusters[row]
+                if liked and not was_liked:
+                    liked_counts[cluster] += 1
+                    if was_rated:
+                        disliked_counts[cluster] -= 1
+                elif not liked and not was_rated:
+                    disliked_counts[cluster] += 1
+
+        self.liked = np.union1d(self.liked, np.fromiter(new_liked, dtype=np.int32)).astype(np.int32)
+        self.rated = np.union1d(self.rated, np.fromiter(new_rated, dtype=np.int32)).astype(np.int32)
+
+class ProfileStore:
+    """
+    Taste profiles kept in memory by least recent use within a byte budget
+    and saved to MongoDB, so a user's next request only applies the
+    preferences added since.
+
+    Callers get copies, taken under the user's lock, so a request reads one
+    consistent state while another request of the user updates the profile.
+    """
+
+    def __init__(self, max_bytes=PROFILE_CACHE_MB * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.profiles = OrderedDict()
+        # Bytes of each cached profile when it was last stored
+        self.sizes = {}
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.user_locks = [threading.Lock() for _ in range(PROFILE_LOCK_STRIPES)]
+
+    def get(self, db, user_id, preferences, snapshot, base=None):
+        """
+        Get a user's profile brought up to date with their preferences.
+
+        Args:
+            db: Database connection
+            user_id (str): User ID
+            preferences (list): Full preference list of the user, or only the
+                ones added after base
+            snapshot (CatalogSnapshot): Current catalog
+            base (tuple): (count, last preference ID) the preferences continue
+                from when they are a delta (optional)
+
+        Returns:
+            TasteProfile: Copy of the up-to-date profile
+
+        Raises:
+            StaleDelta: If the profile does not end at base, a delta cannot
+                rebuild it
+        """
+        preferences = preferences or []
+
+        with self._user_lock(user_id):
+            with self.lock:
+                profile = self.profiles.get(user_id)
+            if profile is None or (base is not None and not profile.continues(*base)):
+                # Another process may have saved the profile the delta continues
+                profile = self._read(db, user_id)
+
+            if base is not None:
+                if profile is None or profile.epoch != snapshot.epoch or not profile.continues(*base):
+                    raise StaleDelta(profile.preference_count if profile is not None else 0)
+                new_preferences = preferences
+                changed = new_preferences or profile.pending or profile.catalog_version != snapshot.version
+                mode = 'incremental' if changed else 'unchanged'
+            elif profile is None or profile.epoch != snapshot.epoch or not profile.follows(preferences):
+                mode = 'rebuild'
+                profile = TasteProfile(user_id, snapshot.epoch, snapshot.version)
+                new_preferences = preferences
+            else:
+                new_preferences = preferences[profile.preference_count:]
+                changed = new_preferences or profile.pending or profile.catalog_version != snapshot.version
+                mode = 'incremental' if changed else 'unchanged'
+
+            profile.apply(snapshot, new_preferences)
+            metrics.PROFILE_UPDATES_TOTAL.inc(mode=mode)
+            # Profiles of preferences without IDs cannot be continued, so are not saved
+            if mode != 'unchanged' and profile.revision() is not None:
+                self._save(db, profile)
+
+            self._remember(profile)
+            return profile.copy()
+
+    def accept(self, db, user_id, preferences, base):
+        """
+        Add preferences sent as a delta to a user's profile without a catalog.
+
+        The preferences are counted and saved as pending, so a delta sent
+        after this one continues from it even before a catalog lookup has
+        resolved them. The next get resolves them to rows.
+
+        Args:
+            db: Database connection
+            user_id (str): User ID
+            preferences (list): Preferences added after base
+            base (tuple): (count, last preference ID) the preferences continue from
+
+        Returns:
+            TasteProfile: Copy of the profile with the preferences accepted
+
+        Raises:
+            StaleDelta: If the profile does not end at base
+        """
+        with self._user_lock(user_id):
+            with self.lock:
+                profile = self.profiles.get(user_id)
+            if profile is None or not profile.continues(*base):
+                # Another process may have saved the profile the delta continues
+                profile = self._read(db, user_id)
+            if profile is None or not profile.continues(*base):
+                raise StaleDelta(profile.preference_count if profile is not None else 0)
+
+            profile.accept(preferences or [])
+            if preferences and profile.revision() is not None:
+                self._save(db, profile)
+
+            self._remember(profile)
+            return profile.copy()
+
+    def cluster_like_counts(self, profile, models):
+        """
+        Liked and disliked songs per cluster for a profile returned by get.
+
+        While the cached profile is still in the same state, the counts are
+        kept on it, so later preferences update them instead of a recount.
+
+        Args:
+            profile (TasteProfile): Profile returned by get
+            models (ClusterModels): Models the songs are clustered by
+
+        Returns:
+            tuple: (liked_counts, disliked_counts) arrays indexed by cluster
+        """
+        with self._user_lock(profile.user_id):
+            with self.lock:
+                cached = self.profiles.get(profile.user_id)
+            if cached is None or cached.generation != profile.generation:
+                return profile.cluster_like_counts(models)
+
+            liked_counts, disliked_counts = cached.cluster_like_counts(models)
+            self._remember(cached)
+            return liked_counts.copy(), disliked_counts.copy()
+
+    def size(self):
+        """
+        Returns:
+            int: Number of profiles in memory
+        """
+        with self.lock:
+            return len(self.profiles)
+
+    def nbytes(self):
+        """
+        Returns:
+            int: Estimated bytes of the profiles in memory
+        """
+        with self.lock:
+            return self.cached_bytes
+
+    def _user_lock(self, user_id):
+        return self.user_locks[hash(user_id) % PROFILE_LOCK_STRIPES]
+
+    def _remember(self, profile):
+        size = profile.nbytes()
+        with self.lock:
+            self.cached_bytes += size - self.sizes.get(profile.user_id, 0)
+            self.profiles[profile.user_id] = profile
+            self.sizes[profile.user_id] = size
+            self.profiles.move_to_end(profile.user_id)
+            # Keep the newest profile even if it alone exceeds the budget
+            while self.cached_bytes > self.max_bytes and len(self.profiles) > 1:
+                user_id, _ = self.profiles.popitem(last=False)
+                self.cached_bytes -= self.sizes.pop(user_id)
+
+    def _read(self, db, user_id):
+        try:
+            document = db[PROFILE_COLLECTION].find_one({'_id': user_id})
+            return TasteProfile.from_document(document) if document else None
+        except Exception as e:
+            utils.log(f"Could not load taste profile of {user_id}: {e}")
+            return None
+
+    def _save(self, db, profile):
+        try:
+            db[PROFILE_COLLECTION].replace_one({'_id': profile.user_id}, profile.to_document(), upsert=True)
+        except Exception as e:
+            utils.log(f"Could not save taste profile of {profile.user_id}: {e}")
+
+_generations = itertools.count()
+
+def _contains(rows, row):
+    index = np.searchsorted(rows, row)
+    return index < len(rows) and rows[index] == row
+
+def _pack_rows(rows):
+    return Binary(zlib.compress(np.asarray(rows, dtype='<i4').tobytes()))
+
+def _unpack_rows(data):
+    return np.frombuffer(zlib.decompress(data), dtype='<i4').astype(np.int32)
+
+def _preference_id(preference):
+    preference_id = preference.get('_id')
+    return str(preference_id) if preference_id is not None else None
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Get the process-wide taste profile store.
+
+    Returns:
+        ProfileStore: Shared profile store
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ProfileStore()
+        return _store
@@ -0,0 +1,182 @@
+"""
+Opt-in profiling of recommendation jobs, saved as pstats and collapsed stacks.
+"""
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from . import codec
+from . import utils
+
+PROFILING_DIR = os.getenv('PROFILING_DIR', '/app/profiles')
+
+# Percentage of jobs profiled without being asked to
+PROFILING_SAMPLE_PERCENT = float(os.getenv('PROFILING_SAMPLE_PERCENT', 0))
+
+# Number of most recent profiles kept on disk
+PROFILING_KEEP = int(os.getenv('PROFILING_KEEP', 50))
+
+# Seconds between stack samples of the profiled thread
+PROFILING_SAMPLE_INTERVAL = float(os.getenv('PROFILING_SAMPLE_INTERVAL', 0.005))
+
+# File kinds written per profile
+PROFILE_FILES = {'collapsed': '.collapsed', 'pstats': '.pstats', 'json': '.json'}
+
+_PROFILE_ID = re.compile(r'^[0-9TZ]+-[0-9a-f]{8}$')
+
+def sampled():
+    """
+    Decide whether a job is profiled by sampling.
+
+    Returns:
+        bool: True for PROFILING_SAMPLE_PERCENT of the calls
+    """
+    return PROFILING_SAMPLE_PERCENT > 0 and random.random() * 100 < PROFILING_SAMPLE_PERCENT
+
+class StackSampler:
+    """
+    Samples the stack of one thread at a fixed interval and counts each
+    distinct stack, which is what flamegraph tools read.
+
+    cProfile only records caller and callee pairs, so the full stacks of
+    the collapsed format come from this sampler instead.
+    """
+
+    def __init__(self, thread_id, interval=PROFILING_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def collapsed(self):
+        """
+        Returns:
+            str: One 'frame;frame;frame count' line per distinct stack, root first
+        """
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(frames))] += 1
+
+@contextmanager
+def profiled(job, **params):
+    """
+    Profile the calling thread and save the profile once the block exits.
+
+    Args:
+        job (str): Name of the profiled job
+        **params: Job parameters stored with the profile
+
+    Yields:
+        dict: Profile metadata, the block can add entries such as the catalog size
+    """
+    info = {
+        'id': f'{datetime.utcnow():%Y%m%dT%H%M%SZ}-{uuid.uuid4().hex[:8]}',
+        'job': job,
+        'params': params,
+        'startedAt': datetime.utcnow().isoformat() + 'Z'
+    }
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident())
+
+    start = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield info
+    finally:
+        profiler.disable()
+        sampler.stop()
+        info['seconds'] = round(time.perf_counter() - start, 6)
+        info['samples'] = sum(sampler.stacks.values())
+        _save(info, profiler, sampler)
+
+def _save(info, profiler, sampler):
+    try:
+        os.makedirs(PROFILING_DIR, exist_ok=True)
+        profiler.dump_stats(_path(info['id'], 'pstats'))
+        with open(_path(info['id'], 'collapsed'), 'w') as f:
+            f.write(sampler.collapsed())
+        # Metadata is written last, listing only shows complete profiles
+        with open(_path(info['id'], 'json'), 'wb') as f:
+            f.write(codec.dumps(info))
+        _prune()
+        utils.log_event('profile_saved', id=info['id'], job=info['job'], seconds=info['seconds'])
+    except OSError as e:
+        utils.log(f"Could not save profile {info['id']}: {e}")
+
+def _prune():
+    for info in list_profiles()[PROFILING_KEEP:]:
+        for kind in PROFILE_FILES:
+            try:
+                os.remove(_path(info['id'], kind))
+            except OSError:
+                pass
+
+def _path(profile_id, kind):
+    return os.path.join(PROFILING_DIR, profile_id + PROFILE_FILES[kind])
+
+def list_profiles():
+    """
+    List the saved profiles, newest first.
+
+    Returns:
+        list: Metadata of each profile
+    """
+    try:
+        names = os.listdir(PROFILING_DIR)
+    except OSError:
+        return []
+
+    profiles = []
+    for name in sorted(names, reverse=True):
+        if not name.endswith(PROFILE_FILES['json']):
+            continue
+        try:
+            with open(os.path.join(PROFILING_DIR, name), 'rb') as f:
+                profiles.append(codec.loads(f.read()))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def profile_path(profile_id, kind):
+    """
+    Locate a saved profile file.
+
+    Args:
+        profile_id (str): Profile ID from list_profiles
+        kind (str): 'collapsed', 'pstats' or 'json'
+
+    Returns:
+        str: Path of the file, or None if there is no such profile
+    """
+    if kind not in PROFILE_FILES or not _PROFILE_ID.match(profile_id):
+        return None
+    path = _path(profile_id, kind)
+    return path if os.path.exists(path) else None
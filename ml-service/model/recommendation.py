@@ -1,12 +1,248 @@
 """
 Main recommendation generation process.
 """
-from . import feature_extraction
-from . import clustering
+import os
+import time
+import numpy as np
+from . import catalog
+from . import cluster_cache
+from . import jobs
+from . import metrics
+from . import persistence
+from . import profiles
+from . import profiling
+from . import result_cache
+from . import retrieval
 from . import scoring
 from . import utils
 
-def generate_recommendations(db, user_id, questionnaire_id, preferences=None, current_questionnaire=None):
+# Default response deadline of the synchronous recommendation endpoint
+DEADLINE_MS = float(os.getenv('RECOMMENDATION_DEADLINE_MS', 200))
+
+# Longest deadline a client may ask for, longer ones are shortened to it
+MAX_DEADLINE_MS = float(os.getenv('RECOMMENDATION_MAX_DEADLINE_MS', 5000))
+
+# Most recommendations a client may ask for in one response
+MAX_LIMIT = int(os.getenv('RECOMMENDATION_MAX_LIMIT', 100))
+
+# Maximum number of songs scored by the approximate path
+APPROX_CANDIDATE_LIMIT = int(os.getenv('APPROX_CANDIDATE_LIMIT', 5000))
+
+# Songs nearest to the liked songs added to the approximate path's candidates
+APPROX_NEIGHBOR_LIMIT = int(os.getenv('APPROX_NEIGHBOR_LIMIT', 1000))
+
+# Paths that score every candidate worth scoring, their results are cached
+EXACT_PATHS = ('full', 'retrieval')
+
+# Smoothing of the measured full scoring cost per song
+SCORING_COST_SMOOTHING = 0.2
+
+_scoring_cost = {'seconds_per_song': None}
+
+_startup = {'warm_up_seconds': None, 'first_recommendation_seconds': None}
+
+class RecommendationError(Exception):
+    """
+    Raised when recommendations cannot be generated for a request.
+    """
+
+def recommend(db, preferences, current_questionnaire, limit=15, deadline_ms=None, user_id=None,
+              preferences_base=None):
+    """
+    Compute song recommendations without storing them.
+    
+    Full results are cached by catalog version and preferences, so a
+    resubmitted questionnaire returns the earlier result without scoring.
+    On large catalogs a retrieval stage first picks the candidate songs from
+    the user's liked clusters and neighbourhoods (see retrieval.py), and
+    only those are scored. With a deadline, clustering is never fitted in
+    the request: models of an earlier catalog version are updated with the
+    changed songs, models that would need a full fit fall back to popularity
+    ranking while they warm in the background, and when full scoring is not
+    expected to fit in the remaining budget only the clusters holding the
+    user's liked songs and the songs nearest to them are scored.
+    
+    With a user ID, the user's taste profile is brought up to date with the
+    preferences added since their last request and scoring reads the liked
+    and rated songs from it instead of resolving every preference again.
+    The preferences can then also be only the ones added since a known base.
+    
+    Args:
+        db: Database connection
+        preferences: User preferences
+        current_questionnaire: Current questionnaire data
+        limit (int): Number of recommendations to return
+        deadline_ms (float): Time budget in milliseconds (optional)
+        user_id (str): User whose taste profile is used (optional)
+        preferences_base (tuple): (count, last preference ID) of the user's
+            preferences that come before the given ones (optional)
+        
+    Returns:
+        dict: Formatted recommendations, the path used ('full', 'retrieval',
+            'cached', 'candidate_clusters' or 'popularity') and per-stage timings
+            
+    Raises:
+        RecommendationError: If there is no questionnaire or no catalog
+        profiles.StaleDelta: If preferences_base is not where the user's
+            taste profile ends
+    """
+    timer = utils.StageTimer(metrics.observe_stage)
+    
+    if not current_questionnaire:
+        raise RecommendationError("Missing current questionnaire")
+    if preferences_base is not None and user_id is None:
+        raise RecommendationError("Preferences sent as a delta need a user ID")
+    
+    # Extract questionnaire answers
+    answers = current_questionnaire.get('answers', [])
+    
+    # Extract user preferences
+    mood, vibe, discovery = utils.extract_questionnaire_preferences(answers)
+    
+    # Get the catalog feature matrix, refreshed only with changed songs
+    snapshot = catalog.get_store().get_snapshot(db)
+    timer.mark('catalog')
+    
+    if snapshot is None or snapshot.song_count == 0:
+        raise RecommendationError("Song catalog is empty")
+    
+    # Apply only the preferences added since the user's last request
+    profile = None
+    revision = None
+    liked_song_ids, disliked_song_ids = [], []
+    if user_id is not None:
+        profile = profiles.get_store().get(db, user_id, preferences, snapshot, base=preferences_base)
+        revision = profile.revision()
+        timer.mark('profile')
+    if revision is None:
+        liked_song_ids, disliked_song_ids = utils.extract_song_preferences(preferences or [])
+    
+    # Reuse the result of an identical earlier request on the same catalog
+    results = result_cache.get_cache()
+    cache_key = result_cache.fingerprint(
+        snapshot.version, mood, vibe, discovery, liked_song_ids, disliked_song_ids, limit, revision=revision
+    )
+    cached = results.get(cache_key)
+    if cached is not None:
+        timer.mark('result_cache')
+        metrics.RECOMMENDATION_PATHS_TOTAL.inc(path='cached')
+        _record_first_recommendation('cached')
+        return {**cached, 'path': 'cached', 'timings': timer.to_dict()}
+    
+    columns = snapshot.columns
+    if profile is not None:
+        liked_rows, rated_rows, has_likes = profile.liked_rows(), profile.rated_rows(), profile.has_likes
+    else:
+        liked_rows, rated_rows = scoring.resolve_ratings(columns, liked_song_ids, disliked_song_ids)
+        has_likes = bool(liked_song_ids)
+    
+    # Get the weighted features and clusters cached for this weight profile
+    cache = cluster_cache.get_cache()
+    if deadline_ms is None:
+        models = cache.get(snapshot, mood, vibe)
+    else:
+        models = cache.peek(snapshot, mood, vibe)
+    timer.mark('clusters')
+    
+    # Score songs based on user preferences
+    base = scoring.base_scores(columns)
+    if models is None:
+        # Models are still warming, rank unrated songs by popularity and recency
+        path = 'popularity'
+        candidates = columns.valid.copy()
+        candidates[rated_rows] = False
+        candidate_rows = np.nonzero(candidates)[0]
+        scores = base[candidate_rows]
+    else:
+        allowed = None
+        cluster_liked_counts = None
+        if profile is not None:
+            cluster_liked_counts, _ = profiles.get_store().cluster_like_counts(profile, models)
+        
+        # Large catalogs are narrowed down to a candidate budget before scoring
+        if retrieval.applies(len(columns.valid)):
+            path = 'retrieval'
+            scored_songs = retrieval.RETRIEVAL_CANDIDATE_LIMIT
+        else:
+            path = 'full'
+            scored_songs = len(columns.valid)
+        
+        if deadline_ms is not None and not _fits_budget(scored_songs, deadline_ms / 1000 - timer.elapsed()):
+            path = 'candidate_clusters'
+            allowed = scoring.candidate_cluster_mask(models.clusters, liked_rows, base, APPROX_CANDIDATE_LIMIT)
+            if len(liked_rows):
+                # Add the liked songs' neighbourhoods, which the popularity cut may drop
+                allowed |= scoring.candidate_neighbor_mask(
+                    models.neighbor_index(), models.weighted_features, liked_rows, APPROX_NEIGHBOR_LIMIT
+                )
+        elif path == 'retrieval':
+            allowed = retrieval.retrieve_candidates(
+                models, base, liked_rows, discovery, cluster_liked_counts=cluster_liked_counts
+            )
+            scored_songs = int(np.count_nonzero(allowed))
+            timer.mark('retrieval')
+        
+        candidate_rows, scores = scoring.score_rows(
+            models.weighted_features, models.clusters, columns, liked_rows, rated_rows, has_likes,
+            discovery, base=base, allowed=allowed, cluster_liked_counts=cluster_liked_counts,
+            cluster_counts=models.cluster_song_counts(columns.valid)
+        )
+    scoring_seconds = timer.mark('score_songs')
+    if path in EXACT_PATHS:
+        _record_scoring_cost(scoring_seconds / max(1, scored_songs))
+    
+    # Rank and select top recommendations
+    top_recommendations = scoring.rank_candidates(
+        candidate_rows, scores, columns, limit=limit
+    )
+    timer.mark('rank_recommendations')
+    
+    # Load names, artists and images only for the selected songs
+    details = catalog.load_song_details(db, [song_id for song_id, _ in top_recommendations])
+    top_recommendations = [
+        (song_id, {**data, 'song': details.get(song_id, data['song'])})
+        for song_id, data in top_recommendations
+    ]
+    timer.mark('song_details')
+    metrics.RECOMMENDATION_PATHS_TOTAL.inc(path=path)
+    
+    result = {
+        'recommendations': scoring.format_recommendations(top_recommendations),
+        'path': path,
+        'catalogSongs': snapshot.song_count
+    }
+    # Fallback paths are not cached so a later request can get the full result
+    if path in EXACT_PATHS:
+        results.put(cache_key, result)
+    _record_first_recommendation(path)
+    
+    return {**result, 'timings': timer.to_dict()}
+
+def _fits_budget(song_count, remaining_seconds):
+    seconds_per_song = _scoring_cost['seconds_per_song']
+    if seconds_per_song is None:
+        return True
+    return seconds_per_song * song_count <= remaining_seconds
+
+def _record_scoring_cost(seconds_per_song):
+    previous = _scoring_cost['seconds_per_song']
+    if previous is None:
+        _scoring_cost['seconds_per_song'] = seconds_per_song
+    else:
+        _scoring_cost['seconds_per_song'] = (
+            (1 - SCORING_COST_SMOOTHING) * previous + SCORING_COST_SMOOTHING * seconds_per_song
+        )
+
+def _record_first_recommendation(path):
+    if _startup['first_recommendation_seconds'] is not None:
+        return
+    seconds = time.monotonic() - metrics.START_TIME
+    _startup['first_recommendation_seconds'] = seconds
+    metrics.FIRST_RECOMMENDATION_SECONDS.set(round(seconds, 3))
+    utils.log_event('first_recommendation', seconds=round(seconds, 3), path=path)
+
+def generate_recommendations(db, user_id, questionnaire_id, preferences=None, current_questionnaire=None,
+                             profiled=False, preferences_base=None):
     """
     Generate song recommendations for a user based on their preferences and listening history.
     
@@ -16,59 +252,113 @@ def generate_recommendations(db, user_id, questionnaire_id, preferences=None, cu
         questionnaire_id: Questionnaire ID
         preferences: User preferences (optional)
         current_questionnaire: Current questionnaire data (optional)
+        profiled (bool): Run under the profiler, which also happens for a
+            sampled share of jobs (optional)
+        preferences_base (tuple): (count, last preference ID) preceding the
+            given preferences in the user's taste profile (optional)
         
     Returns:
-        dict: Status of recommendation generation
+        bool: True once the recommendation document is queued for writing
+        
+    Raises:
+        Exception: Whatever failed, so the job reports it as its error
     """
+    if not (profiled or profiling.sampled()):
+        return _generate(db, user_id, questionnaire_id, preferences, current_questionnaire, preferences_base, {})
+    
+    answers = (current_questionnaire or {}).get('answers', [])
+    mood, vibe, discovery = utils.extract_questionnaire_preferences(answers)
+    with profiling.profiled(
+        'generate_recommendations', userId=user_id, questionnaireId=questionnaire_id,
+        mood=mood, vibe=vibe, discovery=discovery, preferences=len(preferences or [])
+    ) as info:
+        return _generate(db, user_id, questionnaire_id, preferences, current_questionnaire, preferences_base, info)
+
+def _generate(db, user_id, questionnaire_id, preferences, current_questionnaire, preferences_base, details):
     try:
-        # Extract questionnaire answers
-        answers = current_questionnaire.get('answers', [])
-        
-        # Extract user preferences
-        mood, vibe, discovery = utils.extract_questionnaire_preferences(answers)
-        
-        # Extract liked and disliked song IDs
-        liked_song_ids, disliked_song_ids = utils.extract_song_preferences(preferences)
-        
-        # Fetch all songs from database
-        all_songs = list(db.songs.find({}))
-        song_count = len(all_songs)
-        
-        if song_count == 0:
-            return False
-        
-        # Extract features from songs
-        features_array, song_map = feature_extraction.extract_features(all_songs)
-        
-        if features_array is None:
-            return False
-        
-        # Apply preference weights to features
-        weighted_features = feature_extraction.apply_preference_weights(features_array, mood, vibe)
-        
-        # Cluster the songs
-        clusters, kmeans_model = clustering.cluster_songs(weighted_features, song_count)
-        
-        # Score songs based on user preferences
-        song_scores = scoring.score_songs(
-            weighted_features, clusters, kmeans_model, song_map,
-            liked_song_ids, disliked_song_ids, discovery
+        result = recommend(
+            db, preferences, current_questionnaire, limit=15, user_id=user_id, preferences_base=preferences_base
         )
         
-        # Rank and select top recommendations
-        top_recommendations = scoring.rank_recommendations(song_scores, limit=15)
-        
-        # Format recommendations for storage
-        formatted_recommendations = scoring.format_recommendations(top_recommendations)
-        
         # Create recommendation document
         recommendation_doc = scoring.create_recommendation_document(
-            user_id, questionnaire_id, formatted_recommendations
+            user_id, questionnaire_id, persistence.compact_recommendations(result['recommendations'])
         )
         
-        # Save recommendations to database
-        db.recommendations.insert_one(recommendation_doc)
+        # Queue the document, it is written with others in one bulk insert
+        # and the job reports once it is
+        persistence.get_writer().add(
+            db.recommendations, [recommendation_doc], on_persisted=jobs.persisted_callback()
+        )
         
+        details.update(
+            status='succeeded', path=result['path'], catalogSongs=result['catalogSongs'], timings=result['timings']
+        )
+        utils.log_event(
+            'recommendation_job', status='succeeded', userId=user_id, questionnaireId=questionnaire_id,
+            path=result['path'], catalogSongs=result['catalogSongs'], timings=result['timings']
+        )
         return True
     except Exception as e:
-        return False 
\ No newline at end of file
+        details.update(status='failed', error=repr(e))
+        utils.log_event(
+            'recommendation_job', status='failed', userId=user_id, questionnaireId=questionnaire_id,
+            error=repr(e)
+        )
+        raise
+
+def load_persisted():
+    """
+    Memory-map the persisted catalog and cluster models, without querying
+    MongoDB or fitting anything, so processes forked afterwards share them.
+    """
+    snapshot = catalog.get_store().load_persisted()
+    if snapshot is None:
+        return
+    loaded = cluster_cache.get_cache().load_persisted(snapshot)
+    utils.log(f"Loaded persisted catalog version {snapshot.version} and {loaded} cluster models")
+
+def warm_up(db):
+    """
+    Load the catalog and fit the cluster models for every weight profile.
+    
+    Args:
+        db: Database connection
+    """
+    start = time.perf_counter()
+    try:
+        snapshot = catalog.get_store().get_snapshot(db)
+        if snapshot is not None:
+            cluster_cache.get_cache().warm(snapshot)
+    except Exception as e:
+        utils.log(f"Warm-up failed: {e}")
+        return
+    
+    seconds = time.perf_counter() - start
+    _startup['warm_up_seconds'] = seconds
+    metrics.WARM_UP_SECONDS.set(round(seconds, 3))
+    utils.log_event(
+        'warm_up', seconds=round(seconds, 3), catalogSongs=snapshot.song_count if snapshot else 0
+    )
+
+def readiness():
+    """
+    Report whether the cached catalog and cluster models can serve requests.
+    
+    Only in-memory state is checked, so this is cheap enough for frequent probes.
+    
+    Returns:
+        dict: Readiness flag, cached versions and startup timings
+    """
+    snapshot = catalog.get_store().snapshot
+    models_version = cluster_cache.get_cache().warm_version
+    return {
+        'ready': snapshot is not None and models_version is not None,
+        'catalogVersion': snapshot.version if snapshot is not None else None,
+        'modelsVersion': models_version,
+        'warmUpSeconds': _round(_startup['warm_up_seconds']),
+        'firstRecommendationSeconds': _round(_startup['first_recommendation_seconds'])
+    }
+
+def _round(seconds):
+    return round(seconds, 3) if seconds is not None else None
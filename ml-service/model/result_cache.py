@@ -0,0 +1,117 @@
+"""
+LRU cache of recommendation results keyed by catalog version and user preferences.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from . import metrics
+
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 1024))
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL_SECONDS', 600))
+
+def fingerprint(version, mood, vibe, discovery, liked_song_ids, disliked_song_ids, limit, revision=None):
+    """
+    Build the cache key of a recommendation request.
+
+    Args:
+        version (int): Catalog version the result is computed on
+        mood (str): User's mood preference
+        vibe (str): User's vibe preference
+        discovery (str): User's discovery preference
+        liked_song_ids (list): List of liked song IDs
+        disliked_song_ids (list): List of disliked song IDs
+        limit (int): Number of recommendations
+        revision (str): Taste profile revision standing in for the song
+            IDs, which are then not hashed (optional)
+
+    Returns:
+        tuple: Cache key
+    """
+    if revision is not None:
+        return (version, mood, vibe, discovery, limit, 'profile:' + revision)
+
+    digest = hashlib.sha1()
+    for song_ids in (liked_song_ids, disliked_song_ids):
+        for song_id in sorted(set(map(str, song_ids))):
+            digest.update(song_id.encode())
+            digest.update(b'\0')
+        digest.update(b'\1')
+    return (version, mood, vibe, discovery, limit, digest.hexdigest())
+
+class ResultCache:
+    """
+    Recommendation results evicted by least recent use and by age.
+
+    Keys include the catalog version, so a catalog refresh makes older
+    entries unreachable and they age out through the LRU order.
+    """
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Look up a cached result.
+
+        Args:
+            key (tuple): Key from fingerprint
+
+        Returns:
+            dict: The cached result, or None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        metrics.RESULT_CACHE_TOTAL.inc(result='hit' if entry is not None else 'miss')
+        return entry[1] if entry is not None else None
+
+    def put(self, key, result):
+        """
+        Store a result, evicting the least recently used entries over the size limit.
+
+        Args:
+            key (tuple): Key from fingerprint
+            result (dict): Result to cache
+        """
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.monotonic(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def size(self):
+        """
+        Returns:
+            int: Number of cached results
+        """
+        with self.lock:
+            return len(self.entries)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Get the process-wide result cache.
+
+    Returns:
+        ResultCache: Shared result cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
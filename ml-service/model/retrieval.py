@@ -0,0 +1,121 @@
+"""
+Candidate retrieval that narrows the catalog down before full scoring.
+"""
+import os
+import zlib
+import numpy as np
+from . import metrics
+
+# Catalogs smaller than this are scored in full, retrieval would save little
+RETRIEVAL_MIN_SONGS = int(os.getenv('RETRIEVAL_MIN_SONGS', 50000))
+
+# Maximum number of songs passed on to full scoring
+RETRIEVAL_CANDIDATE_LIMIT = int(os.getenv('RETRIEVAL_CANDIDATE_LIMIT', 20000))
+
+# Most popular and recent songs always retrieved, they can rank on base score alone
+RETRIEVAL_POPULAR_LIMIT = int(os.getenv('RETRIEVAL_POPULAR_LIMIT', 500))
+
+# Shares of the candidate budget for the liked songs' neighbourhoods and for
+# the exploration sample of clusters without likes, per discovery setting.
+# The liked clusters get what is left.
+DISCOVERY_SHARES = {
+    'similar': (0.2, 0.0),
+    'balanced': (0.1, 0.0),
+    'explore': (0.05, 0.1),
+}
+
+# Clusters smaller than this keep part of the neutral prior in scoring
+# (see scoring.score_matrix), so their songs can rank without likes
+SMALL_CLUSTER_SIZE = 5
+
+def applies(song_count):
+    """
+    Whether a catalog is large enough to retrieve candidates before scoring.
+
+    Args:
+        song_count (int): Number of songs in the catalog
+
+    Returns:
+        bool: True if retrieval runs before scoring
+    """
+    return song_count >= RETRIEVAL_MIN_SONGS
+
+def retrieve_candidates(models, base, liked_rows, discovery, limit=RETRIEVAL_CANDIDATE_LIMIT,
+                        cluster_liked_counts=None):
+    """
+    Choose the songs worth scoring for a user.
+
+    Songs come from four sources, so the cost of scoring follows the
+    candidate budget instead of the catalog size:
+        - the most popular and recent songs, and the songs of very small clusters
+        - the songs nearest to each liked song
+        - the clusters with the highest share of liked songs, whole while
+          they fit and by base score for the last one
+        - for 'explore', a random sample of the clusters without likes
+
+    The sample is seeded by the liked songs, so the same request retrieves
+    the same songs.
+
+    Args:
+        models (ClusterModels): Models the songs are clustered by
+        base (np.array): Base scores from scoring.base_scores
+        liked_rows (np.array): Feature indices of the liked songs
+        discovery (str): User's discovery preference
+        limit (int): Maximum number of songs to retrieve
+        cluster_liked_counts (np.array): Liked songs per cluster, counted
+            from liked_rows when not given (optional)
+
+    Returns:
+        np.array: Mask of the songs to score
+    """
+    clusters = np.asarray(models.clusters)
+    members, offsets = models.cluster_members()
+    sizes = np.diff(offsets)
+    if cluster_liked_counts is None:
+        cluster_liked_counts = np.bincount(clusters[liked_rows], minlength=len(sizes))
+    liked_counts = np.asarray(cluster_liked_counts)[:len(sizes)]
+
+    allowed = np.zeros(len(clusters), dtype=bool)
+    neighbor_share, explore_share = DISCOVERY_SHARES.get(discovery, DISCOVERY_SHARES['balanced'])
+
+    # Songs that score well without any likes
+    popular_limit = RETRIEVAL_POPULAR_LIMIT if len(liked_rows) else limit
+    allowed[_top_rows(np.arange(len(base)), base, popular_limit)] = True
+    for cluster in np.flatnonzero(sizes < SMALL_CLUSTER_SIZE).tolist():
+        allowed[members[offsets[cluster]:offsets[cluster + 1]]] = True
+
+    if len(liked_rows):
+        neighbor_limit = int(limit * neighbor_share)
+        if neighbor_limit:
+            rows, _ = models.neighbor_index().nearest(
+                models.weighted_features[liked_rows], neighbor_limit + len(liked_rows)
+            )
+            allowed[rows] = True
+
+        # Clusters in order of their liked share, as cluster affinity scores them
+        cluster_budget = limit - int(limit * explore_share) - int(np.count_nonzero(allowed))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            liked_share = np.where(sizes > 0, liked_counts / sizes, 0)
+        for cluster in np.flatnonzero(liked_counts)[np.argsort(-liked_share[liked_counts > 0], kind='stable')]:
+            if cluster_budget <= 0:
+                break
+            rows = members[offsets[cluster]:offsets[cluster + 1]]
+            if len(rows) > cluster_budget:
+                rows = _top_rows(rows, base[rows], cluster_budget)
+            allowed[rows] = True
+            cluster_budget -= len(rows)
+
+    explore_limit = int(limit * explore_share)
+    if explore_limit:
+        unliked = liked_counts == 0
+        seed = zlib.crc32(np.asarray(liked_rows, dtype=np.int64).tobytes())
+        sample = np.random.default_rng(seed).choice(len(clusters), min(len(clusters), explore_limit * 2), replace=False)
+        allowed[sample[unliked[clusters[sample]]][:explore_limit]] = True
+
+    metrics.RETRIEVED_CANDIDATES.observe(int(np.count_nonzero(allowed)), discovery=discovery)
+    return allowed
+
+def _top_rows(rows, scores, limit):
+    if len(rows) <= limit:
+        return rows
+    return rows[np.argpartition(-scores, limit - 1)[:limit]]
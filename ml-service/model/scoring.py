@@ -3,8 +3,504 @@ Song scoring and recommendation generation.
 """
 from datetime import datetime
 import numpy as np
+from . import neighbors
 
-def score_songs(features_array, clusters, kmeans_model, song_map, 
+# Feature similarity is worth SIMILARITY_POINTS minus SIMILARITY_SLOPE times
+# the distance to the closest liked songs
+SIMILARITY_POINTS = 30
+SIMILARITY_SLOPE = 60
+
+# Song documents converted to columns at once
+COLUMN_BATCH_SIZE = 10000
+
+class SongColumns:
+    """
+    Compact per-song metadata used for scoring and ranking, in feature row order.
+    
+    Spotify IDs are stored as one fixed-width byte string array with a sorted
+    order for lookups, popularity and release year as small integers, and
+    artist IDs interned into integer CSR arrays. Display fields are not kept,
+    they are loaded for the selected songs only.
+    """
+    __slots__ = ('song_ids', 'id_order', 'valid', 'popularity', 'release_years',
+                 'artist_offsets', 'artist_values', 'artist_keys')
+
+    def __init__(self, song_ids, valid, popularity, release_years,
+                 artist_offsets, artist_values, artist_keys):
+        self.song_ids = song_ids
+        self.id_order = np.argsort(song_ids, kind='stable').astype(np.int32)
+        self.valid = valid
+        self.popularity = popularity
+        self.release_years = release_years
+        self.artist_offsets = artist_offsets
+        self.artist_values = artist_values
+        self.artist_keys = artist_keys
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def song_id(self, row):
+        """
+        Returns:
+            str: Spotify ID of a row, or None if the song has none
+        """
+        return self.song_ids[row].decode() or None
+
+    def lookup(self, song_ids):
+        """
+        Find the rows of Spotify IDs.
+        
+        Args:
+            song_ids (list): Spotify IDs
+            
+        Returns:
+            np.array: Row of each ID, or -1 if it is not in the catalog
+        """
+        keys = [_id_key(song_id) for song_id in song_ids]
+        rows = np.full(len(keys), -1, dtype=np.intp)
+        # Keys longer than the stored width cannot match and would be truncated
+        usable = [i for i, key in enumerate(keys) if key and len(key) <= self.song_ids.itemsize]
+        if not usable or len(self.song_ids) == 0:
+            return rows
+        
+        wanted = np.array([keys[i] for i in usable], dtype=self.song_ids.dtype)
+        positions = np.minimum(
+            np.searchsorted(self.song_ids, wanted, sorter=self.id_order), len(self.song_ids) - 1
+        )
+        found = self.id_order[positions]
+        hit = self.song_ids[found] == wanted
+        rows[np.array(usable)[hit]] = found[hit]
+        return rows
+
+    def song(self, row):
+        """
+        Minimal song document of a row, standing in when display fields are not loaded.
+        
+        Returns:
+            dict: Song document with the Spotify ID, popularity and artist IDs
+        """
+        artists = self.artist_values[self.artist_offsets[row]:self.artist_offsets[row + 1]]
+        return {
+            'spotifyId': self.song_id(row),
+            'popularity': int(self.popularity[row]),
+            'artists': [{'id': self.artist_keys[value].decode()} for value in artists.tolist()]
+        }
+
+    def merge(self, rows, songs):
+        """
+        Build the columns of a changed catalog.
+        
+        Args:
+            rows (list): Rows replaced by the first len(rows) songs
+            songs (list): Song documents of the replaced rows followed by
+                the songs appended as new rows
+            
+        Returns:
+            SongColumns: Columns with the rows replaced and the songs appended
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        changed = build_song_columns(songs, artist_keys=self.artist_keys)
+        n_replaced = len(rows)
+        
+        def combine(column, changed_column):
+            merged = np.concatenate([column, changed_column[n_replaced:]])
+            merged[rows] = changed_column[:n_replaced]
+            return merged
+        
+        # Gather each row's artists from the old or the changed CSR arrays
+        lengths = combine(np.diff(self.artist_offsets), np.diff(changed.artist_offsets))
+        starts = combine(self.artist_offsets[:-1], changed.artist_offsets[:-1] + len(self.artist_values))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        values = np.concatenate([self.artist_values, changed.artist_values])[gather]
+        
+        return SongColumns(
+            song_ids=combine(self.song_ids, changed.song_ids),
+            valid=combine(self.valid, changed.valid),
+            popularity=combine(self.popularity, changed.popularity),
+            release_years=combine(self.release_years, changed.release_years),
+            artist_offsets=offsets,
+            artist_values=values.astype(np.int32),
+            artist_keys=changed.artist_keys
+        )
+
+def _id_key(song_id):
+    return song_id.encode() if isinstance(song_id, str) else b''
+
+def parse_release_year(song):
+    """
+    Parse the release year of a song's album.
+    
+    Args:
+        song (dict): Song document
+        
+    Returns:
+        float: Release year, or NaN if missing or unparsable
+    """
+    try:
+        release_date = datetime.fromisoformat(song['album']['releaseDate'].replace('Z', '+00:00'))
+        return float(release_date.year)
+    except (KeyError, ValueError, TypeError, AttributeError):
+        return np.nan
+
+def build_song_columns(songs, artist_keys=None):
+    """
+    Build the scoring columns for song documents.
+    
+    Args:
+        songs (iterable): Song documents in feature row order
+        artist_keys (np.array): Artist IDs already interned, kept at their
+            positions so artist values stay comparable (optional)
+        
+    Returns:
+        SongColumns: Columns in feature row order
+    """
+    builder = SongColumnsBuilder(artist_keys)
+    batch = []
+    for song in songs:
+        batch.append(song)
+        if len(batch) >= COLUMN_BATCH_SIZE:
+            builder.add(batch)
+            batch = []
+    builder.add(batch)
+    return builder.build()
+
+class SongColumnsBuilder:
+    """
+    Builds SongColumns from song documents arriving in batches, so the
+    documents of a whole catalog never have to be held at once.
+    """
+    
+    def __init__(self, artist_keys=None):
+        self.parts = []
+        self.artist_index = {}
+        if artist_keys is not None:
+            self.artist_index = {key.decode(): i for i, key in enumerate(artist_keys.tolist())}
+    
+    def add(self, songs):
+        """
+        Convert the next batch of song documents, in feature row order.
+        
+        Args:
+            songs (list): Song documents
+        """
+        song_ids = np.array([_id_key(song.get('spotifyId')) for song in songs], dtype=bytes)
+        
+        popularity = np.array(
+            [song.get('popularity') for song in songs], dtype=float
+        )
+        popularity[np.isnan(popularity)] = 50
+        
+        # Unknown release years are stored as 0
+        release_years = np.array([parse_release_year(song) for song in songs], dtype=float)
+        release_years[np.isnan(release_years)] = 0
+        
+        artist_offsets, artist_values = intern_artists(songs, self.artist_index)
+        self.parts.append((
+            song_ids,
+            np.clip(np.rint(popularity), 0, 100).astype(np.uint8),
+            release_years.astype(np.int16),
+            artist_offsets,
+            artist_values
+        ))
+    
+    def build(self):
+        """
+        Returns:
+            SongColumns: Columns of every song added, in the order added
+        """
+        parts = self.parts or [(np.array([], dtype=bytes), np.array([], dtype=np.uint8),
+                                np.array([], dtype=np.int16), np.zeros(1, dtype=np.int64),
+                                np.array([], dtype=np.int32))]
+        song_ids, popularity, release_years, offsets, values = zip(*parts)
+        
+        # Each part's offsets start at zero, shift them past the earlier parts' values
+        shifts = np.cumsum([0] + [len(part) for part in values[:-1]])
+        artist_offsets = np.concatenate(
+            [part[:-1] + shift for part, shift in zip(offsets, shifts)] + [[shifts[-1] + len(values[-1])]]
+        ).astype(np.int64)
+        song_ids = np.concatenate(song_ids)
+        self.parts = []
+        
+        return SongColumns(
+            song_ids=song_ids,
+            valid=song_ids != b'',
+            popularity=np.concatenate(popularity),
+            release_years=np.concatenate(release_years),
+            artist_offsets=artist_offsets,
+            artist_values=np.concatenate(values).astype(np.int32),
+            artist_keys=np.array([key.encode() for key in self.artist_index], dtype=bytes)
+        )
+
+def resolve_ratings(columns, liked_song_ids, disliked_song_ids):
+    """
+    Map a user's liked and disliked song IDs to catalog rows.
+    
+    Args:
+        columns (SongColumns): Scoring columns for the songs
+        liked_song_ids (list): List of liked song IDs
+        disliked_song_ids (list): List of disliked song IDs
+        
+    Returns:
+        tuple: (liked_rows, rated_rows) arrays of feature indices
+    """
+    liked_rows = _rows_for(columns, liked_song_ids)
+    disliked_rows = _rows_for(columns, disliked_song_ids)
+    return liked_rows, np.union1d(liked_rows, disliked_rows)
+
+def _rows_for(columns, song_ids):
+    rows = columns.lookup(list(set(song_ids)))
+    return np.unique(rows[rows >= 0])
+
+def base_scores(columns):
+    """
+    Compute the popularity and recency part of the score, shared by all users.
+    
+    Args:
+        columns (SongColumns): Scoring columns for the songs
+        
+    Returns:
+        np.array: Base score for every feature row
+    """
+    # Base score is initially from popularity and recency
+    base_score = columns.popularity / 100.0
+    has_year = columns.release_years > 0
+    years_old = np.maximum(0, datetime.now().year - columns.release_years[has_year])
+    recency_factor = 1.0 / (1.0 + (years_old / 10.0))
+    base_score[has_year] = 0.7 * base_score[has_year] + 0.3 * recency_factor
+    return base_score * 40
+
+def score_matrix(features_array, clusters, valid, base, liked_rows, rated_rows, has_likes, discovery,
+                 rows=None, cluster_liked_counts=None, cluster_counts=None):
+    """
+    Score every song, or a subset of them, for several users at once.
+    
+    Args:
+        features_array (np.array): Normalized and weighted feature array
+        clusters (np.array): Array of cluster assignments
+        valid (np.array): Mask of songs with a Spotify ID
+        base (np.array): Shared base scores from base_scores
+        liked_rows (list): Liked feature indices, one array per user
+        rated_rows (list): Liked and disliked feature indices, one array per user
+        has_likes (list): Whether each user liked any song at all
+        discovery (list): Discovery preference of each user
+        rows (np.array): Sorted feature indices to score, all songs when not
+            given, so the cost follows the candidates instead of the catalog (optional)
+        cluster_liked_counts (np.array): Liked songs per user and cluster,
+            counted from liked_rows when not given (optional)
+        cluster_counts (np.array): Valid songs per cluster over the whole
+            catalog, counted from valid when not given (optional)
+        
+    Returns:
+        tuple: (scores, candidates) user-by-song matrices over rows where:
+            - scores are the non-negative scores
+            - candidates mark the valid songs each user has not rated
+    """
+    clusters = np.asarray(clusters)
+    n_users = len(liked_rows)
+    
+    # Song counts per cluster and like counts per user and cluster
+    if cluster_counts is None:
+        n_clusters = int(clusters.max()) + 1 if len(clusters) else 0
+        cluster_counts = np.bincount(clusters[valid], minlength=n_clusters)
+    n_clusters = len(cluster_counts)
+    if cluster_liked_counts is None:
+        all_liked = np.concatenate(liked_rows).astype(np.intp) if n_users else np.empty(0, dtype=np.intp)
+        user_index = np.repeat(np.arange(n_users), [len(user_rows) for user_rows in liked_rows])
+        cluster_liked_counts = np.zeros((n_users, n_clusters))
+        np.add.at(cluster_liked_counts, (user_index, clusters[all_liked]), 1)
+    else:
+        # Counts may cover clusters no song is labelled with anymore
+        cluster_liked_counts = np.asarray(cluster_liked_counts, dtype=float)[:, :n_clusters]
+    
+    # Every per-user array below covers the scored rows only
+    row_clusters, row_valid, row_base = clusters, valid, base
+    if rows is not None:
+        row_clusters, row_valid, row_base = clusters[rows], valid[rows], base[rows]
+    
+    candidates = np.repeat(row_valid[None, :], n_users, axis=0)
+    for user, user_rated in enumerate(rated_rows):
+        candidates[user, _positions(rows, user_rated)] = False
+    
+    # Factor 1: Cluster affinity, weighted towards a neutral prior for small clusters
+    confidence = np.minimum(1.0, cluster_counts / 5.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cluster_liked_ratio = (confidence * cluster_liked_counts / cluster_counts) + (1 - confidence) * 0.5
+    scores = cluster_liked_ratio[:, row_clusters]
+    scores *= 50
+    scores += row_base[None, :]
+    
+    for user in range(n_users):
+        user_scores = scores[user]
+        
+        # Factor 2: Feature similarity to the closest liked songs in the same cluster.
+        # Clusters without liked songs keep the default distance, worth nothing.
+        if has_likes[user]:
+            user_liked = np.asarray(liked_rows[user], dtype=np.intp)
+            liked_clusters = clusters[user_liked]
+            candidate_positions = np.nonzero(candidates[user])[0]
+            candidate_clusters = row_clusters[candidate_positions]
+            candidate_rows = candidate_positions if rows is None else rows[candidate_positions]
+            
+            for cluster_id in np.nonzero(cluster_liked_counts[user])[0]:
+                in_cluster = candidate_clusters == cluster_id
+                if not in_cluster.any():
+                    continue
+                avg_distance = neighbors.nearest_liked_distance(
+                    features_array[candidate_rows[in_cluster]],
+                    features_array[user_liked[liked_clusters == cluster_id]]
+                )
+                user_scores[candidate_positions[in_cluster]] += np.maximum(
+                    0, SIMILARITY_POINTS - (avg_distance * SIMILARITY_SLOPE)
+                )
+        
+        # Factor 3: Discovery preference adjustment, looked up per cluster
+        # instead of expanding the counts to every song
+        cluster_has_likes = cluster_liked_counts[user] > 0
+        if discovery[user] == 'similar':
+            # Boost songs in clusters with liked songs
+            user_scores[cluster_has_likes[row_clusters]] *= 1.3
+        elif discovery[user] == 'explore':
+            # Boost lightly explored clusters with at least one like
+            user_scores[((cluster_counts < 3) & cluster_has_likes)[row_clusters]] *= 1.2
+    
+    np.maximum(scores, 0, out=scores)
+    return scores, candidates
+
+def _positions(rows, wanted):
+    """
+    Positions of feature indices within the sorted scored rows, dropping
+    the ones not scored.
+    """
+    wanted = np.asarray(wanted, dtype=np.intp)
+    if rows is None:
+        return wanted
+    positions = np.searchsorted(rows, wanted)
+    found = positions < len(rows)
+    found[found] = rows[positions[found]] == wanted[found]
+    return positions[found]
+
+def score_array(features_array, clusters, columns, liked_song_ids, disliked_song_ids, discovery,
+                base=None, allowed=None):
+    """
+    Score every unrated song based on its cluster and the user's preferences.
+    
+    Args:
+        features_array (np.array): Normalized and weighted feature array
+        clusters (np.array): Array of cluster assignments
+        columns (SongColumns): Scoring columns for the songs
+        liked_song_ids (list): List of liked song IDs
+        disliked_song_ids (list): List of disliked song IDs
+        discovery (str): User's discovery preference
+        base (np.array): Precomputed base scores (optional)
+        allowed (np.array): Mask restricting which songs are scored (optional)
+        
+    Returns:
+        tuple: (candidate_rows, scores) where:
+            - candidate_rows are the feature indices of the unrated songs
+            - scores are their non-negative scores
+    """
+    liked_rows, rated_rows = resolve_ratings(columns, liked_song_ids, disliked_song_ids)
+    return score_rows(
+        features_array, clusters, columns, liked_rows, rated_rows, bool(liked_song_ids), discovery,
+        base=base, allowed=allowed
+    )
+
+def score_rows(features_array, clusters, columns, liked_rows, rated_rows, has_likes, discovery,
+               base=None, allowed=None, cluster_liked_counts=None, cluster_counts=None):
+    """
+    Score every unrated song for a user whose ratings are already resolved to rows.
+    
+    With an allowed mask only the allowed songs are scored, the others are
+    never expanded into per-song arrays.
+    
+    Args:
+        features_array (np.array): Normalized and weighted feature array
+        clusters (np.array): Array of cluster assignments
+        columns (SongColumns): Scoring columns for the songs
+        liked_rows (np.array): Feature indices of the liked songs
+        rated_rows (np.array): Feature indices of the liked and disliked songs
+        has_likes (bool): Whether the user liked any song at all
+        discovery (str): User's discovery preference
+        base (np.array): Precomputed base scores (optional)
+        allowed (np.array): Mask restricting which songs are scored (optional)
+        cluster_liked_counts (np.array): Liked songs per cluster (optional)
+        cluster_counts (np.array): Valid songs per cluster (optional)
+        
+    Returns:
+        tuple: (candidate_rows, scores) as returned by score_array
+    """
+    if base is None:
+        base = base_scores(columns)
+    if cluster_liked_counts is not None:
+        cluster_liked_counts = np.asarray(cluster_liked_counts)[None, :]
+    rows = np.flatnonzero(allowed) if allowed is not None else None
+    
+    scores, candidates = score_matrix(
+        features_array, clusters, columns.valid, base,
+        [liked_rows], [rated_rows], [has_likes], [discovery], rows=rows,
+        cluster_liked_counts=cluster_liked_counts, cluster_counts=cluster_counts
+    )
+    
+    positions = np.nonzero(candidates[0])[0]
+    candidate_rows = positions if rows is None else rows[positions]
+    return candidate_rows, scores[0, positions]
+
+def candidate_cluster_mask(clusters, liked_rows, base, limit):
+    """
+    Restrict scoring to the clusters holding the user's liked songs.
+    
+    Used as a cheaper approximate path: only songs in those clusters are
+    kept, and at most `limit` of them with the best base scores.
+    
+    Args:
+        clusters (np.array): Array of cluster assignments
+        liked_rows (np.array): Feature indices of the liked songs
+        base (np.array): Base scores from base_scores
+        limit (int): Maximum number of songs to keep
+        
+    Returns:
+        np.array: Mask of the songs to score
+    """
+    clusters = np.asarray(clusters)
+    if len(liked_rows):
+        rows = np.nonzero(np.isin(clusters, np.unique(clusters[liked_rows])))[0]
+    else:
+        rows = np.arange(len(clusters))
+    
+    if len(rows) > limit:
+        rows = rows[np.argpartition(-base[rows], limit - 1)[:limit]]
+    
+    allowed = np.zeros(len(clusters), dtype=bool)
+    allowed[rows] = True
+    return allowed
+
+def candidate_neighbor_mask(index, features_array, liked_rows, limit):
+    """
+    Restrict scoring to the songs closest to the user's liked songs.
+    
+    Complements candidate_cluster_mask on the approximate path: the
+    feature similarity factor favours songs near liked songs even when
+    they are not popular enough to pass its cut. The liked songs
+    themselves are pulled in too and dropped later as rated, so `limit`
+    unrated songs remain.
+    
+    Args:
+        index (NeighborIndex): Index over features_array
+        features_array (np.array): Normalized and weighted feature array
+        liked_rows (np.array): Feature indices of the liked songs
+        limit (int): Maximum number of songs to keep
+        
+    Returns:
+        np.array: Mask of the songs to score
+    """
+    rows, _ = index.nearest(features_array[liked_rows], limit + len(liked_rows))
+    allowed = np.zeros(len(features_array), dtype=bool)
+    allowed[rows] = True
+    return allowed
+
+def score_songs(features_array, clusters, kmeans_model, columns,
                 liked_song_ids, disliked_song_ids, discovery):
     """
     Score each song based on liked/disliked songs in its cluster and user preferences.
@@ -13,7 +509,7 @@ def score_songs(features_array, clusters, kmeans_model, song_map,
         features_array (np.array): Normalized and weighted feature array
         clusters (np.array): Array of cluster assignments
         kmeans_model (KMeans): Fitted KMeans model
-        song_map (dict): Mapping from feature indices to song documents
+        columns (SongColumns): Scoring columns for the songs
         liked_song_ids (list): List of liked song IDs
         disliked_song_ids (list): List of disliked song IDs
         discovery (str): User's discovery preference
@@ -21,197 +517,163 @@ def score_songs(features_array, clusters, kmeans_model, song_map,
     Returns:
         dict: Dictionary mapping song IDs to score data
     """
-    # Create sets for liked and disliked songs for quick lookup
-    liked_songs_set = set(liked_song_ids)
-    disliked_songs_set = set(disliked_song_ids)
+    candidate_rows, scores = score_array(
+        features_array, clusters, columns, liked_song_ids, disliked_song_ids, discovery
+    )
     
-    # Get cluster statistics
-    cluster_counts = {}
-    cluster_liked_counts = {}
-    cluster_liked_songs = {}
+    return {
+        columns.song_id(row): {'score': score, 'song': columns.song(row)}
+        for row, score in zip(candidate_rows.tolist(), scores.tolist())
+    }
+
+def intern_artists(songs, artist_index=None):
+    """
+    Intern the artist IDs of songs into integer CSR arrays.
     
-    # Calculate base statistics per cluster
-    for idx, song_idx in enumerate(song_map.keys()):
-        song = song_map[song_idx]
-        song_id = song.get('spotifyId')
-        cluster_id = clusters[idx]
+    Args:
+        songs (iterable): Song documents in row order
+        artist_index (dict): Mapping from artist ID to its integer, extended
+            in place with new artists (optional)
         
-        # Skip if this isn't a valid song
-        if not song_id:
-            continue
-            
-        # Initialize cluster counts if needed
-        if cluster_id not in cluster_counts:
-            cluster_counts[cluster_id] = 0
-            cluster_liked_counts[cluster_id] = 0
-            cluster_liked_songs[cluster_id] = []
-            
-        # Count interactions
-        cluster_counts[cluster_id] += 1
+    Returns:
+        tuple: (artist_offsets, artist_values) where the artists of row i are
+            artist_values[artist_offsets[i]:artist_offsets[i + 1]]
+    """
+    if artist_index is None:
+        artist_index = {}
+    offsets = [0]
+    values = []
+    
+    for song in songs:
+        for artist in song.get('artists', []):
+            artist_id = artist.get('id')
+            if artist_id:
+                values.append(artist_index.setdefault(artist_id, len(artist_index)))
+        offsets.append(len(values))
+    
+    return np.array(offsets, dtype=np.int64), np.array(values, dtype=np.int32)
+
+def top_k_positions(scores, k):
+    """
+    Get the positions of the k highest scores, best first.
+    
+    Ties keep their original order, and every score tied with the k-th best is
+    included, so the result is a prefix of a stable descending sort.
+    
+    Args:
+        scores (np.array): Scores to select from
+        k (int): Number of positions wanted
         
-        # Count liked songs in this cluster
-        if song_id in liked_songs_set:
-            cluster_liked_counts[cluster_id] += 1
-            cluster_liked_songs[cluster_id].append(song_idx)
+    Returns:
+        np.array: Positions sorted by descending score, empty if k is not positive
+    """
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    window = np.nonzero(scores >= threshold)[0]
+    return window[np.argsort(-scores[window], kind='stable')]
+
+def select_diverse(scores, rows, artist_offsets, artist_values, limit, artist_max_songs=2):
+    """
+    Select the best scores while keeping at most a few songs per artist.
+    
+    Only a window of the best scores is sorted, and the window grows until the
+    artist constraint can be met, falling back to a full backfill without the
+    constraint when there are not enough diverse songs.
     
-    # Score each song
-    song_scores = {}
+    Args:
+        scores (np.array): Scores to select from
+        rows (np.array): CSR row of each score in the artist arrays
+        artist_offsets (np.array): Artist CSR offsets from intern_artists
+        artist_values (np.array): Artist CSR values from intern_artists
+        limit (int): Maximum number of positions to return
+        artist_max_songs (int): Maximum songs per artist
+        
+    Returns:
+        list: Selected positions in ranking order
+    """
+    window = limit * 4
     
-    # For each song in the dataset
-    for idx, song_idx in enumerate(song_map.keys()):
-        song = song_map[song_idx]
-        song_id = song.get('spotifyId')
+    while True:
+        order = top_k_positions(scores, window).tolist()
+        selected = []
+        artist_count = {}
         
-        # Skip if this isn't a valid song
-        if not song_id:
-            continue
-            
-        # Skip songs the user has already interacted with
-        if song_id in liked_songs_set or song_id in disliked_songs_set:
-            continue
-            
-        cluster_id = clusters[idx]
-        
-        # Base score is initially from popularity and recency
-        base_score = song.get('popularity', 50) / 100.0  # Normalize to 0-1
-        
-        # Adjust for song release date if available
-        if 'album' in song and 'releaseDate' in song['album']:
-            try:
-                release_date = datetime.fromisoformat(song['album']['releaseDate'].replace('Z', '+00:00'))
-                # Calculate recency score (1.0 for current year, decreasing for older)
-                current_year = datetime.now().year
-                years_old = max(0, current_year - release_date.year)
-                recency_factor = 1.0 / (1.0 + (years_old / 10.0))  # Decay factor
-                base_score = 0.7 * base_score + 0.3 * recency_factor
-            except (ValueError, TypeError):
-                # If date parsing fails, don't adjust
-                pass
-        
-        # Initialize score with base
-        score = base_score * 40  # Scale to make it significant
-        
-        # Factor 1: Cluster affinity
-        # Calculate affinity based on ratio of liked songs in this cluster
-        cluster_liked_ratio = 0
-        if cluster_counts.get(cluster_id, 0) > 0:
-            liked_count = cluster_liked_counts.get(cluster_id, 0)
-            total_count = cluster_counts.get(cluster_id, 0)
+        for pos in order:
+            row = rows[pos]
+            artist_ids = artist_values[artist_offsets[row]:artist_offsets[row + 1]].tolist()
             
-            # Use a weighted ratio that considers the amount of data
-            # This is to avoid overfitting on clusters with few samples
-            if total_count > 0:
-                confidence = min(1.0, total_count / 5.0)  # More ratings = more confidence
-                # Weighted average between observed ratio and neutral prior
-                cluster_liked_ratio = (confidence * liked_count / total_count) + (1 - confidence) * 0.5
-                
-                # Scale up the score based on this ratio (higher for clusters with more liked songs)
-                score += cluster_liked_ratio * 50  # Major factor
-        
-        # Factor 2: Feature similarity
-        # Find similar songs among those the user liked
-        if liked_song_ids:
-            # Calculate average distance to liked songs in same cluster
-            avg_distance = 100  # Start with large value
+            # Skip if we already have max songs from this artist
+            if any(artist_count.get(artist_id, 0) >= artist_max_songs for artist_id in artist_ids):
+                continue
             
-            # If there are liked songs in this cluster, compare to them
-            if cluster_id in cluster_liked_songs and cluster_liked_songs[cluster_id]:
-                distances = []
-                for liked_idx in cluster_liked_songs[cluster_id]:
-                    # Calculate Euclidean distance in feature space
-                    dist = np.linalg.norm(features_array[idx] - features_array[liked_idx])
-                    distances.append(dist)
-                
-                # Use smaller distances (more similar = better)
-                if distances:
-                    # Take average of top 3 closest songs or fewer
-                    distances.sort()
-                    avg_distance = np.mean(distances[:min(3, len(distances))])
+            selected.append(pos)
+            for artist_id in artist_ids:
+                artist_count[artist_id] = artist_count.get(artist_id, 0) + 1
             
-            # Convert distance to similarity score (smaller distance = higher score)
-            similarity_score = max(0, 30 - (avg_distance * 60))  # Scale and invert
-            score += similarity_score
-        
-        # Factor 3: Discovery preference adjustment
-        if discovery == 'similar':
-            # For users who want similar music, boost songs in clusters with liked songs
-            if cluster_liked_counts.get(cluster_id, 0) > 0:
-                score *= 1.3
-        elif discovery == 'explore':
-            # For users who want to explore, boost songs in clusters with fewer interactions
-            # but still prefer clusters with some likes over those with only dislikes
-            total_interactions = cluster_counts.get(cluster_id, 0)
-            if total_interactions == 0:
-                # Unexplored cluster
-                score *= 1.3
-            elif total_interactions < 3 and cluster_liked_counts.get(cluster_id, 0) > 0:
-                # Lightly explored with at least one like
-                score *= 1.2
-        
-        # Store the final score
-        song_scores[song_id] = {
-            'score': max(0, score),  # Ensure non-negative score
-            'song': song
-        }
+            if len(selected) >= limit:
+                return selected
+        
+        if len(order) >= len(scores):
+            break
+        window *= 4
+    
+    # If we don't have enough songs yet, add more without the artist constraint
+    chosen = set(selected)
+    for pos in order:
+        if len(selected) >= limit:
+            break
+        if pos not in chosen:
+            selected.append(pos)
     
-    return song_scores
+    return selected
 
-def rank_recommendations(song_scores, limit=50):
+def rank_candidates(candidate_rows, scores, columns, limit=50):
     """
-    Rank and select top recommendations based on scores with artist diversity.
+    Rank scored catalog rows and select top recommendations with artist diversity.
     
     Args:
-        song_scores (dict): Dictionary mapping song IDs to score data
+        candidate_rows (np.array): Feature indices from score_array
+        scores (np.array): Scores from score_array
+        columns (SongColumns): Scoring columns for the songs
         limit (int): Maximum number of recommendations to return
         
     Returns:
-        list: List of (song_id, data) tuples for top recommendations
+        list: List of (song_id, data) tuples for top recommendations, whose
+            songs only carry the fields kept in the columns
     """
-    # Sort songs by score (descending)
-    sorted_scores = sorted(
-        song_scores.items(), 
-        key=lambda x: x[1]['score'], 
-        reverse=True
+    selected = select_diverse(
+        scores, candidate_rows, columns.artist_offsets, columns.artist_values, limit
     )
     
-    # Apply artist diversity filter
     top_recommendations = []
-    artists_included = set()  # Track artists we've already included
-    artist_max_songs = 2      # Maximum songs per artist
-    artist_count = {}         # Count songs per artist
-    
-    # First pass: add top recommendations with artist diversity constraint
-    for song_id, data in sorted_scores:
-        if len(top_recommendations) >= limit:
-            break
-            
-        song = data['song']
-        # Get all artist IDs for this song
-        artist_ids = [artist.get('id') for artist in song.get('artists', []) if artist.get('id')]
-        
-        # Skip if we already have max songs from this artist
-        should_skip = False
-        for artist_id in artist_ids:
-            if artist_count.get(artist_id, 0) >= artist_max_songs:
-                should_skip = True
-                break
-                
-        if should_skip:
-            continue
-            
-        # Add the song and update artist counts
-        top_recommendations.append((song_id, data))
-        for artist_id in artist_ids:
-            artists_included.add(artist_id)
-            artist_count[artist_id] = artist_count.get(artist_id, 0) + 1
+    for pos in selected:
+        row = int(candidate_rows[pos])
+        top_recommendations.append(
+            (columns.song_id(row), {'score': float(scores[pos]), 'song': columns.song(row)})
+        )
+    return top_recommendations
+
+def rank_recommendations(song_scores, limit=50):
+    """
+    Rank and select top recommendations based on scores with artist diversity.
     
-    # If we don't have enough songs yet, add more without the artist constraint
-    if len(top_recommendations) < limit:
-        for song_id, data in sorted_scores:
-            if song_id not in [rec[0] for rec in top_recommendations] and len(top_recommendations) < limit:
-                top_recommendations.append((song_id, data))
+    Args:
+        song_scores (dict): Dictionary mapping song IDs to score data
+        limit (int): Maximum number of recommendations to return
+        
+    Returns:
+        list: List of (song_id, data) tuples for top recommendations
+    """
+    items = list(song_scores.items())
+    scores = np.array([data['score'] for _, data in items], dtype=float)
+    artist_offsets, artist_values = intern_artists(data['song'] for _, data in items)
     
-    return top_recommendations
+    selected = select_diverse(scores, np.arange(len(items)), artist_offsets, artist_values, limit)
+    return [items[pos] for pos in selected]
 
 def format_recommendations(top_recommendations):
     """
@@ -2,8 +2,13 @@
 Utility functions for the ML service.
 """
 
+import fcntl
 import logging
+import os
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from . import codec
 
 # Set up logging
 logging.basicConfig(
@@ -21,6 +26,93 @@ def log(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] {message}")
 
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive lock shared by every process using the same file.
+    
+    Args:
+        path (str): Lock file path, created if missing
+        blocking (bool): Wait for the lock instead of giving up
+        
+    Yields:
+        bool: Whether the lock was acquired
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        f = open(path, 'a')
+    except OSError:
+        # Without a writable lock file no other process can share the
+        # directory either, so there is nothing to coordinate with
+        yield True
+        return
+    
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class StageTimer:
+    """
+    Measure how long consecutive stages of a process take.
+    """
+
+    def __init__(self, observe=None):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.stages = {}
+        self.observe = observe
+
+    def mark(self, stage):
+        """
+        Record the time since the previous mark as the duration of a stage.
+        
+        Args:
+            stage (str): Name of the stage that just finished
+            
+        Returns:
+            float: Stage duration in seconds
+        """
+        now = time.perf_counter()
+        seconds = now - self.last
+        self.stages[stage] = seconds
+        self.last = now
+        if self.observe is not None:
+            self.observe(stage, seconds)
+        return seconds
+
+    def elapsed(self):
+        """
+        Returns:
+            float: Seconds since the timer started
+        """
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: Stage durations and total in milliseconds
+        """
+        timings = {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
+        timings['total'] = round(self.elapsed() * 1000, 3)
+        return timings
+
+def log_event(event, **fields):
+    """
+    Log a structured event as a single JSON line.
+    
+    Args:
+        event (str): Event name
+        **fields: JSON-serializable event fields
+    """
+    log(codec.dumps({'event': event, **fields}).decode())
+
 def extract_questionnaire_preferences(answers):
     """
     Extract mood, vibe, and discovery preferences from questionnaire answers.
@@ -0,0 +1,228 @@
+"""
+Regression tests comparing the vectorized scoring and ranking with the
+song-by-song implementation they replaced.
+"""
+from datetime import datetime
+import numpy as np
+import pytest
+from sklearn.cluster import KMeans
+from benchmarks import synthetic
+from model import feature_extraction
+from model import scoring
+from model import utils
+
+N_SONGS = 3000
+N_CLUSTERS = 12
+LIMIT = 15
+
+def reference_scores(features_array, clusters, songs, liked_song_ids, disliked_song_ids, discovery):
+    """
+    Score songs one at a time, as scoring.score_songs did before it was vectorized.
+
+    Args:
+        features_array (np.array): Normalized and weighted feature array
+        clusters (np.array): Array of cluster assignments
+        songs (list): Song documents in feature row order
+        liked_song_ids (list): List of liked song IDs
+        disliked_song_ids (list): List of disliked song IDs
+        discovery (str): User's discovery preference
+
+    Returns:
+        dict: Dictionary mapping song IDs to score data
+    """
+    liked_songs_set = set(liked_song_ids)
+    disliked_songs_set = set(disliked_song_ids)
+
+    cluster_counts = {}
+    cluster_liked_counts = {}
+    cluster_liked_songs = {}
+    for idx, song in enumerate(songs):
+        song_id = song.get('spotifyId')
+        cluster_id = clusters[idx]
+        if not song_id:
+            continue
+        if cluster_id not in cluster_counts:
+            cluster_counts[cluster_id] = 0
+            cluster_liked_counts[cluster_id] = 0
+            cluster_liked_songs[cluster_id] = []
+        cluster_counts[cluster_id] += 1
+        if song_id in liked_songs_set:
+            cluster_liked_counts[cluster_id] += 1
+            cluster_liked_songs[cluster_id].append(idx)
+
+    song_scores = {}
+    for idx, song in enumerate(songs):
+        song_id = song.get('spotifyId')
+        if not song_id or song_id in liked_songs_set or song_id in disliked_songs_set:
+            continue
+        cluster_id = clusters[idx]
+
+        base_score = song.get('popularity', 50) / 100.0
+        if 'album' in song and 'releaseDate' in song['album']:
+            release_date = datetime.fromisoformat(song['album']['releaseDate'].replace('Z', '+00:00'))
+            years_old = max(0, datetime.now().year - release_date.year)
+            recency_factor = 1.0 / (1.0 + (years_old / 10.0))
+            base_score = 0.7 * base_score + 0.3 * recency_factor
+        score = base_score * 40
+
+        total_count = cluster_counts[cluster_id]
+        confidence = min(1.0, total_count / 5.0)
+        cluster_liked_ratio = (confidence * cluster_liked_counts[cluster_id] / total_count) + (1 - confidence) * 0.5
+        score += cluster_liked_ratio * 50
+
+        if liked_song_ids:
+            avg_distance = 100
+            if cluster_liked_songs[cluster_id]:
+                distances = sorted(
+                    np.linalg.norm(features_array[idx] - features_array[liked_idx])
+                    for liked_idx in cluster_liked_songs[cluster_id]
+                )
+                avg_distance = np.mean(distances[:3])
+            score += max(0, 30 - (avg_distance * 60))
+
+        if discovery == 'similar':
+            if cluster_liked_counts[cluster_id] > 0:
+                score *= 1.3
+        elif discovery == 'explore':
+            if total_count < 3 and cluster_liked_counts[cluster_id] > 0:
+                score *= 1.2
+
+        song_scores[song_id] = {'score': max(0, score), 'song': song}
+    return song_scores
+
+def reference_ranking(song_scores, limit):
+    """
+    Rank by a full sort with at most two songs per artist, as
+    scoring.rank_recommendations did before select_diverse.
+
+    Args:
+        song_scores (dict): Dictionary mapping song IDs to score data
+        limit (int): Maximum number of recommendations to return
+
+    Returns:
+        list: Song IDs in ranking order
+    """
+    sorted_scores = sorted(song_scores.items(), key=lambda x: x[1]['score'], reverse=True)
+    selected = []
+    artist_count = {}
+    for song_id, data in sorted_scores:
+        if len(selected) >= limit:
+            break
+        artist_ids = [artist.get('id') for artist in data['song'].get('artists', []) if artist.get('id')]
+        if any(artist_count.get(artist_id, 0) >= 2 for artist_id in artist_ids):
+            continue
+        selected.append(song_id)
+        for artist_id in artist_ids:
+            artist_count[artist_id] = artist_count.get(artist_id, 0) + 1
+
+    for song_id, _ in sorted_scores:
+        if len(selected) >= limit:
+            break
+        if song_id not in selected:
+            selected.append(song_id)
+    return selected
+
+@pytest.fixture(scope='module')
+def catalog():
+    # Few artists per genre, so the artist limit and the backfill are exercised
+    songs = synthetic.generate_songs(N_SONGS, seed=7, artists_per_genre=4)
+    for song in songs[::97]:
+        song['artists'] = []
+    for song in songs[::211]:
+        song['spotifyId'] = None
+
+    features, columns = feature_extraction.extract_features(songs)
+    weighted = feature_extraction.apply_preference_weights(features, 'energetic', 'happy')
+    clusters = KMeans(n_clusters=N_CLUSTERS, n_init=1, random_state=0).fit_predict(weighted)
+    return songs, weighted, clusters, columns
+
+def _users(songs, count):
+    song_ids = [song['spotifyId'] for song in songs if song['spotifyId']]
+    return [synthetic.generate_user(song_ids, seed=seed) for seed in range(count)]
+
+@pytest.mark.parametrize('discovery', ['similar', 'explore', 'balanced'])
+def test_score_array_matches_reference(catalog, discovery):
+    songs, features, clusters, columns = catalog
+
+    for user in _users(songs, 3):
+        liked, disliked = utils.extract_song_preferences(user['preferences'])
+        expected = reference_scores(features, clusters, songs, liked, disliked, discovery)
+
+        rows, scores = scoring.score_array(features, clusters, columns, liked, disliked, discovery)
+
+        assert [columns.song_id(row) for row in rows.tolist()] == list(expected)
+        np.testing.assert_allclose(scores, [data['score'] for data in expected.values()], rtol=1e-5)
+
+def test_score_matrix_scores_users_independently(catalog):
+    songs, features, clusters, columns = catalog
+    users = _users(songs, 4)
+    discovery = ['similar', 'explore', 'balanced', 'similar']
+    ratings = [
+        scoring.resolve_ratings(columns, *utils.extract_song_preferences(user['preferences']))
+        for user in users
+    ]
+
+    scores, candidates = scoring.score_matrix(
+        features, clusters, columns.valid, scoring.base_scores(columns),
+        [liked for liked, _ in ratings], [rated for _, rated in ratings],
+        [len(liked) > 0 for liked, _ in ratings], discovery
+    )
+
+    for index, user in enumerate(users):
+        liked, disliked = utils.extract_song_preferences(user['preferences'])
+        expected = reference_scores(features, clusters, songs, liked, disliked, discovery[index])
+        rows = np.nonzero(candidates[index])[0]
+        assert [columns.song_id(row) for row in rows.tolist()] == list(expected)
+        np.testing.assert_allclose(
+            scores[index, rows], [data['score'] for data in expected.values()], rtol=1e-5
+        )
+
+@pytest.mark.parametrize('limit', [1, LIMIT, 200])
+def test_ranking_matches_reference(catalog, limit):
+    songs, features, clusters, columns = catalog
+
+    for user in _users(songs, 3):
+        liked, disliked = utils.extract_song_preferences(user['preferences'])
+        expected = reference_scores(features, clusters, songs, liked, disliked, 'similar')
+
+        rows, scores = scoring.score_array(features, clusters, columns, liked, disliked, 'similar')
+        ranked = scoring.rank_candidates(rows, scores, columns, limit=limit)
+
+        assert [song_id for song_id, _ in ranked] == reference_ranking(expected, limit)
+
+def test_select_diverse_matches_reference_with_ties():
+    rng = np.random.RandomState(3)
+    # Coarse scores tie often, and a handful of artists forces the backfill
+    scores = rng.randint(0, 20, size=500).astype(float)
+    songs = [
+        {'artists': [{'id': f'artist{a}'} for a in rng.choice(6, size=rng.randint(0, 3), replace=False)]}
+        for _ in range(500)
+    ]
+    song_scores = {f'song{i}': {'score': scores[i], 'song': song} for i, song in enumerate(songs)}
+    artist_offsets, artist_values = scoring.intern_artists(songs)
+
+    for limit in (1, 10, 40, 500):
+        selected = scoring.select_diverse(scores, np.arange(500), artist_offsets, artist_values, limit)
+        assert [f'song{pos}' for pos in selected] == reference_ranking(song_scores, limit)
+
+@pytest.mark.parametrize('discovery', ['similar', 'explore', 'balanced'])
+def test_score_rows_scores_only_allowed_songs(catalog, discovery):
+    songs, features, clusters, columns = catalog
+    allowed = np.random.RandomState(5).rand(len(columns)) < 0.2
+
+    for user in _users(songs, 3):
+        liked, disliked = utils.extract_song_preferences(user['preferences'])
+        liked_rows, rated_rows = scoring.resolve_ratings(columns, liked, disliked)
+        # Liked songs outside the allowed rows still count for similarity
+        allowed[liked_rows[::2]] = False
+
+        all_rows, all_scores = scoring.score_rows(
+            features, clusters, columns, liked_rows, rated_rows, True, discovery
+        )
+        rows, scores = scoring.score_rows(
+            features, clusters, columns, liked_rows, rated_rows, True, discovery, allowed=allowed
+        )
+
+        kept = allowed[all_rows]
+        np.testing.assert_array_equal(rows, all_rows[kept])
+        np.testing.assert_allclose(scores, all_scores[kept], rtol=1e-6)